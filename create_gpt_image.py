@@ -23,17 +23,89 @@ if version_info < (3, 0):
     exit('Python version must be 3.0 or higher')
 
 from logging import (debug, info, error, DEBUG, INFO, getLogger,
-                     basicConfig)
+                     basicConfig, root as root_logger)
 from argparse import ArgumentParser
-from os import remove, stat
-from os.path import isfile, normcase, normpath, realpath, abspath, dirname
-from struct import unpack, pack
-from uuid import UUID, uuid4
+import os
+from os import (remove, stat, fstat, ftruncate, fdatasync, lseek, makedirs,
+                SEEK_DATA, SEEK_HOLE, pread, replace, getpid, listdir, dup,
+                fdopen, strerror, preadv, pwrite, close, open as os_open,
+                O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC, O_DIRECT, SEEK_END,
+                SEEK_SET)
+from stat import S_ISREG, S_ISBLK
+from os.path import (isfile, isdir, normcase, normpath, realpath, abspath,
+                     basename, dirname, join)
+from struct import unpack, pack, calcsize
+from uuid import UUID, uuid4, uuid5
 from binascii import crc32
 from re import compile as re_compile
 from collections import namedtuple
 from configparser import ConfigParser, ParsingError, NoOptionError, NoSectionError
 from math import floor, log
+from errno import EBADF, EINVAL, ENOSYS, ENOTTY, ENXIO, EOPNOTSUPP, EXDEV
+from bisect import bisect_right
+from fcntl import ioctl
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from resource import getrusage, RUSAGE_SELF
+from threading import Lock, Thread
+from queue import Queue
+from hashlib import sha256, new as hash_new
+from mmap import mmap, ACCESS_READ
+from json import dump, dumps, load
+from gzip import open as gzip_open
+from lzma import open as lzma_open
+from ctypes import CDLL, get_errno, c_int, c_int64
+from zipfile import (ZipFile, ZIP_STORED, ZIP_DEFLATED, BadZipFile,
+                     is_zipfile)
+
+# the zstd compressed binaries are only supported with the zstandard module
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the holes are punched in the images with fallocate of the C library
+try:
+    libc = CDLL(None, use_errno=True)
+    libc.fallocate64.argtypes = (c_int, c_int, c_int64, c_int64)
+except (OSError, AttributeError):
+    libc = None
+
+
+# fallocate mode punching a hole without changing the size of the file
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# chunk of zero bytes used to detect the zero data of binaries
+ZERO_CHUNK = bytes(64 * 1024)
+
+# namespace of the deterministic GUIDs derived from a seed
+GUID_NAMESPACE = UUID('6f1c4ae4-9d55-4c2b-8e8f-3c2d0d5d1a7e')
+
+
+class GPTImageError(Exception):
+    """
+    Error raised while creating, reading or modifying a GPT/UEFI image, the
+    command line reports it and exits
+    """
+
+
+class LayoutError(GPTImageError):
+    """
+    Invalid TLB partition file or partitions layout
+    """
+
+
+class BinaryError(GPTImageError):
+    """
+    Invalid binary file of a partition
+    """
+
+
+class ImageError(GPTImageError):
+    """
+    Invalid GPT/UEFI image, or image which can't be written
+    """
 
 
 class MBRInfos(object):
@@ -126,15 +198,14 @@ class MBRInfos(object):
             self.dummy_2, self.dummy_3, self.sign \
             = unpack(MBRInfos._FMT, self.raw)
 
-    def write(self, img_file, offset=0):
+    def pack(self):
         """
-        Used to write MBR in an image file
+        Used to build the raw MBR written in an image file
         """
         self.raw = pack(MBRInfos._FMT, self.boot, self.os_type,
                         self.lba_start, self.lba_size, b'\x00',
                         MBRInfos._PART_ENTRY, b'\x00', self.sign)
-        img_file.seek(offset)
-        img_file.write(self.raw)
+        return self.raw
 
 
 class GPTHeaderInfos(object):
@@ -276,42 +347,33 @@ class GPTHeaderInfos(object):
             self.lba_start, self.table_length, self.entry_size, \
             self.table_crc = unpack(GPTHeaderInfos._FMT, self.raw)
 
-    def write(self, img_file, offset, block_size):
+    def pack(self, table_crc, backup=False):
         """
-        Used to write GPT header and backup in an image file
+        Used to build the raw GPT header, or the raw GPT backup, with the
+        CRC32 of the partition table and its own CRC32
         """
-        self.raw = pack(GPTHeaderInfos._FMT, self.sign, self.rev,
-                        self.size, 0, 1, self.lba_backup,
-                        self.lba_first, self.lba_last, self.uuid,
-                        2, self.table_length, self.entry_size, 0)
-
-        backup_raw = pack(GPTHeaderInfos._FMT, self.sign, self.rev,
-                          self.size, 0, self.lba_backup, 1,
-                          self.lba_first, self.lba_last, self.uuid,
-                          self.lba_start, self.table_length,
-                          self.entry_size, 0)
-
-        # writes a new GPT header
-        img_file.seek(offset)
-        img_file.write(self.raw)
-
-        # writes zero on unused blocks of GPT header
-        raw_stuffing = b'\x00' * (block_size - len(self.raw))
-        img_file.write(raw_stuffing)
+        # the backup points to the header and to the backup partition table
+        if backup:
+            lba_current, lba_other, lba_table = self.lba_backup, 1, \
+                self.lba_start
+        else:
+            lba_current, lba_other, lba_table = 1, self.lba_backup, 2
 
-        # saves the end of the GPT header
-        gpt_header_end = img_file.tell()
+        fields = [self.sign, self.rev, self.size, 0, lba_current, lba_other,
+                  self.lba_first, self.lba_last, self.uuid, lba_table,
+                  self.table_length, self.entry_size, table_crc]
 
-        # writes a new GPT backup
-        backup_position = self.lba_backup * block_size
-        img_file.seek(backup_position)
-        img_file.write(backup_raw)
+        # computes the CRC32 of the header with its CRC field zeroed
+        fields[3] = crc32(pack(GPTHeaderInfos._FMT, *fields)) & 0xffffffff
+        raw = pack(GPTHeaderInfos._FMT, *fields)
 
-        # writes zero on unused blocks of GPT backup
-        img_file.write(raw_stuffing)
+        if not backup:
+            self.raw = raw
+            self.crc = fields[3]
+            self.lba_current = lba_current
+            self.table_crc = table_crc
 
-        # sets the read pointer at the end of GPT header wrote
-        img_file.seek(gpt_header_end)
+        return raw
 
 
 class PartTableInfos(list):
@@ -347,30 +409,30 @@ class PartTableInfos(list):
             entry.read(self.raw)
             self.append(entry)
 
-    def write(self, img_file, offset, entry_size, tlb_infos, last_usable):
+    def pack(self, tlb_infos, length, entry_size):
         """
-        Used to write GPT partitions tables in an image file
+        Used to build the raw GPT partition table, written in an image file
+        as primary and as backup partition table
         """
+        if len(tlb_infos) > length:
+            raise LayoutError('Too many partitions: {0}, the partition table '
+                              'is limited to {1} entries'
+                              .format(len(tlb_infos), length))
+
         # erases the partition table entries
-        self = []
+        del self[:]
 
-        # writes all new partition entries in GPT header
-        current_offset = offset
+        # builds all new partition entries
         for pos, part_info in enumerate(tlb_infos):
             entry = TableEntryInfos(pos, entry_size)
-            entry.write(img_file, current_offset, part_info)
-            current_offset += entry_size
+            entry.pack(part_info)
             self.append(entry)
 
-        # copies all partition entries wrote from GPT header to
-        # the GPT backup
-        img_file.seek(offset)
-        raw_entries_size = current_offset - offset
-        raw_entries = img_file.read(raw_entries_size)
-        img_file.seek(last_usable + 1)
-        img_file.write(raw_entries)
+        # the unused entries are zeroed
+        raw_entries = b''.join(entry.raw for entry in self)
+        self.raw = raw_entries.ljust(length * entry_size, b'\x00')
 
-        img_file.seek(current_offset)
+        return self.raw
 
 
 class TableEntryInfos(object):
@@ -441,9 +503,9 @@ class TableEntryInfos(object):
         self.type, self.uuid, self.lba_first, self.lba_last, self.attr, \
             self.name = unpack(TableEntryInfos._FMT, self.raw)
 
-    def write(self, img_file, offset, entry_info):
+    def pack(self, entry_info):
         """
-        Use to write a partition table entries in an image file
+        Use to build a raw partition table entry written in an image file
         """
         types = {
             'Unused': '00000000-0000-0000-0000-000000000000',
@@ -530,9 +592,8 @@ class TableEntryInfos(object):
             else:
                 tuuid = UUID(types[entry_info.type]).bytes_le
         else:
-            error('Unknown partition type: {0} {1}'
-                  .format(entry_info.label, entry_info.type))
-            exit(-1)
+            raise LayoutError('Unknown partition type: {0} {1}'
+                              .format(entry_info.label, entry_info.type))
 
         # sets the partition uuid
         puuid = UUID(entry_info.uuid).bytes_le
@@ -542,353 +603,2501 @@ class TableEntryInfos(object):
                         int(entry_info.begin), last, 0,
                         entry_info.label.encode('utf-16le'))
 
-        img_file.seek(offset)
-        img_file.write(self.raw)
+        # an entry may be larger than the raw entry
+        self.raw = self.raw.ljust(self.size, b'\x00')
 
+        # keeps the information of the raw entry
+        self.type, self.uuid, self.lba_first, self.lba_last, self.attr, \
+            self.name = unpack(TableEntryInfos._FMT,
+                               self.raw[:calcsize(TableEntryInfos._FMT)])
 
-TLB_INFO = namedtuple('TLB_INFO', ('begin', 'size', 'type', 'uuid', 'label'))
+        return self.raw
 
 
-class TLBInfos(list):
+class BinaryCopier(object):
     """
-    TLB information extracted from the TLB partition file
+    Copy engine used to write binary files in the partitions of an image.
+
+    The copy is done by the kernel whenever it's possible, trying in order:
+      - a FICLONERANGE reflink, when the binary and the image share a
+        btrfs/xfs file system,
+      - os.copy_file_range,
+      - os.sendfile,
+    then falls back to a large reusable buffer. A method which isn't
+    supported is disabled for the next copies of the write, the copiers of
+    the partitions of a write share the disabled methods. A cross device
+    copy is only disabled from the file system of the binary. When the
+    copied data is hashed, it has to go through the buffer, so the kernel
+    copies aren't used.
+
+    Only the data extents of the binary, found with SEEK_DATA and
+    SEEK_HOLE, are given to the kernel copies, its holes are zeroed without
+    being read. In sparse mode, the holes and the zero chunks detected in
+    the buffer are skipped: a new image is already zero there, but in an
+    image which may already hold data, they are punched as holes, or
+    overwritten with zeros when holes can't be punched. Only the reflink
+    keeps the holes, so the other kernel copies are disabled. Out of
+    sparse mode, the zeros are written, the image isn't made sparse.
+
+    The system calls done by the copies are counted by name in syscalls.
     """
-    __slots__ = ('path', 'format', 'slotab')
+    __slots__ = ('sparse', 'methods', 'disabled', 'buffer', 'digests',
+                 'punch', 'syscalls')
 
-    def __init__(self, path):
-        super(TLBInfos, self).__init__()
-        self.path = path
-        self._set_format()
-        self.slotab = 0
+    _FICLONERANGE = 0x4020940d
 
-    def __repr__(self):
-        result = ''
+    _CLONE_FMT = '=qQQQ'
 
-        for item in self:
-            line = ('add -b {0} -s {1} -t {2} -u {3} -l {4}'
-                    '\n').format(item.begin, item.size, item.type, item.uuid,
-                                 item.label)
-            result = '{0}{1}'.format(result, line)
+    _BUFFER_SIZE = 4 * 1024 * 1024
 
-        return result
+    _SPARSE_CHUNK_SIZE = 64 * 1024
 
-    def _set_format(self):
+    _UNSUPPORTED = (EXDEV, EINVAL, ENOSYS, EOPNOTSUPP, ENOTTY, EBADF)
+
+    def __init__(self, sparse=False, digests=None, punch=False,
+                 disabled=None):
+        self.sparse = sparse
+        self.buffer = None
+        self.digests = digests
+        self.punch = punch
+        self.syscalls = {}
+
+        # the methods which failed, by name or by name and device of the
+        # binary for the cross device copies, shared by the copiers of a
+        # write
+        self.disabled = set() if disabled is None else disabled
+
+        self.methods = []
+        if digests is None:
+            self.methods.append('reflink')
+        if not sparse and digests is None:
+            if hasattr(os, 'copy_file_range'):
+                self.methods.append('copy_file_range')
+            if hasattr(os, 'sendfile'):
+                self.methods.append('sendfile')
+
+    def copy(self, src_fd, dst_fd, dst_offset, length, src_offset=0):
         """
-        Identify the format of the TLB partition file
+        Copies length bytes of the source file from src_offset to the
+        destination file at dst_offset, the holes of the source are skipped
         """
-        self.format = 'ini'
+        position = src_offset
+        for start, end in data_extents(src_fd, src_offset + length,
+                                       src_offset):
+            self.zero(dst_fd, dst_offset + position - src_offset,
+                      start - position)
+            self._copy_data(src_fd, dst_fd, dst_offset + start - src_offset,
+                            end - start, start)
+            position = end
+        self.zero(dst_fd, dst_offset + position - src_offset,
+                  src_offset + length - position)
+
+    def zero(self, dst_fd, dst_offset, length):
+        """
+        Leaves length zero bytes at dst_offset of the destination file, they
+        are hashed without being read
+        """
+        if length <= 0:
+            return
+        hash_fill(self.digests, b'\x00' * 4, length)
+        self.skip(dst_fd, dst_offset, length)
 
-        with open(self.path, 'r') as tlb_file:
-            for line in tlb_file:
-                # determines the type of partition table file
-                # If file contains "partition_table=gpt" pattern then
-                # it's a JSON TLB partition file,
-                # else it's probably an INI TLB partition file.
-                # Parser will then check if the file is correct.
-                tlb_file_type_found = line.find("partition_table=gpt")
-
-                if tlb_file_type_found != -1:
-                    self.format = 'tbl'
-                    break
+    def skip(self, dst_fd, dst_offset, length):
+        """
+        Skips a zero region of the destination file in sparse mode, punched
+        or overwritten if the destination may already hold data there. Out of
+        sparse mode, the zeros are written.
+        """
+        if not self.sparse:
+            self.count('pwrite', write_zero(dst_fd, dst_offset, length))
+        elif self.punch:
+            self.count('fallocate')
+            zero_region(dst_fd, dst_offset, length)
 
-        debug('Partition table format: {0}'.format(self.format))
+    def count(self, syscall, calls=1):
+        """
+        Counts the calls of a system call done by the copies
+        """
+        self.syscalls[syscall] = self.syscalls.get(syscall, 0) + calls
 
-    def _read_json(self, block_size):
+    def _enabled(self, src_fd):
         """
-        Used to read a JSON TLB partition file
+        Gives the copy methods which aren't disabled for a source file
         """
-        with open(self.path, 'rb') as tlb_file:
-            re_parser = re_compile(r'^add\s-b\s(?P<begin>\w+)\s-s\s'
-                                   '(?P<size>[\w$()-]+)\s-t\s'
-                                   '(?P<type>\w+)\s-u\s'
-                                   '(?P<uuid>[\w-]+)\s'
-                                   '-l\s(?P<label>\w+)'
-                                   )
-            # reads the JSON TLB file to instantiate a the TLBInfos
-            for line in tlb_file:
-                debug('TLB reading line: {0}'.format(line))
-                parsed_line = re_parser.match(line)
-
-                if parsed_line:
-                    debug('TLB parsed line: {0}'.format(line))
-                    debug('\t begin: {0}'
-                          .format(parsed_line.group('begin')))
-                    debug('\t size: {0}'.format(parsed_line.group('size')))
-                    debug('\t type: {0}'.format(parsed_line.group('type')))
-                    debug('\t uuid: {0}'.format(parsed_line.group('uuid')))
-                    debug('\t label: {0}'
-                          .format(parsed_line.group('label')))
-
-                    self.append(TLB_INFO(*parsed_line.groups()))
+        if not self.disabled:
+            return self.methods
+
+        device = fstat(src_fd).st_dev
+        return [method for method in self.methods
+                if method not in self.disabled and
+                (method, device) not in self.disabled]
 
+    def _copy_data(self, src_fd, dst_fd, dst_offset, length, src_offset):
+        """
+        Copies a region of data of the source file, with the first method
+        which is supported
+        """
+        done = 0
+        for method in self._enabled(src_fd):
+            if done >= length:
+                return
+            try:
+                done += getattr(self, '_copy_{0}'.format(method))(
+                    src_fd, src_offset + done, dst_fd, dst_offset + done,
+                    length - done)
+            except OSError as err:
+                if err.errno not in BinaryCopier._UNSUPPORTED:
+                    raise
+                debug('Copy with {0} failed: {1}'.format(method, err))
+                # a cross device copy may succeed for a binary of another
+                # file system
+                if err.errno == EXDEV:
+                    self.disabled.add((method, fstat(src_fd).st_dev))
                 else:
-                    debug('TLB not parsed line: {0}'.format(line))
+                    self.disabled.add(method)
 
-    def _preparse_partitions(self, cfg):
+        if done < length:
+            self._copy_buffer(src_fd, src_offset + done, dst_fd,
+                              dst_offset + done, length - done)
+
+    def _copy_reflink(self, src_fd, src_offset, dst_fd, dst_offset, length):
         """
-        Taken from gpt_ini2bin.py
+        Shares the extents of the source with the destination, only the part
+        aligned on the file system blocks can be cloned
         """
-        with open(self.path, 'r') as f:
-            data = f.read()
+        fs_block = fstat(dst_fd).st_blksize
+        if src_offset % fs_block or dst_offset % fs_block:
+            return 0
+
+        size = length - length % fs_block
+        if size == 0:
+            return 0
+
+        self.count('ioctl')
+        ioctl(dst_fd, BinaryCopier._FICLONERANGE,
+              pack(BinaryCopier._CLONE_FMT, src_fd, src_offset, size,
+                   dst_offset))
+        return size
+
+    def _copy_copy_file_range(self, src_fd, src_offset, dst_fd, dst_offset,
+                              length):
+        """
+        Copies in the kernel, without going through the user space
+        """
+        done = 0
+        while done < length:
+            self.count('copy_file_range')
+            size = os.copy_file_range(src_fd, dst_fd, length - done,
+                                      src_offset + done, dst_offset + done)
+            if size == 0:
+                break
+            done += size
+        return done
+
+    def _copy_sendfile(self, src_fd, src_offset, dst_fd, dst_offset, length):
+        """
+        Copies in the kernel, sendfile writes at the current position of the
+        destination
+        """
+        self.count('lseek')
+        lseek(dst_fd, dst_offset, SEEK_SET)
+        done = 0
+        while done < length:
+            self.count('sendfile')
+            size = os.sendfile(dst_fd, src_fd, src_offset + done,
+                               length - done)
+            if size == 0:
+                break
+            done += size
+        return done
+
+    def _copy_buffer(self, src_fd, src_offset, dst_fd, dst_offset, length):
+        """
+        Copies through a buffer allocated once and reused for all the copies
+        """
+        if self.buffer is None:
+            self.buffer = bytearray(BinaryCopier._BUFFER_SIZE)
+        view = memoryview(self.buffer)
+
+        done = 0
+        while done < length:
+            self.count('preadv')
+            size = preadv(src_fd, [view[:min(len(view), length - done)]],
+                          src_offset + done)
+            if size == 0:
+                break
+
+            if self.digests:
+                for digest in self.digests:
+                    digest.update(view[:size])
+
+            self._write_data(dst_fd, dst_offset + done, view[:size])
+            done += size
+        return done
+
+    def write(self, dst_fd, dst_offset, data):
+        """
+        Writes data already in memory at dst_offset of the destination file,
+        it's hashed and its zero chunks are skipped
+        """
+        if self.digests:
+            for digest in self.digests:
+                digest.update(data)
 
-            try:
-                self.slotab = cfg.getint('base', 'nb_slot')
-            except NoOptionError:
-                self.slotab = 0
+        self._write_data(dst_fd, dst_offset, memoryview(data))
 
-            start_part = cfg.get('base', 'partitions').split()
+    def _write_data(self, dst_fd, dst_offset, view):
+        """
+        Writes the non-zero chunks of the data, the zero chunks are skipped
+        in sparse mode. Each chunk is compared once, the consecutive chunks
+        of data or of zeros are written or skipped at once.
+        """
+        size = len(view)
+        if not self.sparse:
+            self.count('pwrite', write_all(dst_fd, view, dst_offset))
+            return
 
-            try:
-                slot_group_bsp = cfg.get('base.slot_group_bsp', 'partitions').split()
-            except NoSectionError:
-                slot_group_bsp = []
+        chunk = BinaryCopier._SPARSE_CHUNK_SIZE
+
+        start = None
+        zero_start = None
+        for pos in range(0, size, chunk):
+            end = min(pos + chunk, size)
+            if is_zero(view[pos:end]):
+                if start is not None:
+                    self.count('pwrite', write_all(dst_fd, view[start:pos],
+                                                   dst_offset + start))
+                    start = None
+                if zero_start is None:
+                    zero_start = pos
+            else:
+                if zero_start is not None:
+                    self.skip(dst_fd, dst_offset + zero_start,
+                              pos - zero_start)
+                    zero_start = None
+                if start is None:
+                    start = pos
 
-            try:
-                slot_group_aosp = cfg.get('base.slot_group_aosp', 'partitions').split()
-            except NoSectionError:
-                slot_group_aosp = []
+        if start is not None:
+            self.count('pwrite', write_all(dst_fd, view[start:size],
+                                           dst_offset + start))
+        if zero_start is not None:
+            self.skip(dst_fd, dst_offset + zero_start, size - zero_start)
 
-            try:
-                end_part = cfg.get('base.end', 'partitions').split()
-            except NoSectionError:
-                end_part = []
 
-            for l in data.split('\n'):
-                words = l.split()
-                if len(words) > 2:
-                    if words[0] == 'partitions' and words[1] == '+=':
-                        start_part += words[2:]
+class SparseImage(object):
+    """
+    Android sparse image used as a partition binary, expanded on the fly in
+    the partition.
+
+    Sparse header format is a little-endian struct with:
+    +----------------+--------+------+--------+
+    | name           | type   | size | format |
+    +================+========+======+========+
+    | magic          | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+    | major version  | ushort | 2    | H      |
+    +----------------+--------+------+--------+
+    | minor version  | ushort | 2    | H      |
+    +----------------+--------+------+--------+
+    | file hdr size  | ushort | 2    | H      |
+    +----------------+--------+------+--------+
+    | chunk hdr size | ushort | 2    | H      |
+    +----------------+--------+------+--------+
+    | block size     | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+    | total blocks   | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+    | total chunks   | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+    | checksum       | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+
+    Each chunk starts with a header:
+    +----------------+--------+------+--------+
+    | chunk type     | ushort | 2    | H      |
+    +----------------+--------+------+--------+
+    | reserved       | ushort | 2    | H      |
+    +----------------+--------+------+--------+
+    | size in blocks | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+    | total size     | uint   | 4    | I      |
+    +----------------+--------+------+--------+
+    """
+    __slots__ = ('path', 'magic', 'major', 'minor', 'file_hdr_size',
+                 'chunk_hdr_size', 'block_size', 'total_blocks',
+                 'total_chunks', 'checksum')
 
-        return start_part, slot_group_bsp, slot_group_aosp, end_part
+    MAGIC = 0xed26ff3a
 
-    def _contruct_tlb_info(self, start_lba, cfg, block_size, parts):
-        for part in parts:
-            partname = 'partition.{0}'.format(part)
-            ptype = cfg.get(partname, 'type')
-            label = cfg.get(partname, 'label')
+    CHUNK_RAW = 0xcac1
+    CHUNK_FILL = 0xcac2
+    CHUNK_DONT_CARE = 0xcac3
+    CHUNK_CRC32 = 0xcac4
 
-            nb_slots = 1
-            if self.slotab == 2:
-                try:
-                    if cfg.get(partname, 'has_slot') == 'true':
-                        nb_slots = 2
-                except NoOptionError:
-                    nb_slots = 1
+    _FMT = '<IHHHHIIII'
 
-            for slot_id in range(nb_slots):
-                try:
-                    begin = cfg.get(partname, 'start_lba')
-                    begin = int(begin.split(',')[slot_id])
-                except NoOptionError:
-                    begin = start_lba
+    _CHUNK_FMT = '<HHII'
 
-                try:
-                    readlen = cfg.get(partname, 'len')
-                    readlen = int(readlen.split(',')[slot_id])
-                except IndexError:
-                    readlen = cfg.getint(partname, 'len')
+    _FILL_SIZE = 1024 * 1024
 
-                if readlen > 0:
-                    size = (readlen * 1024 * 1024) // block_size
-                    start_lba = begin + size
-                else:
-                    size = readlen
+    def __init__(self, path):
+        self.path = path
 
-                uuid = str(uuid4())
-                if nb_slots == 1:
-                    self.append(TLB_INFO(begin, size, ptype, uuid, label))
-                    break
-                self.append(TLB_INFO(begin, size, ptype, uuid,
-                            label + '_%c' % (ord('a') + slot_id)))
-        return start_lba
+        self.magic = 0
+        self.major = 0
+        self.minor = 0
+        self.file_hdr_size = 0
+        self.chunk_hdr_size = 0
+        self.block_size = 0
+        self.total_blocks = 0
+        self.total_chunks = 0
+        self.checksum = 0
 
-    def _contruct_tlb_grp_info(self, start_lba, cfg, block_size, parts):
-        for grp_id in range(self.slotab):
-            for part in parts:
-                partname = 'partition.{0}'.format(part)
-                ptype = cfg.get(partname, 'type')
-                uuid = str(uuid4())
-                label = cfg.get(partname, 'label')
+    @classmethod
+    def is_sparse(cls, bin_file):
+        """
+        Checks if the binary file starts with the magic of sparse images
+        """
+        raw = pread(bin_file.fileno(), 4, 0)
+        return len(raw) == 4 and unpack('<I', raw)[0] == cls.MAGIC
 
-                try:
-                    readlen = cfg.get(partname, 'len')
-                    readlen = int(readlen.split(',')[grp_id])
-                except IndexError:
-                    readlen = cfg.getint(partname, 'len')
+    @property
+    def size(self):
+        """
+        Size in Bytes of the expanded image
+        """
+        return self.block_size * self.total_blocks
 
-                try:
-                    begin = cfg.get(partname, 'start_lba')
-                    begin = int(begin.split(',')[grp_id])
-                except NoOptionError:
-                    begin = start_lba
+    def read(self, bin_file):
+        """
+        Reads the header of a sparse image
+        """
+        self.parse(pread(bin_file.fileno(), calcsize(SparseImage._FMT), 0))
 
-                if readlen > 0:
-                    size = (readlen * 1024 * 1024) // block_size
-                    start_lba = begin + size
-                else:
-                    size = readlen
+    def parse(self, raw):
+        """
+        Parses the raw header of a sparse image
+        """
+        if len(raw) != calcsize(SparseImage._FMT):
+            raise BinaryError('Invalid sparse image: {0}'.format(self.path))
 
-                self.append(TLB_INFO(begin, size, ptype, uuid,
-                            label + '_%c' % (ord('a') + grp_id)))
-        return start_lba
+        self.magic, self.major, self.minor, self.file_hdr_size, \
+            self.chunk_hdr_size, self.block_size, self.total_blocks, \
+            self.total_chunks, self.checksum = unpack(SparseImage._FMT, raw)
 
-    def _read_ini(self, block_size):
+        if self.magic != SparseImage.MAGIC or self.major != 1 or \
+                self.block_size == 0 or self.block_size % 4:
+            raise BinaryError('Invalid sparse image: {0}'.format(self.path))
+
+    def chunks(self, bin_file):
         """
-        Used to read a INI TLB partition file
+        Iterates on the chunks of the sparse image, gives their type, their
+        expanded size in Bytes and their data: the offset of RAW data in the
+        file, the pattern of FILL chunks or None. The file is read with
+        positional I/O, so it can be shared by several writers.
         """
-        # sets a parser to read the INI TLB partition file
-        cfg = ConfigParser(strict=False)
-        try:
-            cfg.read(self.path)
+        offset = self.file_hdr_size
 
-        except ParsingError:
-            error('Invalid TLB partition file: {0}'.format(self.path))
-            exit(-1)
+        for _ in range(self.total_chunks):
+            raw = pread(bin_file.fileno(), self.chunk_hdr_size, offset)
+            offset += self.chunk_hdr_size
+            chunk_type, chunk_size, data_size = self.parse_chunk(raw)
 
-        # gpt.ini is not a "standard" ini file because keys are not uniques
-        start_part, slot_group_bsp, slot_group_aosp, end_part = self._preparse_partitions(cfg)
+            if chunk_type == SparseImage.CHUNK_RAW:
+                yield chunk_type, chunk_size, offset
 
-        # sets the start lba value which the read value or uses the default
-        # value
-        try:
-            start_lba_prev = cfg.getint('base', 'start_lba')
-            debug('The start_lba value read in the TLB partition file')
+            elif chunk_type == SparseImage.CHUNK_FILL:
+                pattern = pread(bin_file.fileno(), data_size, offset)
+                if len(pattern) != 4:
+                    raise BinaryError('Invalid FILL chunk in sparse image: {0}'
+                                      .format(self.path))
+                yield chunk_type, chunk_size, pattern
 
-        except NoOptionError:
-            # set start lba to offset 1M bytes, align with kernelflinger
-            start_lba_prev = 1024 * 1024 // block_size
-            info('The start_lba value is undefined in the TLB partition file,'
-                 ' the default value is used: {0}'.format(start_lba_prev))
+            elif chunk_type == SparseImage.CHUNK_DONT_CARE:
+                yield chunk_type, chunk_size, None
 
-        # contructs the TLB info
-        start_lba = self._contruct_tlb_info(start_lba_prev, cfg, block_size,
-                                            start_part)
-        start_lba = self._contruct_tlb_grp_info(start_lba, cfg, block_size,
-                                                slot_group_bsp)
-        start_lba = self._contruct_tlb_grp_info(start_lba, cfg, block_size,
-                                                slot_group_aosp)
-        self._contruct_tlb_info(start_lba, cfg, block_size, end_part)
+            offset += data_size
 
-    def read(self, block_size):
+    def parse_chunk(self, raw):
         """
-        Read a TLB file
+        Parses the raw header of a chunk, gives its type, its expanded size
+        and the size of its data in Bytes
         """
-        # reads the JSON TLB partition file
-        if self.format == 'tbl':
-            self._read_json(block_size)
+        if len(raw) != self.chunk_hdr_size:
+            raise BinaryError('Truncated sparse image: {0}'.format(self.path))
 
-        # reads the INI TLB partition file
-        else:
-            self._read_ini(block_size)
+        chunk_type, _, chunk_blocks, total_size = \
+            unpack(SparseImage._CHUNK_FMT,
+                   raw[:calcsize(SparseImage._CHUNK_FMT)])
+        data_size = total_size - self.chunk_hdr_size
+        chunk_size = chunk_blocks * self.block_size
 
-    def _recompute_partition_begin(self):
+        if chunk_type == SparseImage.CHUNK_RAW and data_size != chunk_size:
+            raise BinaryError('Invalid RAW chunk in sparse image: {0}'
+                              .format(self.path))
+
+        if chunk_type not in (SparseImage.CHUNK_RAW, SparseImage.CHUNK_FILL,
+                              SparseImage.CHUNK_DONT_CARE,
+                              SparseImage.CHUNK_CRC32):
+            raise BinaryError('Unknown chunk type 0x{0:04x} in sparse image: '
+                              '{1}'.format(chunk_type, self.path))
+
+        return chunk_type, chunk_size, data_size
+
+    def write(self, bin_file, img_fd, offset, copier):
         """
-        Ensure that partitions do not overlap
+        Expands the chunks of the sparse image at the offset of the image:
+        RAW chunks are copied, FILL chunks are written with their pattern and
+        DONT_CARE chunks are left untouched, they are hashed as zeros
         """
-        new_begin = -1
-        for pos, entry in enumerate(self):
-            if new_begin == -1:
-                new_begin = self[pos].begin + self[pos].size
-                continue
-            self[pos] = self[pos]._replace(begin=new_begin)
-            new_begin += self[pos].size
+        position = offset
+
+        for chunk_type, chunk_size, data in self.chunks(bin_file):
+            if chunk_type == SparseImage.CHUNK_RAW:
+                copier.copy(bin_file.fileno(), img_fd, position, chunk_size,
+                            data)
+            elif chunk_type == SparseImage.CHUNK_FILL:
+                self._fill(img_fd, position, chunk_size, data, copier)
+                hash_fill(copier.digests, data, chunk_size)
+            else:
+                hash_fill(copier.digests, b'\x00' * 4, chunk_size)
 
-    def compute_last_size_entry(self, img_size, block_size, entry_size,
-                                table_length):
+            position += chunk_size
+
+    def _fill(self, img_fd, offset, size, pattern, copier):
         """
-        Compute the size of the last TLB entry
+        Writes a 4 Bytes pattern on size Bytes, zero fills are skipped by the
+        copier
         """
-        last = -1
-        # reserve the size for primary and secondary gpt
-        MB = 1024 * 1024
-        remaining_size = (img_size - MB) // block_size - 2048
-        for pos, entry in enumerate(self):
-            debug('Entry size: {0}'.format(entry.size))
-            if entry.size < 0:
-                if (last == -1):
-                    last = pos
-                    continue
-                else:
-                    error('Only one partition of size -1 allowed')
-                    exit(-1)
-            remaining_size -= entry.size
-
-        # if all entries size are already defined
-        if last == -1:
-            debug('All entry sizes are already defined.')
+        if pattern == b'\x00' * 4:
+            copier.skip(img_fd, offset, size)
             return
 
-        if remaining_size < 0:
-            error('The image size is too small regarding partition mapping.')
-            missing = -remaining_size * block_size
-            error('Missing at least: {0} Bytes.'.format(missing))
-            exit(-1)
-
-        # Update the size of the partition with -1 size and recompute
-        # the start of each partitions after it
-        self[last] = self[last]._replace(size=remaining_size)
-        self._recompute_partition_begin()
+        fill = fill_pattern(pattern, size)
+        done = 0
+        while done < size:
+            length = min(len(fill), size - done)
+            write_all(img_fd, fill[:length], offset + done)
+            done += length
 
 
-class GPTImage(object):
+class CompressedImage(object):
     """
-    GPT/UEFI image.
+    Compressed binary file, gzip, xz or zstd, decompressed on the fly in the
+    partition.
+
+    Its size is the decompressed size given by the container: the size of
+    the last member for gzip, modulo 4 GiB, the sum of the blocks of the
+    index of the last stream for xz and the content size of the first frame
+    for zstd. It's only a lower bound, or 0 when it's unknown, so the
+    decompressed data is also bounded by the size of the partition.
     """
-    __slots__ = ('path', 'size', 'block_size', 'mbr',
-                 'gpt_header', 'table')
+    __slots__ = ('path', 'compression', 'size')
 
-    ANDROID_PARTITIONS = [
-        'xen_dom0',
-        'xen_misc',
-        'xen_guest',
-        'xen_rootfs',
-        'sos_boot',
-        'uos_boot',
-        'android_guest',
-        'sos_rootfs',
-        'uos_rootfs',
-        'vbmeta',
-        'multiboot',
-        'esp',
-        'esp2',
-        'bootloader',
-        'bootloader2',
-        'bldr_utils',
-        'boot',
-        'recovery',
-        'misc',
-        'metadata',
-        'system',
-        'vendor',
-        'vendor_boot',
-        'init_boot',
-        'product',
-        'odm',
-        'acpi',
-        'acpio',
-        'cache',
-        'data',
-        'userdata',
-        'persistent',
-        'factory',
-        'config',
-        'tos',
-        'mfos',
-        'teedata',
-        'super',
-        'reserved'
-        ]
+    FORMATS = (('gzip', b'\x1f\x8b'),
+               ('xz', b'\xfd7zXZ\x00'),
+               ('zstd', b'\x28\xb5\x2f\xfd'))
 
-    def __init__(self, path, size='5G', block_size=512, gpt_header_size=92):
+    _XZ_FOOTER_SIZE = 12
 
+    def __init__(self, path, compression):
         self.path = path
-        self.size = GPTImage.convert_size_to_bytes(size)
-        self.block_size = block_size
+        self.compression = compression
+        self.size = 0
 
-        self.mbr = MBRInfos(self.block_size)
-        self.gpt_header = GPTHeaderInfos(self.size, block_size,
-                                         gpt_header_size)
-        self.table = PartTableInfos()
+    @classmethod
+    def detect(cls, bin_file):
+        """
+        Gives the compression of the binary file from its magic, or None
+        """
+        raw = pread(bin_file.fileno(), 6, 0)
+        for compression, magic in cls.FORMATS:
+            if raw.startswith(magic):
+                return compression
+        return None
+
+    def read(self, bin_file):
+        """
+        Reads the decompressed size from the container
+        """
+        if self.compression == 'zstd' and zstandard is None:
+            raise BinaryError('The zstandard module is needed to decompress: '
+                              '{0}'.format(self.path))
+
+        size = getattr(self, '_{0}_size'.format(self.compression))(
+            bin_file.fileno(), fstat(bin_file.fileno()).st_size)
+        self.size = size or 0
+
+    @classmethod
+    def _gzip_size(cls, fd, length):
+        """
+        Size of the last gzip member, modulo 4 GiB
+        """
+        raw = pread(fd, 4, length - 4)
+        return unpack('<I', raw)[0] if len(raw) == 4 else None
+
+    @classmethod
+    def _xz_size(cls, fd, length):
+        """
+        Sum of the uncompressed sizes of the blocks of the last xz stream,
+        read in its index
+        """
+        # skips the stream padding
+        while length >= 4 and pread(fd, 4, length - 4) == b'\x00' * 4:
+            length -= 4
+
+        footer_size = CompressedImage._XZ_FOOTER_SIZE
+        footer = pread(fd, footer_size, length - footer_size)
+        if len(footer) != footer_size or footer[10:] != b'YZ':
+            return None
+
+        index_size = (unpack('<I', footer[4:8])[0] + 1) * 4
+        index = pread(fd, index_size, length - footer_size - index_size)
+        if len(index) != index_size or index[0] != 0:
+            return None
+
+        def varint(pos):
+            value = 0
+            for shift in range(0, 63, 7):
+                value |= (index[pos] & 0x7f) << shift
+                pos += 1
+                if not index[pos - 1] & 0x80:
+                    break
+            return value, pos
+
+        try:
+            records, pos = varint(1)
+            size = 0
+            for _ in range(records):
+                _, pos = varint(pos)
+                uncompressed, pos = varint(pos)
+                size += uncompressed
+        except IndexError:
+            return None
+
+        return size
+
+    @classmethod
+    def _zstd_size(cls, fd, length):
+        """
+        Content size of the first zstd frame, when it's given
+        """
+        try:
+            params = zstandard.get_frame_parameters(pread(fd, 18, 0))
+        except zstandard.ZstdError:
+            return None
+        if params.content_size == zstandard.CONTENTSIZE_UNKNOWN:
+            return None
+        return params.content_size
+
+    def _open(self):
+        """
+        Opens the decompressed stream, it's read from its own file
+        """
+        if self.compression == 'gzip':
+            return gzip_open(self.path, 'rb')
+        if self.compression == 'xz':
+            return lzma_open(self.path, 'rb')
+
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(self.path, 'rb'), read_across_frames=True)
+
+    def chunks(self, limit):
+        """
+        Iterates on the decompressed data, which must not exceed limit Bytes
+        """
+        done = 0
+        with self._open() as stream:
+            while True:
+                data = stream.read(BinaryCopier._BUFFER_SIZE)
+                if not data:
+                    break
+
+                if done == 0 and len(data) >= 4 and \
+                        unpack('<I', data[:4])[0] == SparseImage.MAGIC:
+                    raise BinaryError('Compressed sparse images aren\'t '
+                                      'supported: {0}'.format(self.path))
+
+                done += len(data)
+                if done > limit:
+                    raise BinaryError('Decompressed binary file {0} is '
+                                      'greather than its partition size ({1} '
+                                      'Bytes)'.format(self.path, limit))
+
+                yield data
+
+    def write(self, img_fd, offset, copier, limit):
+        """
+        Decompresses the binary at the offset of the image, returns the
+        decompressed size
+        """
+        done = 0
+        for data in self.chunks(limit):
+            copier.write(img_fd, offset + done, data)
+            done += len(data)
+
+        return done
+
+
+class ZipMember(CompressedImage):
+    """
+    Member of a zip archive, like a flashfiles archive, used as a partition
+    binary. Its path is the one of the archive followed by the name of the
+    member, as if the archive was a directory. A stored member is copied
+    directly from the archive, a deflated one is decompressed on the fly, and
+    a member which is a sparse image is expanded on the fly, so the archive
+    is never extracted.
+    """
+    __slots__ = ('archive', 'member', 'info', 'data_offset', 'sparse_img')
+
+    _LOCAL_HEADER_FMT = '<4s22xHH'
+
+    def __init__(self, path, archive, member):
+        super(ZipMember, self).__init__(path, None)
+        self.archive = archive
+        self.member = member
+        self.info = None
+        self.data_offset = None
+        self.sparse_img = None
+
+    @classmethod
+    def split(cls, path):
+        """
+        Gives the path of the archive and the name of the member of a path in
+        a zip archive, or None if it isn't one
+        """
+        archive = dirname(path)
+        if isfile(path) or not isfile(archive) or not is_zipfile(archive):
+            return None
+        return archive, basename(path)
+
+    @classmethod
+    def read_member(cls, path):
+        """
+        Reads the whole content of a member of a zip archive
+        """
+        archive, member = ZipMember.split(path)
+        with ZipFile(archive) as zip_file:
+            return zip_file.read(member)
+
+    def read(self, bin_file):
+        """
+        Reads the entry of the member in the archive, and the header of the
+        member if it's a sparse image
+        """
+        try:
+            with ZipFile(bin_file) as zip_file:
+                self.info = zip_file.getinfo(self.member)
+                if self.info.compress_type not in (ZIP_STORED,
+                                                   ZIP_DEFLATED):
+                    raise BinaryError('Unsupported compression of the member '
+                                      '{0} of the archive: {1}'
+                                      .format(self.member, self.archive))
+
+                with zip_file.open(self.info) as stream:
+                    raw = stream.read(calcsize(SparseImage._FMT))
+        except (BadZipFile, KeyError) as err:
+            raise BinaryError('Invalid member {0} of the archive {1}: {2}'
+                              .format(self.member, self.archive, err))
+
+        self.compression = ('stored' if self.info.compress_type == ZIP_STORED
+                            else 'deflated')
+        self.size = self.info.file_size
+
+        # the data of a stored member is after its local header
+        header_size = calcsize(ZipMember._LOCAL_HEADER_FMT)
+        magic, name_size, extra_size = unpack(
+            ZipMember._LOCAL_HEADER_FMT,
+            pread(bin_file.fileno(), header_size, self.info.header_offset))
+        if magic != b'PK\x03\x04':
+            raise BinaryError('Invalid member {0} of the archive: {1}'
+                              .format(self.member, self.archive))
+        self.data_offset = (self.info.header_offset + header_size +
+                            name_size + extra_size)
+
+        if len(raw) >= 4 and unpack('<I', raw[:4])[0] == SparseImage.MAGIC:
+            debug('Member {0} of the archive {1} is a sparse image'
+                  .format(self.member, self.archive))
+            self.sparse_img = SparseImage(self.path)
+            self.sparse_img.parse(raw)
+            self.size = self.sparse_img.size
+
+    def _open(self):
+        """
+        Opens the stream of the member, through its own file of the archive
+        """
+        with ZipFile(self.archive) as zip_file:
+            return zip_file.open(self.info)
+
+    def _read(self, stream, size):
+        """
+        Reads size Bytes of the stream of the member
+        """
+        data = stream.read(size)
+        if len(data) != size:
+            raise BinaryError('Truncated member {0} of the archive: {1}'
+                              .format(self.member, self.archive))
+        return data
+
+    def _chunks(self, stream):
+        """
+        Iterates on the chunks of the member like on the ones of a sparse
+        image, the data of the RAW chunks is read from the stream in pieces
+        """
+        if self.sparse_img is None:
+            while True:
+                data = stream.read(BinaryCopier._BUFFER_SIZE)
+                if not data:
+                    break
+                yield SparseImage.CHUNK_RAW, len(data), data
+            return
+
+        sparse_img = self.sparse_img
+        self._read(stream, sparse_img.file_hdr_size)
+        for _ in range(sparse_img.total_chunks):
+            chunk_type, chunk_size, data_size = sparse_img.parse_chunk(
+                self._read(stream, sparse_img.chunk_hdr_size))
+
+            if chunk_type == SparseImage.CHUNK_RAW:
+                done = 0
+                while done < chunk_size:
+                    data = self._read(stream, min(BinaryCopier._BUFFER_SIZE,
+                                                  chunk_size - done))
+                    yield chunk_type, len(data), data
+                    done += len(data)
+                continue
+
+            data = self._read(stream, data_size)
+            if chunk_type == SparseImage.CHUNK_FILL:
+                if len(data) != 4:
+                    raise BinaryError('Invalid FILL chunk in sparse image: {0}'
+                                      .format(self.path))
+                yield chunk_type, chunk_size, data
+            elif chunk_type == SparseImage.CHUNK_DONT_CARE:
+                yield chunk_type, chunk_size, None
+
+    def chunks(self, limit):
+        """
+        Iterates on the expanded data of the member, which must not exceed
+        limit Bytes
+        """
+        done = 0
+        with self._open() as stream:
+            for chunk_type, chunk_size, data in self._chunks(stream):
+                done += chunk_size
+                if done > limit:
+                    raise BinaryError('Binary file {0} is greather than its '
+                                      'partition size ({1} Bytes)'
+                                      .format(self.path, limit))
+
+                if chunk_type == SparseImage.CHUNK_RAW:
+                    yield data
+                    continue
+
+                pattern = data or b'\x00' * 4
+                fill = fill_pattern(pattern, chunk_size)
+                while chunk_size:
+                    yield fill[:chunk_size]
+                    chunk_size -= min(len(fill), chunk_size)
+
+    def write(self, img_fd, offset, copier, limit):
+        """
+        Copies or expands the member at the offset of the image, returns the
+        expanded size
+        """
+        if self.size > limit:
+            raise BinaryError('Binary file {0} is greather than its '
+                              'partition size ({1} Bytes)'
+                              .format(self.path, limit))
+
+        # a stored member is a range of the archive
+        if self.compression == 'stored' and self.sparse_img is None:
+            with open(self.archive, 'rb') as archive_file:
+                copier.copy(archive_file.fileno(), img_fd, offset, self.size,
+                            self.data_offset)
+            return self.size
+
+        position = offset
+        with self._open() as stream:
+            for chunk_type, chunk_size, data in self._chunks(stream):
+                if chunk_type == SparseImage.CHUNK_RAW:
+                    copier.write(img_fd, position, data)
+                elif chunk_type == SparseImage.CHUNK_FILL:
+                    self.sparse_img._fill(img_fd, position, chunk_size, data,
+                                          copier)
+                    hash_fill(copier.digests, data, chunk_size)
+                else:
+                    hash_fill(copier.digests, b'\x00' * 4, chunk_size)
+                position += chunk_size
+
+        return position - offset
+
+
+class StreamImage(CompressedImage):
+    """
+    Binary read from a file object without file descriptor, like a stream of
+    a socket or a buffer in memory. It's read once on the fly, so it can only
+    be written in one partition of one image. Its size is unknown, it's
+    bounded by the size of the partition.
+    """
+    __slots__ = ('stream',)
+
+    def __init__(self, path, stream):
+        super(StreamImage, self).__init__(path, None)
+        self.stream = stream
+
+    def chunks(self, limit):
+        """
+        Iterates on the data of the stream, which must not exceed limit Bytes
+        """
+        done = 0
+        while True:
+            data = self.stream.read(BinaryCopier._BUFFER_SIZE)
+            if not data:
+                break
+
+            done += len(data)
+            if done > limit:
+                raise BinaryError('Binary file {0} is greather than its '
+                                  'partition size ({1} Bytes)'
+                                  .format(self.path, limit))
+
+            yield data
+
+
+class BinaryFiles(object):
+    """
+    Binary files opened to write partitions. They are only read with
+    positional I/O, so they can be shared by the writers of several images
+    built from the same binaries.
+    """
+    __slots__ = ('files', 'lock')
+
+    def __init__(self):
+        self.files = {}
+        self.lock = Lock()
+
+    def open(self, bin_path):
+        """
+        Opens a binary file once, returns the binary file, its sparse image
+        header if it's a sparse image, its compressed image if it's
+        compressed, its member if it's in a zip archive or its stream, and its
+        size once expanded. The binary file is a path, a file object or a
+        callable giving one of them.
+        """
+        with self.lock:
+            if bin_path in self.files:
+                return self.files[bin_path]
+
+            # a callable gives the binary file once it's opened, a path or a
+            # file object
+            source = bin_path() if callable(bin_path) else bin_path
+            if isinstance(source, str):
+                name = source
+                member = ZipMember.split(source)
+            else:
+                name = str(getattr(source, 'name', source))
+                member = None
+
+            # a file object is read through its own file descriptor from its
+            # start, or once as a stream without file descriptor
+            if not isinstance(source, str):
+                try:
+                    bin_file = fdopen(dup(source.fileno()), 'rb')
+                except (AttributeError, OSError):
+                    debug('Binary file {0} is a stream'.format(name))
+                    self.files[bin_path] = (None, StreamImage(name, source),
+                                            0)
+                    return self.files[bin_path]
+
+            # the member of a zip archive is read from the archive
+            else:
+                try:
+                    bin_file = open(member[0] if member else source, 'rb')
+                except IOError as err:
+                    raise BinaryError('Can\'t open the binary file {0}: {1}'
+                                      .format(name, err))
+
+            # the sparse and compressed images are expanded directly in the
+            # partition, a compressed file object isn't detected
+            bin_img = None
+            compression = None
+            if isinstance(source, str) and not member:
+                compression = CompressedImage.detect(bin_file)
+            if member:
+                bin_img = ZipMember(name, *member)
+                bin_img.read(bin_file)
+                bin_size = bin_img.size
+                debug('Binary file {0} is a {1} member of {2}'
+                      .format(name, bin_img.compression, member[0]))
+            elif SparseImage.is_sparse(bin_file):
+                debug('Binary file {0} is a sparse image'.format(name))
+                bin_img = SparseImage(name)
+                bin_img.read(bin_file)
+                bin_size = bin_img.size
+            elif compression:
+                debug('Binary file {0} is compressed with {1}'
+                      .format(name, compression))
+                bin_img = CompressedImage(name, compression)
+                bin_img.read(bin_file)
+                bin_size = bin_img.size
+            else:
+                bin_size = fstat(bin_file.fileno()).st_size
+
+            self.files[bin_path] = (bin_file, bin_img, bin_size)
+            return self.files[bin_path]
+
+    def close(self):
+        """
+        Closes all the binary files
+        """
+        with self.lock:
+            for bin_file, _, _ in self.files.values():
+                if bin_file is not None:
+                    bin_file.close()
+            self.files.clear()
+
+
+class TeeWriter(object):
+    """
+    Writes the same data at the same offsets in several destinations, image
+    files or devices. Each destination is written by its own thread from a
+    bounded queue, so the data is read once and written in parallel. A
+    destination failing is isolated: its error is recorded and the other
+    destinations are still written.
+
+    In sparse mode, with the size of the image, the image files are sized
+    with ftruncate and the zero chunks are skipped in them. The devices
+    aren't zeroed, the zero chunks are written in them and the regions
+    discarded are discarded in the devices only.
+    """
+    __slots__ = ('paths', 'fds', 'queues', 'threads', 'written', 'errors',
+                 'regular', 'sparse')
+
+    _QUEUE_SIZE = 8
+
+    def __init__(self, paths, size=None):
+        self.paths = paths
+        self.fds = []
+        self.queues = []
+        self.threads = []
+        self.written = [0] * len(paths)
+        self.errors = [None] * len(paths)
+        self.regular = [True] * len(paths)
+        self.sparse = size is not None
+
+        for index, path in enumerate(paths):
+            fd = None
+            try:
+                fd = os_open(path, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+                self.regular[index] = S_ISREG(fstat(fd).st_mode)
+                # sizes the sparse image files
+                if self.sparse and self.regular[index]:
+                    ftruncate(fd, size)
+            except OSError as err:
+                self._fail(index, err)
+            self.fds.append(fd)
+
+            # the threads aren't daemon threads, close joins them and the
+            # interpreter can't exit in the middle of a write
+            self.queues.append(Queue(TeeWriter._QUEUE_SIZE))
+            thread = Thread(target=self._run, args=(index,))
+            thread.start()
+            self.threads.append(thread)
+
+    def _fail(self, index, err):
+        """
+        Records the error of a destination, it isn't written anymore
+        """
+        error('Writing {0} failed: {1}'.format(self.paths[index], err))
+        self.errors[index] = err
+
+    def _run(self, index):
+        """
+        Writes the data queued for a destination. Any error fails the
+        destination, but its queue is still drained, else the writes of the
+        other destinations would block on its full queue.
+        """
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                break
+            if self.errors[index] is not None:
+                continue
+
+            offset, data, length = item
+            try:
+                if data is None:
+                    BlockDevice.discard(self.fds[index], offset, length)
+                else:
+                    write_all(self.fds[index], data, offset)
+                    self.written[index] += length
+            except Exception as err:
+                self._fail(index, err)
+
+    def write(self, data, offset):
+        """
+        Queues data to write at an offset of all the destinations, a zero
+        chunk is skipped in the sparse image files
+        """
+        zero = self.sparse and any(self.regular) and is_zero(data)
+        for index, data_queue in enumerate(self.queues):
+            if self.errors[index] is None and \
+                    not (zero and self.regular[index]):
+                data_queue.put((offset, data, len(data)))
+
+    def discard(self, offset, length):
+        """
+        Queues the discard of length Bytes at an offset of the devices, the
+        image files are already holes there
+        """
+        for index, data_queue in enumerate(self.queues):
+            if self.errors[index] is None and not self.regular[index]:
+                data_queue.put((offset, None, length))
+
+    def progress(self):
+        """
+        Logs the Bytes written in each destination
+        """
+        for path, written, err in zip(self.paths, self.written, self.errors):
+            info('{0}: {1} Bytes written{2}'
+                 .format(path, written, ', failed' if err else ''))
+
+    def close(self):
+        """
+        Waits for all the data to be written and closes the destinations.
+        Returns the paths of the destinations which failed
+        """
+        for data_queue in self.queues:
+            data_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        for index, fd in enumerate(self.fds):
+            if fd is None:
+                continue
+            try:
+                close(fd)
+            except OSError as err:
+                if self.errors[index] is None:
+                    self._fail(index, err)
+
+        return [path for path, err in zip(self.paths, self.errors) if err]
+
+
+class StreamWriter(object):
+    """
+    Base of the writers of an expanded image given in order, with the write,
+    fill and skip methods. It writes the binaries of the partitions.
+    """
+    __slots__ = ()
+
+    def write_file(self, bin_file, buf):
+        """
+        Writes a binary file read through a buffer
+        """
+        view = memoryview(buf)
+        offset = 0
+        while True:
+            size = preadv(bin_file.fileno(), [view], offset)
+            if not size:
+                break
+            self.write(view[:size])
+            offset += size
+
+    def write_sparse_image(self, sparse_img, bin_file, buf):
+        """
+        Writes the chunks of a sparse image binary, its RAW chunks are read
+        through a buffer
+        """
+        view = memoryview(buf)
+        for chunk_type, chunk_size, data in sparse_img.chunks(bin_file):
+            if chunk_type == SparseImage.CHUNK_RAW:
+                done = 0
+                while done < chunk_size:
+                    size = preadv(bin_file.fileno(),
+                                  [view[:min(len(view), chunk_size - done)]],
+                                  data + done)
+                    if size == 0:
+                        raise BinaryError('Truncated sparse image: {0}'
+                                          .format(sparse_img.path))
+                    self.write(view[:size])
+                    done += size
+            elif chunk_type == SparseImage.CHUNK_FILL:
+                self.fill(data, chunk_size)
+            else:
+                self.skip(chunk_size)
+
+    def write_binary(self, bin_file, bin_img, buf, limit):
+        """
+        Writes a binary file, a sparse or a compressed image is expanded, a
+        compressed image must not exceed limit Bytes. Returns the number of
+        Bytes written
+        """
+        start = self.tell()
+        if isinstance(bin_img, CompressedImage):
+            for data in bin_img.chunks(limit):
+                self.write(data)
+        elif bin_img:
+            self.write_sparse_image(bin_img, bin_file, buf)
+        else:
+            self.write_file(bin_file, buf)
+
+        return self.tell() - start
+
+
+class SparseImageWriter(StreamWriter):
+    """
+    Writer of an Android sparse image, the regions of the expanded image are
+    given in order. Data is written in RAW chunks, except its zero blocks
+    written in FILL chunks, and the gaps between regions are DONT_CARE
+    chunks. The output file must be seekable, the headers of the RAW chunks
+    and of the sparse image are completed once their data is written.
+    """
+    __slots__ = ('out_file', 'block_size', 'size', 'position', 'pending',
+                 'chunk_type', 'chunk_blocks', 'chunk_pattern', 'chunk_start',
+                 'total_chunks')
+
+    BLOCK_SIZE = 4096
+
+    _MAX_CHUNK_BLOCKS = 256 * 1024
+
+    def __init__(self, out_file, block_size, size):
+        self.out_file = out_file
+        self.block_size = block_size
+        self.size = size
+
+        # position of the complete blocks written, and the start of the next
+        # block not complete yet
+        self.position = 0
+        self.pending = b''
+
+        # the chunk being written
+        self.chunk_type = None
+        self.chunk_blocks = 0
+        self.chunk_pattern = None
+        self.chunk_start = 0
+
+        self.total_chunks = 0
+
+        # the header is written again by the close method
+        self._write_header()
+
+    def _write_header(self):
+        """
+        Writes the header of the sparse image at the start of the file
+        """
+        self.out_file.seek(0)
+        self.out_file.write(pack(SparseImage._FMT, SparseImage.MAGIC, 1, 0,
+                                 calcsize(SparseImage._FMT),
+                                 calcsize(SparseImage._CHUNK_FMT),
+                                 self.block_size,
+                                 self.size // self.block_size,
+                                 self.total_chunks, 0))
+
+    def _end_chunk(self):
+        """
+        Writes the header of the current chunk, and the pattern of a FILL
+        chunk
+        """
+        if self.chunk_type is None:
+            return
+
+        chunk_hdr_size = calcsize(SparseImage._CHUNK_FMT)
+        data_size = 0
+        if self.chunk_type == SparseImage.CHUNK_RAW:
+            data_size = self.chunk_blocks * self.block_size
+        elif self.chunk_type == SparseImage.CHUNK_FILL:
+            data_size = len(self.chunk_pattern)
+
+        raw = pack(SparseImage._CHUNK_FMT, self.chunk_type, 0,
+                   self.chunk_blocks, chunk_hdr_size + data_size)
+
+        # the header of a RAW chunk is before its data
+        if self.chunk_type == SparseImage.CHUNK_RAW:
+            end = self.out_file.tell()
+            self.out_file.seek(self.chunk_start)
+            self.out_file.write(raw)
+            self.out_file.seek(end)
+        else:
+            self.out_file.write(raw)
+            if self.chunk_pattern:
+                self.out_file.write(self.chunk_pattern)
+
+        self.total_chunks += 1
+        self.chunk_type = None
+
+    def _chunk(self, chunk_type, blocks, pattern=None):
+        """
+        Adds blocks to the current chunk, or starts a new chunk
+        """
+        if self.chunk_type != chunk_type or \
+                self.chunk_pattern != pattern or \
+                self.chunk_blocks + blocks > \
+                SparseImageWriter._MAX_CHUNK_BLOCKS:
+            self._end_chunk()
+            self.chunk_type = chunk_type
+            self.chunk_pattern = pattern
+            self.chunk_blocks = 0
+            self.chunk_start = self.out_file.tell()
+
+            # reserves the header of a RAW chunk
+            if chunk_type == SparseImage.CHUNK_RAW:
+                self.out_file.write(b'\x00' *
+                                    calcsize(SparseImage._CHUNK_FMT))
+
+        self.chunk_blocks += blocks
+        self.position += blocks * self.block_size
+
+    def _write_blocks(self, data):
+        """
+        Writes complete blocks of data, zero blocks in FILL chunks and the
+        other ones in RAW chunks
+        """
+        view = memoryview(data)
+        size = len(view)
+
+        # the zero regions are written at once
+        if is_zero(data):
+            self._chunk(SparseImage.CHUNK_FILL, size // self.block_size,
+                        b'\x00' * 4)
+            return
+
+        start = 0
+        while start < size:
+            end = start
+            while end < size and \
+                    not is_zero(view[end:end + self.block_size]):
+                end += self.block_size
+
+            # writes the data blocks, splitted on the chunk size limit
+            while start < end:
+                room = SparseImageWriter._MAX_CHUNK_BLOCKS
+                if self.chunk_type == SparseImage.CHUNK_RAW:
+                    room -= self.chunk_blocks
+                blocks = min(room or SparseImageWriter._MAX_CHUNK_BLOCKS,
+                             (end - start) // self.block_size)
+                self._chunk(SparseImage.CHUNK_RAW, blocks)
+                self.out_file.write(view[start:start +
+                                         blocks * self.block_size])
+                start += blocks * self.block_size
+
+            while end < size and \
+                    is_zero(view[end:end + self.block_size]):
+                end += self.block_size
+            if end > start:
+                self._chunk(SparseImage.CHUNK_FILL,
+                            (end - start) // self.block_size, b'\x00' * 4)
+            start = end
+
+    def tell(self):
+        """
+        Gives the position in the expanded image
+        """
+        return self.position + len(self.pending)
+
+    def write(self, data):
+        """
+        Writes data at the current position of the expanded image
+        """
+        if self.pending:
+            data = self.pending + bytes(data)
+            self.pending = b''
+
+        size = len(data) - len(data) % self.block_size
+        if size:
+            self._write_blocks(memoryview(data)[:size])
+        self.pending = bytes(memoryview(data)[size:])
+
+    def _write_pattern(self, chunk_type, length, pattern):
+        """
+        Writes length Bytes of a 4 Bytes pattern, in a FILL or a DONT_CARE
+        chunk for the complete blocks
+        """
+        # completes the pending block with the pattern
+        if self.pending:
+            head = min(length, self.block_size - len(self.pending))
+            self.write((pattern * (head // 4 + 1))[:head])
+            length -= head
+            pattern = pattern[head % 4:] + pattern[:head % 4]
+
+        blocks = length // self.block_size
+        if blocks:
+            self._chunk(chunk_type, blocks,
+                        pattern if chunk_type == SparseImage.CHUNK_FILL
+                        else None)
+
+        tail = length % self.block_size
+        if tail:
+            self.write((pattern * (tail // 4 + 1))[:tail])
+
+    def fill(self, pattern, length):
+        """
+        Writes length Bytes of a 4 Bytes pattern
+        """
+        self._write_pattern(SparseImage.CHUNK_FILL, length, pattern)
+
+    def skip(self, length):
+        """
+        Skips length Bytes of the expanded image, left unwritten
+        """
+        self._write_pattern(SparseImage.CHUNK_DONT_CARE, length,
+                            b'\x00' * 4)
+
+    def seek(self, offset):
+        """
+        Moves forward to the offset of the expanded image
+        """
+        if offset < self.tell():
+            raise ImageError('Android sparse image can only be written '
+                             'forward')
+        self.skip(offset - self.tell())
+
+    def close(self):
+        """
+        Completes the image up to its size and writes its header
+        """
+        if self.pending:
+            self.write(b'\x00' * (self.block_size - len(self.pending)))
+        self.seek(self.size)
+        self._end_chunk()
+        self._write_header()
+
+
+class BlockDevice(object):
+    """
+    Block device used as the target of a GPT/UEFI image, its size and its
+    logical block size are read with ioctls.
+    """
+    __slots__ = ('path', 'size', 'logical_block_size')
+
+    _BLKSSZGET = 0x1268
+
+    _BLKGETSIZE64 = 0x80081272
+
+    _BLKDISCARD = 0x1277
+
+    def __init__(self, path):
+        self.path = path
+
+        fd = os_open(path, O_RDONLY)
+        try:
+            self.size = unpack('Q', ioctl(fd, BlockDevice._BLKGETSIZE64,
+                                          b'\x00' * 8))[0]
+            self.logical_block_size = unpack('i', ioctl(
+                fd, BlockDevice._BLKSSZGET, b'\x00' * 4))[0]
+        finally:
+            close(fd)
+
+    @classmethod
+    def is_block_device(cls, path):
+        """
+        Checks if the path is a block device
+        """
+        try:
+            return S_ISBLK(stat(path).st_mode)
+        except OSError:
+            return False
+
+    @classmethod
+    def discard(cls, fd, offset, length):
+        """
+        Discards length Bytes at the offset of the block device, returns
+        False if the device doesn't support it
+        """
+        try:
+            ioctl(fd, cls._BLKDISCARD, pack('QQ', offset, length))
+        except OSError as err:
+            if err.errno not in BinaryCopier._UNSUPPORTED:
+                raise
+            debug('Discard of {0} Bytes at {1} failed: {2}'
+                  .format(length, offset, err))
+            return False
+        return True
+
+
+class DirectWriter(StreamWriter):
+    """
+    Writer of a block device with O_DIRECT, bypassing the page cache. The
+    data given in order is gathered in a large buffer, page aligned as an
+    anonymous memory map, and written by complete logical blocks. A partial
+    last block is padded with zeros. The written data is synced by batches.
+    """
+    __slots__ = ('fd', 'block_size', 'buffer', 'view', 'position', 'pending',
+                 'unsynced', 'digests')
+
+    _BUFFER_SIZE = 4 * 1024 * 1024
+
+    _SYNC_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path, block_size, digests=None):
+        self.fd = os_open(path, O_WRONLY | O_DIRECT)
+        self.block_size = block_size
+        self.digests = digests
+
+        self.buffer = mmap(-1, DirectWriter._BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+
+        # position of the buffer in the device, and the Bytes in the buffer
+        self.position = 0
+        self.pending = 0
+        self.unsynced = 0
+
+    def tell(self):
+        """
+        Gives the position in the device
+        """
+        return self.position + self.pending
+
+    def seek(self, offset):
+        """
+        Moves to an offset of the device aligned on the logical blocks
+        """
+        self._flush()
+        if offset % self.block_size:
+            raise ImageError('Offset {0} isn\'t aligned on the logical '
+                             'blocks of {1} Bytes'
+                             .format(offset, self.block_size))
+        self.position = offset
+
+    def write(self, data):
+        """
+        Writes data at the current position of the device
+        """
+        if self.digests:
+            for digest in self.digests:
+                digest.update(data)
+
+        view = memoryview(data).cast('B')
+        while view:
+            size = min(len(view), len(self.view) - self.pending)
+            self.view[self.pending:self.pending + size] = view[:size]
+            self.pending += size
+            view = view[size:]
+            if self.pending == len(self.view):
+                self._flush()
+
+    def fill(self, pattern, length):
+        """
+        Writes length Bytes of a 4 Bytes pattern
+        """
+        fill = fill_pattern(pattern, length)
+        done = 0
+        while done < length:
+            size = min(len(fill), length - done)
+            self.write(fill[:size])
+            done += size
+
+    def skip(self, length):
+        """
+        Writes length zero Bytes, unlike a new image file the device isn't
+        zeroed
+        """
+        self.fill(b'\x00' * 4, length)
+
+    def _flush(self):
+        """
+        Writes the buffer, padded with zeros up to a complete block
+        """
+        size = self.pending
+        if size % self.block_size:
+            padding = self.block_size - size % self.block_size
+            self.view[size:size + padding] = ZERO_CHUNK[:padding]
+            size += padding
+
+        if size:
+            write_all(self.fd, self.view[:size], self.position)
+            self.position += size
+            self.pending = 0
+
+            self.unsynced += size
+            if self.unsynced >= DirectWriter._SYNC_SIZE:
+                fdatasync(self.fd)
+                self.unsynced = 0
+
+    def close(self):
+        """
+        Writes and syncs the remaining data, then closes the device
+        """
+        try:
+            self._flush()
+            fdatasync(self.fd)
+        finally:
+            close(self.fd)
+            self.view.release()
+            self.buffer.close()
+
+
+TLB_INFO = namedtuple('TLB_INFO', ('begin', 'size', 'type', 'uuid', 'label',
+                                   'align', 'weight'))
+# the partitions aren't aligned and share the remaining space equally
+TLB_INFO.__new__.__defaults__ = (1, 1)
+
+
+class TLBInfos(list):
+    """
+    TLB information extracted from the TLB partition file
+    """
+    __slots__ = ('path', 'format', 'slotab', 'cfg', 'parts', 'namespace',
+                 'data', 'source', 'derivation')
+
+    def __init__(self, path, tlb_format=None, namespace=None):
+        super(TLBInfos, self).__init__()
+        self.path = path
+        # the GUIDs of the partitions are derived from their label in the
+        # namespace, they are random without namespace
+        self.namespace = namespace
+
+        # the TLB partition file is read once, and the TLB information
+        # derived from it only once it's needed
+        self.data = None
+        self.source = None
+        self.derivation = None
+
+        if tlb_format is None:
+            self._set_format()
+        else:
+            self.format = tlb_format
+        self.slotab = 0
+        self.cfg = None
+        self.parts = None
+
+    def __repr__(self):
+        result = ''
+
+        for item in self:
+            line = ('add -b {0} -s {1} -t {2} -u {3} -l {4}'
+                    '\n').format(item.begin, item.size, item.type, item.uuid,
+                                 item.label)
+            result = '{0}{1}'.format(result, line)
+
+        return result
+
+    def _set_format(self):
+        """
+        Identify the format of the TLB partition file
+        """
+        self.format = 'ini'
+
+        for line in self.read_data().split('\n'):
+            # determines the type of partition table file
+            # If file contains "partition_table=gpt" pattern then
+            # it's a JSON TLB partition file,
+            # else it's probably an INI TLB partition file.
+            # Parser will then check if the file is correct.
+            tlb_file_type_found = line.find("partition_table=gpt")
+
+            if tlb_file_type_found != -1:
+                self.format = 'tbl'
+                break
+
+        debug('Partition table format: {0}'.format(self.format))
+
+    def read_data(self):
+        """
+        Reads the content of the TLB partition file once
+        """
+        try:
+            if self.data is None and ZipMember.split(self.path):
+                self.data = ZipMember.read_member(self.path).decode('utf-8')
+            elif self.data is None:
+                with open(self.path, 'r') as tlb_file:
+                    self.data = tlb_file.read()
+        except (IOError, ValueError, KeyError, BadZipFile) as err:
+            raise LayoutError('Can\'t read the TLB partition file {0}: {1}'
+                              .format(self.path, err))
+        return self.data
+
+    def _read_json(self, block_size):
+        """
+        Used to read a JSON TLB partition file
+        """
+        re_parser = re_compile(r'^add\s-b\s(?P<begin>\w+)\s-s\s'
+                               '(?P<size>[\w$()-]+)\s-t\s'
+                               '(?P<type>\w+)\s-u\s'
+                               '(?P<uuid>[\w-]+)\s'
+                               '-l\s(?P<label>\w+)'
+                               )
+        # reads the JSON TLB file to instantiate a the TLBInfos
+        for line in self.read_data().split('\n'):
+            debug('TLB reading line: {0}'.format(line))
+            parsed_line = re_parser.match(line)
+
+            if parsed_line:
+                debug('TLB parsed line: {0}'.format(line))
+                debug('\t begin: {0}'
+                      .format(parsed_line.group('begin')))
+                debug('\t size: {0}'.format(parsed_line.group('size')))
+                debug('\t type: {0}'.format(parsed_line.group('type')))
+                debug('\t uuid: {0}'.format(parsed_line.group('uuid')))
+                debug('\t label: {0}'
+                      .format(parsed_line.group('label')))
+
+                self.append(TLB_INFO(*parsed_line.groups()))
+
+            else:
+                debug('TLB not parsed line: {0}'.format(line))
+
+    def _preparse_partitions(self, cfg):
+        """
+        Taken from gpt_ini2bin.py
+        """
+        data = self.read_data()
+
+        try:
+            self.slotab = cfg.getint('base', 'nb_slot')
+        except NoOptionError:
+            self.slotab = 0
+
+        start_part = cfg.get('base', 'partitions').split()
+
+        try:
+            slot_group_bsp = cfg.get('base.slot_group_bsp', 'partitions').split()
+        except NoSectionError:
+            slot_group_bsp = []
+
+        try:
+            slot_group_aosp = cfg.get('base.slot_group_aosp', 'partitions').split()
+        except NoSectionError:
+            slot_group_aosp = []
+
+        try:
+            end_part = cfg.get('base.end', 'partitions').split()
+        except NoSectionError:
+            end_part = []
+
+        for l in data.split('\n'):
+            words = l.split()
+            if len(words) > 2:
+                if words[0] == 'partitions' and words[1] == '+=':
+                    start_part += words[2:]
+
+        return start_part, slot_group_bsp, slot_group_aosp, end_part
+
+    def _contruct_tlb_info(self, start_lba, cfg, block_size, parts):
+        for part in parts:
+            partname = 'partition.{0}'.format(part)
+            ptype = cfg.get(partname, 'type')
+            label = cfg.get(partname, 'label')
+
+            nb_slots = 1
+            if self.slotab == 2:
+                try:
+                    if cfg.get(partname, 'has_slot') == 'true':
+                        nb_slots = 2
+                except NoOptionError:
+                    nb_slots = 1
+
+            align, weight = self._read_allocation(cfg, partname, block_size)
+            for slot_id in range(nb_slots):
+                try:
+                    begin = cfg.get(partname, 'start_lba')
+                    begin = int(begin.split(',')[slot_id])
+                except NoOptionError:
+                    begin = start_lba
+
+                try:
+                    readlen = cfg.get(partname, 'len')
+                    readlen = int(readlen.split(',')[slot_id])
+                except IndexError:
+                    readlen = cfg.getint(partname, 'len')
+
+                if readlen > 0:
+                    size = (readlen * 1024 * 1024) // block_size
+                    start_lba = begin + size
+                else:
+                    size = readlen
+
+                if nb_slots == 1:
+                    uuid = make_guid(self.namespace, label)
+                    self.append(TLB_INFO(begin, size, ptype, uuid, label,
+                                         align, weight))
+                    break
+                slot_label = label + '_%c' % (ord('a') + slot_id)
+                uuid = make_guid(self.namespace, slot_label)
+                self.append(TLB_INFO(begin, size, ptype, uuid, slot_label,
+                                     align, weight))
+        return start_lba
+
+    def _contruct_tlb_grp_info(self, start_lba, cfg, block_size, parts):
+        for grp_id in range(self.slotab):
+            for part in parts:
+                partname = 'partition.{0}'.format(part)
+                ptype = cfg.get(partname, 'type')
+                label = cfg.get(partname, 'label')
+                slot_label = label + '_%c' % (ord('a') + grp_id)
+                uuid = make_guid(self.namespace, slot_label)
+                align, weight = self._read_allocation(cfg, partname,
+                                                      block_size)
+
+                try:
+                    readlen = cfg.get(partname, 'len')
+                    readlen = int(readlen.split(',')[grp_id])
+                except IndexError:
+                    readlen = cfg.getint(partname, 'len')
+
+                try:
+                    begin = cfg.get(partname, 'start_lba')
+                    begin = int(begin.split(',')[grp_id])
+                except NoOptionError:
+                    begin = start_lba
+
+                if readlen > 0:
+                    size = (readlen * 1024 * 1024) // block_size
+                    start_lba = begin + size
+                else:
+                    size = readlen
+
+                self.append(TLB_INFO(begin, size, ptype, uuid, slot_label,
+                                     align, weight))
+        return start_lba
+
+    def _read_allocation(self, cfg, partname, block_size):
+        """
+        Reads the alignment of a partition, in KiB, converted in blocks, and
+        its weight to share the remaining space with the other partitions of
+        size -1. The alignment of the base section is the default one.
+        """
+        try:
+            for section in (partname, 'base'):
+                if cfg.has_option(section, 'align'):
+                    align = cfg.getint(section, 'align')
+                    break
+            else:
+                align = 0
+
+            weight = 1
+            if cfg.has_option(partname, 'weight'):
+                weight = cfg.getint(partname, 'weight')
+
+        except ValueError as err:
+            raise LayoutError('Invalid allocation of the {0}: {1}'
+                              .format(partname, err))
+
+        if align < 0 or (align * 1024) % block_size:
+            raise LayoutError('The alignment of the {0} is not a multiple of '
+                              'the block size: {1} KiB'
+                              .format(partname, align))
+
+        if weight <= 0:
+            raise LayoutError('The weight of the {0} is not positive: {1}'
+                              .format(partname, weight))
+
+        return max(1, align * 1024 // block_size), weight
+
+    def _parse_ini(self):
+        """
+        Used to parse a INI TLB partition file, once for all the TLB
+        information derived from it
+        """
+        # the TLB information derived from another one
+        if self.source is not None:
+            self._derive_ini()
+            return
+
+        # sets a parser to read the INI TLB partition file
+        cfg = ConfigParser(strict=False)
+        try:
+            cfg.read_string(self.read_data(), self.path)
+
+        except ParsingError:
+            raise LayoutError('Invalid TLB partition file: {0}'
+                              .format(self.path))
+
+        # gpt.ini is not a "standard" ini file because keys are not uniques
+        self.parts = self._preparse_partitions(cfg)
+        self.cfg = cfg
+
+    def _read_ini(self, block_size):
+        """
+        Used to read a INI TLB partition file
+        """
+        if self.cfg is None:
+            self._parse_ini()
+        cfg = self.cfg
+
+        start_part, slot_group_bsp, slot_group_aosp, end_part = self.parts
+
+        # sets the start lba value which the read value or uses the default
+        # value
+        try:
+            start_lba_prev = cfg.getint('base', 'start_lba')
+            debug('The start_lba value read in the TLB partition file')
+
+        except NoOptionError:
+            # set start lba to offset 1M bytes, align with kernelflinger
+            start_lba_prev = 1024 * 1024 // block_size
+            info('The start_lba value is undefined in the TLB partition file,'
+                 ' the default value is used: {0}'.format(start_lba_prev))
+
+        # contructs the TLB info
+        start_lba = self._contruct_tlb_info(start_lba_prev, cfg, block_size,
+                                            start_part)
+        start_lba = self._contruct_tlb_grp_info(start_lba, cfg, block_size,
+                                                slot_group_bsp)
+        start_lba = self._contruct_tlb_grp_info(start_lba, cfg, block_size,
+                                                slot_group_aosp)
+        self._contruct_tlb_info(start_lba, cfg, block_size, end_part)
+
+    def derive(self, include=None, exclude=None, overrides=None):
+        """
+        Gives new TLB information sharing the parsed TLB partition file, with
+        only the partitions included, without the partitions excluded, and
+        with the options of the partitions overridden. It has to be read,
+        the TLB partition file is only parsed then. Only the partitions of an
+        INI TLB partition file can be filtered.
+        """
+        if self.format != 'ini' and (include or exclude or overrides):
+            raise LayoutError('Only an INI TLB partition file can be '
+                              'filtered: {0}'.format(self.path))
+
+        derived = TLBInfos(self.path, self.format, self.namespace)
+        derived.data = self.read_data()
+        derived.source = self
+        derived.derivation = {'include': include, 'exclude': exclude,
+                              'overrides': overrides}
+
+        return derived
+
+    def _derive_ini(self):
+        """
+        Derives the parsed TLB partition file of the source TLB information
+        """
+        source = self.source
+        if source.cfg is None:
+            source._parse_ini()
+
+        include = self.derivation['include']
+        exclude = self.derivation['exclude']
+        overrides = self.derivation['overrides']
+
+        # checks the names of the partitions
+        names = set(name for part in source.parts for name in part)
+        for name in (include or []) + (exclude or []) + list(overrides or {}):
+            if name not in names:
+                raise LayoutError('Unknown partition {0} in the TLB '
+                                  'partition file: {1}'
+                                  .format(name, self.path))
+
+        self.slotab = source.slotab
+        self.parts = tuple([name for name in part
+                            if (include is None or name in include) and
+                            name not in (exclude or [])]
+                           for part in source.parts)
+
+        # copies the parsed file to override the options of the partitions
+        cfg = ConfigParser(strict=False)
+        cfg.read_dict(dict((section,
+                            dict(source.cfg.items(section, raw=True)))
+                           for section in source.cfg.sections()))
+        for name, options in (overrides or {}).items():
+            for option, value in options.items():
+                cfg.set('partition.{0}'.format(name), option, str(value))
+        self.cfg = cfg
+
+    def read(self, block_size):
+        """
+        Read a TLB file
+        """
+        # reads the JSON TLB partition file
+        if self.format == 'tbl':
+            self._read_json(block_size)
+
+        # reads the INI TLB partition file, a section or an option missing
+        # or invalid makes it invalid
+        else:
+            try:
+                self._read_ini(block_size)
+            except (NoSectionError, NoOptionError, ValueError) as err:
+                raise LayoutError('Invalid TLB partition file {0}: {1}'
+                                  .format(self.path, err))
+
+    def _allocate(self, begin, sizes):
+        """
+        Places the partitions one after the other from begin, with their
+        sizes and their begin aligned. Gives the end of the last partition
+        and the number of blocks lost to align them.
+        """
+        padding = 0
+        for pos, entry in enumerate(self):
+            aligned = -(-begin // entry.align) * entry.align
+            padding += aligned - begin
+            self[pos] = entry._replace(begin=aligned, size=sizes[pos])
+            begin = aligned + sizes[pos]
+        return begin, padding
+
+    def compute_last_size_entry(self, img_size, block_size, entry_size,
+                                table_length):
+        """
+        Compute the size of the TLB entries of size -1, they share the
+        remaining space in proportion to their weight, and the begin of the
+        entries when they're aligned
+        """
+        # reserve the size for primary and secondary gpt
+        MB = 1024 * 1024
+        first = self[0].begin if self else 0
+        end = first + (img_size - MB) // block_size - 2048
+
+        growable = []
+        for pos, entry in enumerate(self):
+            debug('Entry size: {0}'.format(entry.size))
+            if entry.size < 0:
+                growable.append(pos)
+        aligned = any(entry.align > 1 for entry in self)
+
+        # if all entries size are already defined
+        if not growable and not aligned:
+            debug('All entry sizes are already defined.')
+            return
+
+        # places the entries without the ones of size -1 to know the
+        # remaining space
+        sizes = [max(entry.size, 0) for entry in self]
+        last, padding = self._allocate(first, sizes)
+        remaining_size = end - last
+        if remaining_size < 0:
+            missing = -remaining_size * block_size
+            raise LayoutError('The image size is too small regarding '
+                              'partition mapping. Missing at least: {0} '
+                              'Bytes.'.format(missing))
+
+        # Update the size of the partitions with -1 size and recompute
+        # the start of each partitions after them
+        weights = sum(self[pos].weight for pos in growable)
+        for pos in growable:
+            sizes[pos] = remaining_size * self[pos].weight // weights
+        last, padding = self._allocate(first, sizes)
+
+        # the entries after a partition of size -1 may be aligned on another
+        # boundary, the last one is shrunk by a multiple of their alignment
+        # until they fit
+        while growable and last > end:
+            pos = growable[-1]
+            align = max([entry.align for entry in self[pos + 1:]] or [1])
+            sizes[pos] -= -(-(last - end) // align) * align
+            if sizes[pos] <= 0:
+                raise LayoutError('The image size is too small to align the '
+                                  'partitions.')
+            last, padding = self._allocate(first, sizes)
+
+        if last > end:
+            raise LayoutError('The image size is too small regarding '
+                              'partition mapping. Missing at least: {0} '
+                              'Bytes.'.format((last - end) * block_size))
+
+        # the partitions of size -1 get the space lost to align the next
+        # partition, and the last one the space left at the end
+        for pos in growable:
+            if pos + 1 < len(self):
+                sizes[pos] = self[pos + 1].begin - self[pos].begin
+            else:
+                sizes[pos] = end - self[pos].begin
+        last, padding = self._allocate(first, sizes)
+
+        report = info if aligned or len(growable) > 1 else debug
+        report('Partitions layout: {0} Bytes lost to the alignment, {1} Bytes'
+               ' unallocated'.format(padding * block_size,
+                                     (end - last) * block_size))
+
+
+class LayoutCache(object):
+    """
+    On-disk cache of the compiled partitions layouts, shared by the builds.
+
+    A layout is the resolved list of the partitions of a TLB partition file,
+    with their begin, size, type and label, once the size of the last entry
+    is computed. It's stored in the cache directory under the hash of the
+    content and the format of the TLB partition file, its derivation, the
+    image size, the block size and the partition table geometry. The GUIDs
+    aren't cached, they're generated again when a layout is loaded.
+    """
+    __slots__ = ('path', 'layouts', 'lock')
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.layouts = {}
+        self.lock = Lock()
+
+    @classmethod
+    def key(cls, tlb_infos, gpt_img):
+        """
+        Gives the key of the layout of TLB information in an image
+        """
+        header = gpt_img.gpt_header
+        key = [LayoutCache.VERSION,
+               sha256(tlb_infos.read_data().encode('utf-8')).hexdigest(),
+               tlb_infos.format, tlb_infos.derivation, gpt_img.size,
+               gpt_img.block_size, header.entry_size, header.table_length]
+        return sha256(dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """
+        Gives the cached layout of a key, or None
+        """
+        with self.lock:
+            if key in self.layouts:
+                return self.layouts[key]
+
+        layout_path = join(self.path, '{0}.json'.format(key))
+        if not isfile(layout_path):
+            return None
+
+        try:
+            with open(layout_path, 'r') as layout_file:
+                layout = load(layout_file)
+        except ValueError:
+            info('Ignoring the invalid cached layout: {0}'
+                 .format(layout_path))
+            return None
+
+        with self.lock:
+            self.layouts[key] = layout
+        return layout
+
+    def store(self, key, tlb_infos):
+        """
+        Stores the layout of TLB information read, it's written atomically
+        to be shared by concurrent builds
+        """
+        layout = [[int(part.begin), int(part.size), part.type, part.label]
+                  for part in tlb_infos]
+        with self.lock:
+            self.layouts[key] = layout
+
+        makedirs(self.path, exist_ok=True)
+        layout_path = join(self.path, '{0}.json'.format(key))
+        tmp_path = '{0}.{1}.tmp'.format(layout_path, getpid())
+        with open(tmp_path, 'w') as layout_file:
+            dump(layout, layout_file)
+        replace(tmp_path, layout_path)
+
+
+class BuildManifest(object):
+    """
+    Sidecar manifest of a GPT/UEFI image used for incremental builds.
+
+    It records the hash of the image layout, the size and the modification
+    time of the image, and for each partition the binary used to write it:
+    its path, size, modification time, content hash and the number of Bytes
+    written in the partition.
+    """
+    __slots__ = ('path')
+
+    SUFFIX = '.build.json'
+
+    VERSION = 1
+
+    _HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def layout_hash(cls, tlb_infos, img_size, block_size):
+        """
+        Hash of the partitions layout of an image, without the unique GUIDs
+        of the partitions, but with their namespace if they're deterministic
+        """
+        namespace = tlb_infos.namespace
+        layout = [img_size, block_size, namespace and str(namespace)]
+        layout.extend([int(part.begin), int(part.size), part.type, part.label]
+                      for part in tlb_infos)
+        return sha256(dumps(layout).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def same_input(cls, old, new):
+        """
+        Checks if a partition is written with the same content
+        """
+        if old is None:
+            return False
+        if old['path'] == 'none' or new['path'] == 'none':
+            return old['path'] == new['path']
+        return old['sha256'] == new['sha256']
+
+    def read(self):
+        """
+        Reads the manifest, returns None when it's missing or invalid
+        """
+        if not isfile(self.path):
+            return None
+
+        try:
+            with open(self.path, 'r') as manifest_file:
+                manifest = load(manifest_file)
+        except ValueError:
+            info('Ignoring the invalid build manifest: {0}'.format(self.path))
+            return None
+
+        if manifest.get('version') != BuildManifest.VERSION:
+            return None
+
+        return manifest
+
+    def matches(self, manifest, layout, img_path):
+        """
+        Checks if the image is the one recorded by the manifest with the same
+        layout
+        """
+        if manifest is None or manifest['layout'] != layout or \
+                not isfile(img_path):
+            return False
+
+        img_stat = stat(img_path)
+        return manifest['image'] == {'size': img_stat.st_size,
+                                     'mtime_ns': img_stat.st_mtime_ns}
+
+    def record(self, bin_path, old=None):
+        """
+        Records a binary file, its content is hashed unless its path, size
+        and modification time are the ones of the old record
+        """
+        if bin_path == 'none':
+            return {'path': 'none'}
+
+        # the member of a zip archive is as recent as its archive
+        member = ZipMember.split(bin_path)
+        bin_stat = stat(member[0] if member else bin_path)
+        record = {'path': bin_path, 'size': bin_stat.st_size,
+                  'mtime_ns': bin_stat.st_mtime_ns}
+
+        if old is not None and all(old.get(key) == value
+                                   for key, value in record.items()):
+            record['sha256'] = old['sha256']
+            return record
+
+        debug('Hashing the binary file {0}'.format(bin_path))
+        digest = sha256()
+        if member:
+            with ZipFile(member[0]) as zip_file:
+                bin_file = zip_file.open(member[1])
+        else:
+            bin_file = open(bin_path, 'rb')
+        with bin_file:
+            while True:
+                data = bin_file.read(BuildManifest._HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+        record['sha256'] = digest.hexdigest()
+
+        return record
+
+    def write(self, layout, img_path, partitions):
+        """
+        Writes the manifest of an image just written
+        """
+        img_stat = stat(img_path)
+        manifest = {'version': BuildManifest.VERSION,
+                    'layout': layout,
+                    'image': {'size': img_stat.st_size,
+                              'mtime_ns': img_stat.st_mtime_ns},
+                    'partitions': partitions}
+
+        with open(self.path, 'w') as manifest_file:
+            dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+
+class HashManifest(object):
+    """
+    Manifest of the expected hashes of the partitions of a GPT/UEFI image.
+
+    It records for each partition its label, its first and last LBAs, the
+    number of Bytes used from its start and their digests:
+
+    {
+        "version": 1,
+        "block_size": 512,
+        "partitions": [
+            {
+                "label": "boot",
+                "first_lba": 2048,
+                "last_lba": 67583,
+                "length": 16777216,
+                "sha1": "...",
+                "sha256": "..."
+            }
+        ]
+    }
+    """
+    __slots__ = ('path')
+
+    SUFFIX = '.hashes.json'
+
+    VERSION = 1
+
+    ALGORITHMS = ('sha1', 'sha256')
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def digests(cls):
+        """
+        New digests of a partition, one per algorithm
+        """
+        return [hash_new(name) for name in cls.ALGORITHMS]
+
+    @classmethod
+    def record(cls, tlb_part, length, digests):
+        """
+        Records a partition with the digests of its length first Bytes
+        """
+        record = {'label': tlb_part.label,
+                  'first_lba': int(tlb_part.begin),
+                  'last_lba': int(tlb_part.begin) + int(tlb_part.size) - 1,
+                  'length': length}
+        for name, digest in zip(cls.ALGORITHMS, digests):
+            record[name] = digest.hexdigest()
+
+        return record
+
+    def write(self, block_size, partitions):
+        """
+        Writes the manifest of the partitions of an image just written
+        """
+        manifest = {'version': HashManifest.VERSION,
+                    'block_size': block_size,
+                    'partitions': partitions}
+
+        with open(self.path, 'w') as manifest_file:
+            dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    def read(self):
+        """
+        Reads the records of the partitions from the manifest
+        """
+        try:
+            with open(self.path, 'r') as manifest_file:
+                manifest = load(manifest_file)
+            partitions = manifest['partitions']
+            for record in partitions:
+                int(record['first_lba']), int(record['last_lba'])
+                int(record['length']), record['label']
+        except (IOError, ValueError, KeyError, TypeError) as err:
+            raise ImageError('Invalid hash manifest {0}: {1}'
+                             .format(self.path, err))
+
+        return partitions
+
+
+class BuildStats(object):
+    """
+    Statistics of the write of a GPT/UEFI image, used to triage the slow
+    builds from their logs. It records the wall time and the Bytes of each
+    phase of the write, of each partition with the system calls of its
+    copy, and the peak RSS of the process:
+
+    {
+        "version": 1,
+        "image": "/out/disk.img",
+        "seconds": 1.52,
+        "peak_rss": 41943040,
+        "phases": [
+            {
+                "name": "partitions",
+                "seconds": 1.4,
+                "bytes": 268435456,
+                "mb_per_s": 182.86
+            }
+        ],
+        "partitions": [
+            {
+                "label": "boot",
+                "seconds": 0.12,
+                "bytes": 16777216,
+                "mb_per_s": 133.33,
+                "syscalls": {"copy_file_range": 1}
+            }
+        ],
+        "syscalls": {"copy_file_range": 1}
+    }
+
+    The partitions are written by concurrent workers, the sum of their
+    times may exceed the time of the partitions phase.
+    """
+    __slots__ = ('start', 'phases', 'partitions', 'syscalls', 'lock')
+
+    SUFFIX = '.stats.json'
+
+    VERSION = 1
+
+    def __init__(self):
+        self.start = time()
+        self.phases = {}
+        self.partitions = {}
+        self.syscalls = {}
+        self.lock = Lock()
+
+    @classmethod
+    def rate(cls, length, seconds):
+        """
+        Gives the throughput of length Bytes moved in seconds, in MB/s
+        """
+        return round(length / (1024 * 1024) / max(seconds, 1e-6), 2)
+
+    @classmethod
+    def peak_rss(cls):
+        """
+        Gives the peak resident set size of the process in Bytes, Linux
+        gives it in KiB
+        """
+        return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+    def phase(self, name, start, length=0):
+        """
+        Records a phase of the write started at start which moved length
+        Bytes, a phase done several times is summed. Returns the end of the
+        phase, the start of the next one
+        """
+        end = time()
+        with self.lock:
+            seconds, total = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (seconds + end - start, total + length)
+        return end
+
+    def partition(self, label, start, length, syscalls=None):
+        """
+        Records the write of a partition started at start which moved
+        length Bytes with the system calls counted by its copy
+        """
+        seconds = time() - start
+        with self.lock:
+            self.partitions[label] = (seconds, length, dict(syscalls or {}))
+            for syscall, calls in (syscalls or {}).items():
+                self.syscalls[syscall] = self.syscalls.get(syscall, 0) + calls
+
+    def report(self, path):
+        """
+        Logs the statistics of the write of the image
+        """
+        info('Statistics of the write of the GPT/UEFI image: {0}'.format(path))
+        for name, (seconds, length) in self.phases.items():
+            if not length:
+                info('  {0}: {1:.3f} s'.format(name, seconds))
+                continue
+            info('  {0}: {1:.3f} s, {2} Bytes ({3:.2f} MB/s)'
+                 .format(name, seconds, length,
+                         BuildStats.rate(length, seconds)))
+        for label, (seconds, length, _) in sorted(
+                self.partitions.items(), key=lambda item: -item[1][0]):
+            info('  partition {0}: {1:.3f} s, {2} Bytes ({3:.2f} MB/s)'
+                 .format(label, seconds, length,
+                         BuildStats.rate(length, seconds)))
+        info('  system calls: {0}'.format(', '.join(
+            '{0} {1}'.format(syscall, calls)
+            for syscall, calls in sorted(self.syscalls.items())) or 'none'))
+        info('  total: {0:.3f} s, peak RSS: {1} Bytes'
+             .format(time() - self.start, BuildStats.peak_rss()))
+
+    def write(self, stats_path, path):
+        """
+        Writes the statistics of the write of the image in a JSON file
+        """
+        with self.lock:
+            phases = [{'name': name,
+                       'seconds': round(seconds, 6),
+                       'bytes': length,
+                       'mb_per_s': BuildStats.rate(length, seconds)}
+                      for name, (seconds, length) in self.phases.items()]
+            partitions = [{'label': label,
+                           'seconds': round(seconds, 6),
+                           'bytes': length,
+                           'mb_per_s': BuildStats.rate(length, seconds),
+                           'syscalls': syscalls}
+                          for label, (seconds, length, syscalls)
+                          in self.partitions.items()]
+            stats = {'version': BuildStats.VERSION,
+                     'image': path,
+                     'seconds': round(time() - self.start, 6),
+                     'peak_rss': BuildStats.peak_rss(),
+                     'phases': phases,
+                     'partitions': partitions,
+                     'syscalls': dict(self.syscalls)}
+
+        with open(stats_path, 'w') as stats_file:
+            dump(stats, stats_file, indent=2, sort_keys=True)
+
+
+class GPTImage(object):
+    """
+    GPT/UEFI image.
+    """
+    __slots__ = ('path', 'size', 'block_size', 'mbr',
+                 'gpt_header', 'table', 'guid_namespace', 'stats',
+                 'sidecar_dir')
+
+    _DIFF_CHUNK_SIZE = 64 * 1024 * 1024
+
+    _DIFF_MAX_EXTENTS = 16
+
+    ANDROID_PARTITIONS = [
+        'xen_dom0',
+        'xen_misc',
+        'xen_guest',
+        'xen_rootfs',
+        'sos_boot',
+        'uos_boot',
+        'android_guest',
+        'sos_rootfs',
+        'uos_rootfs',
+        'vbmeta',
+        'multiboot',
+        'esp',
+        'esp2',
+        'bootloader',
+        'bootloader2',
+        'bldr_utils',
+        'boot',
+        'recovery',
+        'misc',
+        'metadata',
+        'system',
+        'vendor',
+        'vendor_boot',
+        'init_boot',
+        'product',
+        'odm',
+        'acpi',
+        'acpio',
+        'cache',
+        'data',
+        'userdata',
+        'persistent',
+        'factory',
+        'config',
+        'tos',
+        'mfos',
+        'teedata',
+        'super',
+        'reserved'
+        ]
+
+    def __init__(self, path, size='5G', block_size=512, gpt_header_size=92,
+                 guid_namespace=None, sidecar_dir=None):
+
+        self.path = path
+        self.size = GPTImage.convert_size_to_bytes(size)
+        self.block_size = block_size
+
+        # the disk GUID is derived from the layout in the namespace, it's
+        # random without namespace
+        self.guid_namespace = guid_namespace
+
+        self.mbr = MBRInfos(self.block_size)
+        self.gpt_header = GPTHeaderInfos(self.size, block_size,
+                                         gpt_header_size)
+        self.table = PartTableInfos()
+
+        # the statistics of the write of the image
+        self.stats = BuildStats()
+
+        # the directory of the files written with the image, they're next
+        # to it by default
+        self.sidecar_dir = sidecar_dir
 
     def __repr__(self):
 
@@ -906,225 +3115,1874 @@ class GPTImage(object):
         """
         units = ('B', 'K', 'M', 'G')
 
-        unit = str_size[-1:].upper()
+        unit = str_size[-1:].upper()
+
+        # the image size is invalid
+        if unit not in units:
+            raise ImageError('The size of GPT/UEFI image use an invalid '
+                             'unit: {0}'.format(str_size))
+
+        try:
+            # convert string size to an integer
+            value = int(str_size[:-1])
+        except ValueError:
+            raise ImageError('The size of GPT/UEFI image is invalid: {0}'
+                             .format(str_size))
+
+        # the value is negative
+        if value < 0:
+            raise ImageError('The size of GPT/UEFI image is a negative '
+                             'value: {0}'.format(str_size))
+
+        # the value is a Bytes
+        if unit == units[0]:
+            return int(str_size[:-1])
+
+        index = units.index(unit)
+        return value * 1024**index
+
+    def read(self):
+        """
+        Read information from a GPT/UEFI image
+        """
+        # opens and reads the image file
+        with open(self.path, 'rb') as img_file:
+
+            # reads the MBR of the image file
+            debug('Reading MBR from {0}'.format(self.path))
+            self.mbr.read(img_file)
+
+            # reads the GPT header of the image file
+            debug('Reading GPT header from {0}'.format(self.path))
+            offset = self.block_size
+            self.gpt_header.read(img_file, offset)
+
+            # reads the partition table of the image file
+            debug('Reading partition table from {0}'.format(self.path))
+            offset = self.block_size * self.gpt_header.lba_start
+            self.table.read(img_file, offset, self.gpt_header.table_length,
+                            self.gpt_header.entry_size)
+
+    def verify(self, hashes=None, jobs=1):
+        """
+        Verifies the integrity of a GPT/UEFI image mapped in memory: the
+        CRC32 of the GPT header, of the GPT backup and of their partition
+        tables, the consistency of the backup with the header, and the
+        partition entries which must neither overlap nor be out of the
+        usable LBAs. The partitions recorded in the hashes, if given, are
+        hashed in parallel and compared with them. Returns the list of the
+        problems found
+        """
+        problems = []
+
+        with open(self.path, 'rb') as img_file:
+            # the size of a block device is only given by its end
+            length = lseek(img_file.fileno(), 0, SEEK_END)
+            if length < 3 * self.block_size:
+                return ['The image is too small: {0} Bytes'.format(length)]
+
+            img_map = mmap(img_file.fileno(), length, access=ACCESS_READ)
+            try:
+                header = self._verify_header(img_map, 1, problems)
+                if header is None:
+                    return problems
+                self.gpt_header = header
+
+                if header.lba_backup < 2 or \
+                        (header.lba_backup + 1) * self.block_size > length:
+                    problems.append('The GPT backup LBA {0} is out of the '
+                                    'image'.format(header.lba_backup))
+                else:
+                    backup = self._verify_header(img_map, header.lba_backup,
+                                                 problems)
+                    if backup is not None:
+                        self._compare_headers(img_map, header, backup,
+                                              problems)
+
+                self.table = PartTableInfos()
+                self.table.read(img_map, header.lba_start * self.block_size,
+                                header.table_length, header.entry_size)
+                self._verify_entries(problems)
+
+                if hashes:
+                    self._verify_hashes(img_map, hashes, jobs, problems)
+            finally:
+                img_map.close()
+
+        return problems
+
+    def _verify_header(self, img_map, lba, problems):
+        """
+        Verifies the GPT header, or the GPT backup, at a LBA of the image
+        and the CRC32 of its partition table. Returns the header, or None
+        when it can't be used
+        """
+        name = 'GPT header' if lba == 1 else 'GPT backup'
+        offset = lba * self.block_size
+
+        header = GPTHeaderInfos(block_size=self.block_size)
+        header.read(img_map, offset)
+
+        if header.sign != b'EFI PART':
+            problems.append('The {0} at LBA {1} has an invalid signature: {2}'
+                            .format(name, lba, header.sign))
+            return None
+
+        if not calcsize(GPTHeaderInfos._FMT) <= header.size <= \
+                self.block_size:
+            problems.append('The {0} has an invalid size: {1} Bytes'
+                            .format(name, header.size))
+            return None
+
+        # the CRC32 of the header is computed with its CRC field zeroed
+        raw = img_map[offset:offset + header.size]
+        crc = crc32(b''.join((raw[:16], b'\x00' * 4, raw[20:]))) & 0xffffffff
+        if crc != header.crc:
+            problems.append('The {0} has an invalid CRC32: 0x{1:08x} instead '
+                            'of 0x{2:08x}'.format(name, header.crc, crc))
+
+        if header.lba_current != lba:
+            problems.append('The {0} at LBA {1} gives its LBA as {2}'
+                            .format(name, lba, header.lba_current))
+
+        if header.entry_size < calcsize(TableEntryInfos._FMT) or \
+                header.entry_size % 8:
+            problems.append('The {0} has an invalid partition entry size: {1}'
+                            .format(name, header.entry_size))
+            return None
+
+        table_offset = header.lba_start * self.block_size
+        table_end = table_offset + header.table_length * header.entry_size
+        if header.lba_start < 2 or table_end > len(img_map):
+            problems.append('The partition table of the {0} is out of the '
+                            'image: LBA {1}'.format(name, header.lba_start))
+            return None
+
+        table_crc = crc32(img_map[table_offset:table_end]) & 0xffffffff
+        if table_crc != header.table_crc:
+            problems.append('The partition table of the {0} has an invalid '
+                            'CRC32: 0x{1:08x} instead of 0x{2:08x}'
+                            .format(name, header.table_crc, table_crc))
+
+        return header
+
+    def _compare_headers(self, img_map, header, backup, problems):
+        """
+        Checks the GPT backup and its partition table are the ones of the
+        GPT header
+        """
+        if backup.lba_backup != 1:
+            problems.append('The GPT backup gives the GPT header LBA as {0}'
+                            .format(backup.lba_backup))
+
+        for field in ('lba_first', 'lba_last', 'uuid', 'table_length',
+                      'entry_size', 'table_crc'):
+            if getattr(header, field) != getattr(backup, field):
+                problems.append('The GPT header and its backup differ: {0} '
+                                '{1} != {2}'.format(field,
+                                                    getattr(header, field),
+                                                    getattr(backup, field)))
+
+        table_length = header.table_length * header.entry_size
+        table_offset = header.lba_start * self.block_size
+        backup_offset = backup.lba_start * self.block_size
+        if img_map[table_offset:table_offset + table_length] != \
+                img_map[backup_offset:backup_offset + table_length]:
+            problems.append('The partition table and its backup differ')
+
+    def _verify_entries(self, problems):
+        """
+        Checks the used partition entries are in the usable LBAs and don't
+        overlap
+        """
+        header = self.gpt_header
+        entries = [entry for entry in self.table
+                   if entry.type != b'\x00' * 16]
+
+        for entry in entries:
+            if entry.lba_first > entry.lba_last:
+                problems.append('The partition {0} ends before its start: '
+                                'LBAs {1}-{2}'.format(entry_name(entry),
+                                                      entry.lba_first,
+                                                      entry.lba_last))
+            elif entry.lba_first < header.lba_first or \
+                    entry.lba_last > header.lba_last:
+                problems.append('The partition {0} is out of the usable LBAs:'
+                                ' {1}-{2} not in {3}-{4}'
+                                .format(entry_name(entry), entry.lba_first,
+                                        entry.lba_last, header.lba_first,
+                                        header.lba_last))
+
+        entries.sort(key=lambda entry: entry.lba_first)
+        for previous, entry in zip(entries, entries[1:]):
+            if entry.lba_first <= previous.lba_last:
+                problems.append('The partitions {0} and {1} overlap: LBAs '
+                                '{2}-{3} and {4}-{5}'
+                                .format(entry_name(previous),
+                                        entry_name(entry),
+                                        previous.lba_first, previous.lba_last,
+                                        entry.lba_first, entry.lba_last))
+
+    def _verify_hashes(self, img_map, hashes, jobs, problems):
+        """
+        Hashes in parallel the used part of the partitions recorded in the
+        hashes and compares them with their expected digests
+        """
+        entries = dict((entry_name(entry), entry) for entry in self.table
+                       if entry.type != b'\x00' * 16)
+
+        records = []
+        for record in hashes:
+            entry = entries.get(record['label'])
+            if entry is None:
+                problems.append('The partition {0} is missing'
+                                .format(record['label']))
+            elif (entry.lba_first, entry.lba_last) != \
+                    (int(record['first_lba']), int(record['last_lba'])):
+                problems.append('The partition {0} is at LBAs {1}-{2} instead'
+                                ' of {3}-{4}'.format(record['label'],
+                                                     entry.lba_first,
+                                                     entry.lba_last,
+                                                     record['first_lba'],
+                                                     record['last_lba']))
+            elif int(record['length']) > \
+                    (entry.lba_last + 1 - entry.lba_first) * self.block_size:
+                problems.append('The partition {0} is smaller than its '
+                                'recorded length: {1} Bytes'
+                                .format(record['label'], record['length']))
+            else:
+                records.append(record)
+
+        def hash_partition(record):
+            algorithms = [name for name in HashManifest.ALGORITHMS
+                          if name in record]
+            digests = hash_extent(img_map,
+                                  int(record['first_lba']) * self.block_size,
+                                  int(record['length']), algorithms)
+            debug('Partition {0} hashed'.format(record['label']))
+            return [(name, record[name], digests[name])
+                    for name in algorithms]
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for record, results in zip(records,
+                                       pool.map(hash_partition, records)):
+                for name, expected, digest in results:
+                    if expected != digest:
+                        problems.append('The partition {0} has an invalid {1}'
+                                        ': {2} instead of {3}'
+                                        .format(record['label'], name,
+                                                digest, expected))
+
+    def extract(self, out_dir, labels=None, jobs=1, android_sparse=False):
+        """
+        Used to extract the partitions of a GPT/UEFI image already read, or
+        only the ones of the labels, each one in its own file of the output
+        directory. The partitions are extracted by jobs workers in parallel,
+        as sparse files whose zero chunks are holes, or as Android sparse
+        images. Returns the path of each extracted partition
+        """
+        entries = [entry for entry in self.table
+                   if entry.type != b'\x00' * 16]
+        if labels:
+            names = [entry_name(entry) for entry in entries]
+            unknown = [label for label in labels if label not in names]
+            if unknown:
+                raise ImageError('Unknown partition(s) in the GPT/UEFI image '
+                                 '{0}: {1}'
+                                 .format(self.path, ' '.join(unknown)))
+            entries = [entry for entry in entries
+                       if entry_name(entry) in labels]
+
+        with open(self.path, 'rb') as img_file:
+            length = lseek(img_file.fileno(), 0, SEEK_END)
+            for entry in entries:
+                if entry.lba_first > entry.lba_last or \
+                        (entry.lba_last + 1) * self.block_size > length:
+                    raise ImageError('The partition {0} is out of the '
+                                     'GPT/UEFI image: LBAs {1}-{2}'
+                                     .format(entry_name(entry),
+                                             entry.lba_first,
+                                             entry.lba_last))
+
+            makedirs(out_dir, exist_ok=True)
+            info('Extracting {0} partitions of the GPT/UEFI image {1} in {2}'
+                 .format(len(entries), self.path, out_dir))
+
+            start = time()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(self._extract_partition, img_file,
+                                       entry, out_dir, android_sparse)
+                           for entry in entries]
+                paths = dict((entry_name(entry), future.result())
+                             for entry, future in zip(entries, futures))
+            elapsed = time() - start
+
+        info('{0} partitions extracted in {1:.2f} s'
+             .format(len(paths), elapsed))
+
+        return paths
+
+    def _extract_partition(self, img_file, entry, out_dir, android_sparse):
+        """
+        Extracts a partition in its own file, runs in a worker of extract
+        """
+        offset = entry.lba_first * self.block_size
+        size = (entry.lba_last + 1 - entry.lba_first) * self.block_size
+        out_path = join(out_dir, '{0}.img'.format(entry_name(entry)))
+        debug('Extracting the partition {0} in {1}'
+              .format(entry_name(entry), out_path))
+
+        with open(out_path, 'wb') as out_file:
+            if android_sparse:
+                block_size = SparseImageWriter.BLOCK_SIZE
+                while size % block_size:
+                    block_size //= 2
+                writer = SparseImageWriter(out_file, block_size, size)
+
+                buf = bytearray(BinaryCopier._BUFFER_SIZE)
+                view = memoryview(buf)
+                done = 0
+                while done < size:
+                    length = preadv(img_file.fileno(),
+                                    [view[:min(len(view), size - done)]],
+                                    offset + done)
+                    writer.write(view[:length])
+                    done += length
+                writer.close()
+            else:
+                # the zero chunks are left as holes of the sized file
+                out_file.truncate(size)
+                BinaryCopier(sparse=True).copy(img_file.fileno(),
+                                               out_file.fileno(), 0, size,
+                                               offset)
+
+        return out_path
+
+    def update(self, updates, jobs=1, zero_tail=False):
+        """
+        Used to replace in place the binaries of some partitions of a
+        GPT/UEFI image already read, updates gives the binary path of each
+        partition label. The partitions are written by jobs workers in
+        parallel, the GPT is left untouched. With zero_tail, the end of the
+        partitions after their new binary is zeroed. The records of the hash
+        manifest of the image, if any, are updated. Returns the number of
+        Bytes written in each partition.
+        """
+        entries = dict((entry_name(entry), entry) for entry in self.table
+                       if entry.type != b'\x00' * 16)
+        unknown = [label for label in updates if label not in entries]
+        if unknown:
+            raise ImageError('Unknown partition(s) in the GPT/UEFI image '
+                             '{0}: {1}'.format(self.path, ' '.join(unknown)))
+
+        hash_path = self.sidecar_path(HashManifest.SUFFIX)
+        records = None
+        if hash_path is not None and isfile(hash_path):
+            records = dict((record['label'], record) for record
+                           in HashManifest(hash_path).read())
+
+        binaries = BinaryFiles()
+        try:
+            copies = []
+            for label, bin_path in updates.items():
+                entry = entries[label]
+                tlb_part = TLB_INFO(entry.lba_first,
+                                    entry.lba_last + 1 - entry.lba_first,
+                                    None, None, label)
+                bin_file, bin_img, size = self._open_binary(tlb_part,
+                                                            bin_path,
+                                                            binaries)
+                digests = None if records is None else HashManifest.digests()
+                copies.append((tlb_part, bin_file, bin_img, size, digests))
+
+            info('Updating the partitions {0} of the GPT/UEFI image {1}'
+                 .format(' '.join(updates), self.path))
+            written = {}
+            disabled = set()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(self._update_partition, tlb_part,
+                                       bin_file, bin_img, size, digests,
+                                       zero_tail, disabled)
+                           for tlb_part, bin_file, bin_img, size, digests
+                           in copies]
+                for copy, future in zip(copies, futures):
+                    written[copy[0].label] = future.result()
+        finally:
+            binaries.close()
+
+        if records is not None:
+            for tlb_part, _, _, _, digests in copies:
+                records[tlb_part.label] = HashManifest.record(
+                    tlb_part, written[tlb_part.label], digests)
+            info('Updating the hash manifest of the partitions: {0}'
+                 .format(hash_path))
+            HashManifest(hash_path).write(self.block_size,
+                                          list(records.values()))
+
+        info('GPT/UEFI Image {0} updated successfully !!!'.format(self.path))
+
+        return written
+
+    def _update_partition(self, tlb_part, bin_file, bin_img, size, digests,
+                          zero_tail, disabled=None):
+        """
+        Writes the new binary of a partition, runs in a worker of update,
+        sharing the copy methods disabled with the other workers
+        """
+        offset = int(tlb_part.begin) * self.block_size
+        part_size = tlb_part.size * self.block_size
+
+        length = self._write_partition(bin_file, bin_img, offset, size, False,
+                                       digests, part_size, punch=True,
+                                       label=tlb_part.label,
+                                       disabled=disabled)
+        if zero_tail:
+            debug('Zeroing the partition {0} after its binary'
+                  .format(tlb_part.label))
+            img_fd = os_open(self.path, O_WRONLY)
+            try:
+                zero_region(img_fd, offset + length, part_size - length)
+            finally:
+                close(img_fd)
+
+        return length
 
-        # the image size is invalid
-        if unit not in units:
-            error('The size of GPT/UEFI image use an invalid unit: {0}'
-                  .format(str_size))
-            exit(-1)
+    def resize(self, str_size, label):
+        """
+        Used to resize in place a GPT/UEFI image already read. The image file
+        is extended or truncated, the backup partition table and the GPT
+        backup are moved to its new end, and the partition label, the one
+        with the size -1 in the TLB partition files, grows or shrinks by the
+        same number of blocks. It has to be the last partition of the image,
+        the other partitions are left untouched. The GPT header and the
+        tables are rewritten with their new CRC32.
+        """
+        if BlockDevice.is_block_device(self.path):
+            raise ImageError('A block device can\'t be resized: {0}'
+                             .format(self.path))
+
+        size = GPTImage.convert_size_to_bytes(str_size)
+        header = self.gpt_header
+        if size % self.block_size:
+            raise ImageError('The new size of GPT/UEFI image isn\'t a '
+                             'multiple of the block size: {0}'
+                             .format(str_size))
+
+        # the new layout of the end of the image, as computed by the header
+        table_size = -(-header.table_length * header.entry_size //
+                       self.block_size)
+        old_backup = header.lba_backup
+        old_start = old_backup - table_size
+        lba_backup = size // self.block_size - 1
+        delta = lba_backup - old_backup
+
+        entries = [entry for entry in self.table
+                   if entry.type != b'\x00' * 16]
+        resized = [entry for entry in entries if entry_name(entry) == label]
+        if not resized:
+            raise ImageError('No partition {0} to resize in the GPT/UEFI '
+                             'image: {1}'.format(label, self.path))
+        last = resized[0]
+
+        # the partitions after the resized one would have to be moved
+        if any(entry.lba_last > last.lba_last for entry in entries):
+            raise ImageError('The partition {0} isn\'t the last one of the '
+                             'GPT/UEFI image, it can\'t be resized: {1}'
+                             .format(label, self.path))
+
+        lba_last = lba_backup - 1 - table_size
+        if last.lba_last + delta < last.lba_first or \
+                last.lba_last + delta > lba_last:
+            raise ImageError('The GPT/UEFI image is too small to keep its '
+                             'partitions: {0}'.format(str_size))
+
+        info('Resizing the GPT/UEFI image {0} to {1} Bytes, the partition {2}'
+             ' is resized by {3} blocks'.format(self.path, size,
+                                                entry_name(last), delta))
+
+        # the last LBA of the last partition is updated in its raw entry
+        last.lba_last += delta
+        start = last.pos * last.size
+        raw_table = bytearray(self.table.raw)
+        raw_table[start + 40:start + 48] = pack('<Q', last.lba_last)
+        raw_table = bytes(raw_table)
+        table_crc = crc32(raw_table) & 0xffffffff
 
-        try:
-            # convert string size to an integer
-            value = int(str_size[:-1])
-        except ValueError:
-            error('The size of GPT/UEFI image is invalid: {0}'
-                  .format(str_size))
-            exit(-1)
+        header.lba_backup = lba_backup
+        header.lba_last = lba_last
+        header.lba_start = lba_backup - table_size
+        raw_header = header.pack(table_crc).ljust(self.block_size, b'\x00')
+        raw_backup = header.pack(table_crc, backup=True)
+        backup = b''.join((raw_table, raw_backup.ljust(self.block_size,
+                                                       b'\x00')))
+
+        with open(self.path, 'rb+') as img_file:
+            fd = img_file.fileno()
+            if delta > 0:
+                img_file.truncate(size)
+
+            # the new backups are written before the GPT header points to
+            # them
+            write_all(fd, backup, header.lba_start * self.block_size)
+            write_all(fd, raw_header, self.block_size)
+            write_all(fd, raw_table, 2 * self.block_size)
+
+            if delta > 0:
+                # the old backups are now in the last partition
+                zero_region(fd, old_start * self.block_size,
+                            (old_backup + 1 - old_start) * self.block_size)
+            elif delta < 0:
+                img_file.truncate(size)
 
-        # the value is negative
-        if value < 0:
-            error('The size of GPT/UEFI image is a negative value: {0}'
-                  .format(str_size))
-            exit(-1)
+        self.size = size
+        self.table.raw = raw_table
 
-        # the value is a Bytes
-        if unit == units[0]:
-            return int(str_size[:-1])
+        # the records of the hash manifest keep the new LBAs
+        hash_path = self.sidecar_path(HashManifest.SUFFIX)
+        if hash_path is not None and isfile(hash_path):
+            records = HashManifest(hash_path).read()
+            for record in records:
+                if record['label'] == entry_name(last):
+                    record['last_lba'] = last.lba_last
+            HashManifest(hash_path).write(self.block_size, records)
 
-        index = units.index(unit)
-        return value * 1024**index
+        info('GPT/UEFI Image {0} resized successfully !!!'.format(self.path))
 
-    def read(self):
+    def diff(self, other, jobs=1):
         """
-        Read information from a GPT/UEFI image
+        Used to compare a GPT/UEFI image already read with another one read
+        too. The MBR, the GPT headers and the partition tables are compared
+        field by field, then the partitions of both images are compared in
+        large chunks of their memory maps by jobs workers in parallel, the
+        chunks which are holes in both files are skipped. Returns the list
+        of the structural differences and the differing extents of each
+        partition, with offsets relative to the partition start
         """
-        # opens and reads the image file
-        with open(self.path, 'rb') as img_file:
+        differences = []
+
+        if self.mbr.raw != other.mbr.raw:
+            differences.append('MBR differs')
+
+        for field in ('sign', 'rev', 'size', 'lba_backup', 'lba_first',
+                      'lba_last', 'uuid', 'table_length', 'entry_size'):
+            value, other_value = getattr(self.gpt_header, field), \
+                getattr(other.gpt_header, field)
+            if value != other_value:
+                if field == 'uuid':
+                    value, other_value = UUID(bytes_le=value), \
+                        UUID(bytes_le=other_value)
+                differences.append('GPT header {0}: {1} != {2}'
+                                   .format(field, value, other_value))
+
+        entries = dict((entry_name(entry), entry) for entry in self.table
+                       if entry.type != b'\x00' * 16)
+        other_entries = dict((entry_name(entry), entry)
+                             for entry in other.table
+                             if entry.type != b'\x00' * 16)
+        for label in entries:
+            if label not in other_entries:
+                differences.append('Partition {0} only in {1}'
+                                   .format(label, self.path))
+        for label in other_entries:
+            if label not in entries:
+                differences.append('Partition {0} only in {1}'
+                                   .format(label, other.path))
+
+        labels = [label for label in entries if label in other_entries]
+        for label in labels:
+            entry, other_entry = entries[label], other_entries[label]
+            for field in ('lba_first', 'lba_last', 'type', 'uuid', 'attr'):
+                value, other_value = getattr(entry, field), \
+                    getattr(other_entry, field)
+                if value != other_value:
+                    if field in ('type', 'uuid'):
+                        value, other_value = UUID(bytes_le=value), \
+                            UUID(bytes_le=other_value)
+                    differences.append('Partition {0} {1}: {2} != {3}'
+                                       .format(label, field, value,
+                                               other_value))
+
+        with open(self.path, 'rb') as img_file, \
+                open(other.path, 'rb') as other_file:
+            length = lseek(img_file.fileno(), 0, SEEK_END)
+            other_length = lseek(other_file.fileno(), 0, SEEK_END)
+            extents = data_extents(img_file.fileno(), length)
+            other_extents = data_extents(other_file.fileno(), other_length)
+
+            img_map = mmap(img_file.fileno(), length, access=ACCESS_READ)
+            other_map = mmap(other_file.fileno(), other_length,
+                             access=ACCESS_READ)
+            try:
+                # the partitions are compared on their common size, in
+                # chunks balanced between the workers
+                tasks = []
+                for label in labels:
+                    entry, other_entry = entries[label], other_entries[label]
+                    offset = entry.lba_first * self.block_size
+                    other_offset = other_entry.lba_first * self.block_size
+                    size = min(entry.lba_last + 1 - entry.lba_first,
+                               other_entry.lba_last + 1 -
+                               other_entry.lba_first) * self.block_size
+                    size = max(0, min(size, length - offset,
+                                      other_length - other_offset))
+                    for start in range(0, size, GPTImage._DIFF_CHUNK_SIZE):
+                        tasks.append((label, offset, other_offset, start,
+                                      min(start + GPTImage._DIFF_CHUNK_SIZE,
+                                          size)))
+
+                def compare(task):
+                    _, offset, other_offset, start, end = task
+                    if not in_extents(extents, offset + start,
+                                      offset + end) and \
+                            not in_extents(other_extents, other_offset + start,
+                                           other_offset + end):
+                        return []
+                    return diff_extents(img_map, offset, other_map,
+                                        other_offset, start, end,
+                                        self.block_size)
+
+                partitions = dict((label, []) for label in labels)
+                with ThreadPoolExecutor(max_workers=jobs) as pool:
+                    for task, found in zip(tasks, pool.map(compare, tasks)):
+                        extents_found = partitions[task[0]]
+                        for start, end in found:
+                            # merges the adjacent extents of the chunks
+                            if extents_found and extents_found[-1][1] == start:
+                                extents_found[-1] = (extents_found[-1][0], end)
+                            else:
+                                extents_found.append((start, end))
+            finally:
+                img_map.close()
+                other_map.close()
+
+        return differences, dict((label, found) for label, found
+                                 in partitions.items() if found)
+
+    def sidecar_path(self, suffix, required=False):
+        """
+        Gives the path of a file written next to the image, or in the sidecar
+        directory if it's given. The files of a block device are only in the
+        sidecar directory, without it there is no path, an error is raised
+        if the file is required.
+        """
+        if self.sidecar_dir is not None:
+            return join(self.sidecar_dir, basename(self.path) + suffix)
+        if not BlockDevice.is_block_device(self.path):
+            return self.path + suffix
+        if required:
+            raise ImageError('The sidecar directory of the block device {0} '
+                             'is needed to write its {1} file'
+                             .format(self.path, suffix))
+        return None
 
-            # reads the MBR of the image file
-            debug('Reading MBR from {0}'.format(self.path))
-            self.mbr.read(img_file)
+    @classmethod
+    def binary_path(cls, tlb_part, binaries_path):
+        """
+        Gives the path of the binary file used to write a partition, or none
+        """
+        # removes the prefix "android_"
+        truncated_label = tlb_part.label[0:]
+        # removes the postfix "_a" or "_b" for slotab cases
+        if (truncated_label[len(truncated_label)-2:] == '_a' or
+        truncated_label[len(truncated_label)-2:] == '_b') :
+            truncated_label = truncated_label[:-2]
 
-            # reads the GPT header of the image file
-            debug('Reading GPT header from {0}'.format(self.path))
-            offset = self.block_size
-            self.gpt_header.read(img_file, offset)
+        # the slot_b case is never written
+        label = tlb_part.label[0:]
+        if label[len(label)-2:] == '_b':
+            return 'none'
 
-            # reads the partition table of the image file
-            debug('Reading partition table from {0}'.format(self.path))
-            offset = self.block_size * self.gpt_header.lba_start
-            self.table.read(img_file, offset, self.gpt_header.table_length,
-                            self.gpt_header.entry_size)
+        return binaries_path.get(truncated_label, 'none')
 
-    def _write_crc(self, img_file):
+    def _build_headers(self, tlb_infos):
         """
-        Calculate and write CRC32 of GPT partition table, header and backup
+        Builds in memory the raw MBR, GPT header and backup, and partition
+        tables, with their CRC32. Returns the raw of the first blocks of the
+        image, up to the first usable LBA, and the raw of its last blocks,
+        from the backup partition table to the GPT backup
         """
-        # reads partition tables
-        img_file.seek(2 * self.block_size)
-        raw_table = img_file.read(self.gpt_header.table_length *
-                                  self.gpt_header.entry_size)
-        img_file.seek((self.gpt_header.lba_backup - 32) * self.block_size)
-        raw_backup_table = img_file.read(self.gpt_header.table_length *
-                                         self.gpt_header.entry_size)
+        start = time()
+        header = self.gpt_header
+        if self.guid_namespace is not None:
+            layout = BuildManifest.layout_hash(tlb_infos, self.size,
+                                               self.block_size)
+            header.uuid = UUID(make_guid(self.guid_namespace,
+                                         'disk {0}'.format(layout))).bytes_le
+
+        raw_table = self.table.pack(tlb_infos, header.table_length,
+                                    header.entry_size)
+        start = self.stats.phase('tables', start, len(raw_table))
 
-        # computes CRC 32 partition tables
         table_crc = crc32(raw_table) & 0xffffffff
-        backup_table_crc = crc32(raw_backup_table) & 0xffffffff
 
-        # creates raw with the calculated CRC32 of partition tables
-        raw_table_crc = pack('<I', table_crc)
-        raw_backup_table_crc = pack('<I', backup_table_crc)
+        raw_header = header.pack(table_crc)
+        raw_backup = header.pack(table_crc, backup=True)
+        self.stats.phase('crc', start, len(raw_table))
+
+        # the MBR and the headers are padded with zero to fill their block
+        primary = b''.join((self.mbr.pack().ljust(self.block_size, b'\x00'),
+                            raw_header.ljust(self.block_size, b'\x00'),
+                            raw_table))
+        primary = primary.ljust(header.lba_first * self.block_size, b'\x00')
 
-        # writes the calculated CRC 32 of partition table in GPT header
-        img_file.seek(self.block_size + 88)
-        img_file.write(raw_table_crc)
+        backup = b''.join((raw_table,
+                           raw_backup.ljust(self.block_size, b'\x00')))
 
-        # writes the calculated CRC 32 of partition table in GPT backup
-        img_file.seek(self.size - self.block_size + 88)
-        img_file.write(raw_backup_table_crc)
+        return primary, backup
 
-        # reads the GPT header
-        img_file.seek(self.block_size)
-        raw_header = img_file.read(self.gpt_header.size)
+    def _open_binary(self, tlb_part, bin_path, binaries):
+        """
+        Opens the binary file of a partition in the binary files and checks
+        it fits in the partition. Returns the binary file, its sparse or
+        compressed image, if it's one, and its size once expanded
+        """
+        if isinstance(bin_path, str):
+            basedir = dirname(abspath(bin_path))
+            if not is_safe_path(basedir, bin_path):
+                raise BinaryError('The path of the binary file is not '
+                                  'allowed: {0}'.format(bin_path))
 
-        # calcultates the CRC 32 of GPT header
-        header_crc = crc32(raw_header) & 0xffffffff
+        bin_file, bin_img, bin_size_in_bytes = binaries.open(bin_path)
 
-        # creates a raw with the calculated CRC32 of GPT header
-        raw_header_crc = pack('<I', header_crc)
+        # checks if partition size is greather or equal to the binary file
+        part_size_in_bytes = tlb_part.size * self.block_size
+        if part_size_in_bytes < bin_size_in_bytes:
+            raise BinaryError('Size of binary file {0} ({1} Bytes) is '
+                              'greather than {2} partition size ({3} Bytes)'
+                              .format(bin_path, bin_size_in_bytes,
+                                      tlb_part.label, part_size_in_bytes))
 
-        # writes calculated CRC 32 of GPT header
-        img_file.seek(self.block_size + 16)
-        img_file.write(raw_header_crc)
+        return bin_file, bin_img, bin_size_in_bytes
 
-        # reads the GPT backup
-        img_file.seek(self.size - self.block_size)
-        raw_backup = img_file.read(self.gpt_header.size)
+    def _write_partitions(self, img_file, tlb_infos, binaries_path,
+                          sparse=False, jobs=1, binaries=None, hashes=None,
+                          punch=False):
+        """
+        Used to write partitions of image with binary files given. Call by
+        write method, returns the number of Bytes written in each partition
+        from its start. In sparse mode, only the non-zero chunks of the binary
+        files are written, the other ones are left as holes. The binary files
+        are checked first, then they are copied by a pool of jobs workers,
+        each one writing with positional I/O through its own file descriptor
+        of the image. The binary files may be shared with other images. If
+        hashes is a dict, the data of each partition is hashed as it's
+        copied and the hash record of the partition is stored in it. With
+        punch, the partitions may already hold data, the zero regions of the
+        binaries are punched.
+        """
+        # the binaries are copied through other file descriptors of the image
+        img_file.flush()
 
-        # calcultates CRC 32 of GPT backup
-        backup_crc = crc32(raw_backup) & 0xffffffff
+        # the copy methods which failed aren't tried for the next partitions
+        disabled = set()
 
-        # creates a raw with the calculated CRC32 of GPT backup
-        raw_backup_crc = pack('<I', backup_crc)
+        opened = binaries is None
+        if opened:
+            binaries = BinaryFiles()
 
-        # writes the calculated CRC 32 of GPT backup
-        img_file.seek(self.size - self.block_size + 16)
-        img_file.write(raw_backup_crc)
+        try:
+            copies = []
+            written = {}
+            for tlb_part in tlb_infos:
+                # gives the path of binary used to write the partition
+                bin_path = GPTImage.binary_path(tlb_part, binaries_path)
+
+                # computes the partition offset
+                offset = int(tlb_part.begin) * self.block_size
+
+                digests = None if hashes is None else HashManifest.digests()
+
+                # no binary file used to build the partition or slot_b case
+                if bin_path == 'none':
+                    written[tlb_part.label] = 0
+                    # the partition is already a hole of the sparse image
+                    if not sparse:
+                        pwrite(img_file.fileno(), b'\0', offset)
+                        written[tlb_part.label] = 1
+                        hash_fill(digests, b'\0', 1)
+                    if digests is not None:
+                        hashes[tlb_part.label] = HashManifest.record(
+                            tlb_part, written[tlb_part.label], digests)
+                    continue
 
-    def _write_partitions(self, img_file, tlb_infos, binaries_path):
+                bin_file, bin_img, bin_size_in_bytes = \
+                    self._open_binary(tlb_part, bin_path, binaries)
+
+                copies.append((bin_size_in_bytes, offset, bin_file,
+                               bin_img, tlb_part, digests))
+
+            # starts with the largest binaries to balance the workers
+            copies.sort(key=lambda copy: copy[0], reverse=True)
+
+            debug('Copying {0} binaries with {1} workers'
+                  .format(len(copies), jobs))
+            start = time()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(self._write_partition, bin_file,
+                                       bin_img, offset, size, sparse,
+                                       digests,
+                                       tlb_part.size * self.block_size,
+                                       punch, tlb_part.label, disabled)
+                           for size, offset, bin_file, bin_img, tlb_part,
+                           digests in copies]
+                for copy, future in zip(copies, futures):
+                    written[copy[4].label] = future.result()
+            total = sum(written.values())
+            elapsed = self.stats.phase('partitions', start, total) - start
+
+            if hashes is not None:
+                for _, _, _, _, tlb_part, digests in copies:
+                    hashes[tlb_part.label] = HashManifest.record(
+                        tlb_part, written[tlb_part.label], digests)
+        finally:
+            if opened:
+                binaries.close()
+
+        info('Partitions written: {0} Bytes in {1:.2f} s ({2:.2f} MB/s)'
+             .format(total, elapsed,
+                     total / (1024 * 1024) / max(elapsed, 1e-6)))
+
+        return written
+
+    def _write_partition(self, bin_file, bin_img, offset, size,
+                         sparse=False, digests=None, limit=None, punch=False,
+                         label=None, disabled=None):
         """
-        Used to write partitions of image with binary files given. Call by
-        write method
+        Copies a binary file in a partition, runs in a worker of the
+        partitions writer. The copied data is hashed with the digests, if
+        given. A compressed binary must not exceed limit Bytes once
+        decompressed. The zero regions of the binary are punched if the
+        partition may already hold data. The copy of the partition is
+        recorded in the statistics under its label. The copy methods
+        disabled are shared with the other partitions of the write. Returns
+        the number of Bytes written
         """
-        for tlb_part in tlb_infos:
-            # removes the prefix "android_"
-            truncated_label = tlb_part.label[0:]
-            # removes the postfix "_a" or "_b" for slotab cases
-            if (truncated_label[len(truncated_label)-2:] == '_a' or
-            truncated_label[len(truncated_label)-2:] == '_b') :
-                truncated_label = truncated_label[:-2]
-
-            # gives the path of binary used to write the partition
-            bin_path = binaries_path[truncated_label]
-
-            # computes the partition offset
-            offset = int(tlb_part.begin) * self.block_size
-
-            # no binary file used to build the partition or slot_b case
-            label = tlb_part.label[0:]
-            if bin_path == 'none' or label[len(label)-2:] == '_b':
-                line = b'\0'
-                img_file.seek(offset)
-                img_file.write(line)
-                bin_size = 0
-                continue
+        start = time()
+        img_fd = os_open(self.path, O_WRONLY)
+        try:
+            copier = BinaryCopier(sparse, digests, punch, disabled)
+            if isinstance(bin_img, CompressedImage):
+                size = bin_img.write(img_fd, offset, copier, limit)
+            elif bin_img:
+                bin_img.write(bin_file, img_fd, offset, copier)
+            else:
+                copier.copy(bin_file.fileno(), img_fd, offset, size)
+        finally:
+            close(img_fd)
 
-            basedir = dirname(abspath(bin_path))
-            if not is_safe_path(basedir, bin_path):
-                sys.stdout.write('Not allowed!\n')
-
-            # checks if partition size is greather or equal to the binary file
-            bin_size_in_bytes = stat(bin_path).st_size
-            part_size_in_bytes = tlb_part.size * self.block_size
-            bin_size = bin_size_in_bytes // self.block_size
-            if tlb_part.size < bin_size:
-                error('Size of binary file {0} ({1} Bytes) is greather than '
-                      '{2} partition size ({3} Bytes)'.format(bin_path,
-                                                              bin_size_in_bytes,
-                                                              tlb_part.label,
-                                                              part_size_in_bytes))
-                exit(-1)
+        self.stats.partition(label, start, size, copier.syscalls)
+        return size
 
-            # opens and reads the binary file to write the partition
-            with open(bin_path, 'rb') as bin_file:
-                img_file.seek(offset)
-                # Doesn't work if image size exceed the largest integer on that
-                # machine, image size is intepreted as a negative size by
-                # Python interpeter
-                # for line in bin_file:
-                #     img_file.write(line)
-                while True:
-                    data = bin_file.read(8192)
-                    if not data:
-                        break
-                    img_file.write(data)
-
-    def write(self, tlb_infos, binaries_path):
+    def write(self, tlb_infos, binaries_path, sparse=False, jobs=1,
+              binaries=None, hashes=False):
         """
         Used to write a new GPT/UEFI image with values read in TLB file and the
-        binaries
+        binaries, returns the number of Bytes written in each partition. In
+        sparse mode, the image file is sized with ftruncate and only the MBR,
+        the GPT headers, the partition tables and the non-zero data of the
+        binaries are written, everything else is left as holes.
+
+        The MBR, the headers and the tables are built in memory with their
+        CRC32, so each region is written once and in order: the first blocks
+        up to the first usable LBA, the partitions copied by jobs workers in
+        parallel, then the last blocks with the backups.
+
+        With hashes, the partitions are hashed while they are written and
+        their hash manifest is written next to the image.
         """
+        records = {} if hashes else None
         with open(self.path, 'wb+') as img_file:
             info('Launch the write of GPT/UEFI image: {0}'.format(self.path))
 
-            # fill output image header with 0x00: MBR size + GPT header size +
-            # (partition table length * entry size)
-            zero = b'\x00' * (2 * self.block_size +
-                             self.gpt_header.table_length *
-                             self.gpt_header.entry_size)
+            if sparse:
+                debug('Sizing the sparse GPT/UEFI image to {0} Bytes'
+                      .format(self.size))
+                img_file.truncate(self.size)
+
+            info('Building the MBR, the GPT headers and the partition tables'
+                 ' of the GPT/UEFI image: {0}'.format(self.path))
+            primary, backup = self._build_headers(tlb_infos)
+
+            info('Writing the MBR, the GPT Header and the primary partition'
+                 ' table of the GPT/UEFI image: {0}'.format(self.path))
+            start = time()
             img_file.seek(0)
-            img_file.write(zero)
+            img_file.write(primary)
+            img_file.flush()
+            self.stats.phase('primary', start, len(primary))
 
-            info('Writing the MBR of the GPT/UEFI image: {0}'
+            info('Writing partitions of the GPT/UEFI image {0}'
                  .format(self.path))
-            offset = 0
-            self.mbr.write(img_file, offset)
+            written = self._write_partitions(img_file, tlb_infos,
+                                             binaries_path, sparse, jobs,
+                                             binaries, records)
+
+            info('Writing the secondary partition table and the GPT backup'
+                 ' of the GPT/UEFI image: {0}'.format(self.path))
+            start = time()
+            img_file.seek(self.gpt_header.lba_start * self.block_size)
+            img_file.write(backup)
+            img_file.flush()
+            self.stats.phase('backup', start, len(backup))
 
-            info('Writing the GPT Header of the GPT/UEFI image: {0}'
+            info('GPT/UEFI Image {0} created successfully !!!'
                  .format(self.path))
-            offset = self.block_size
-            self.gpt_header.write(img_file, offset, self.block_size)
 
-            info('Writing the primary partition table of the GPT/UEFI'
-                 ' image: {0}'
-                 .format(self.path))
-            offset = 2 * self.block_size
-            self.table.write(img_file, offset, self.gpt_header.entry_size,
-                             tlb_infos, self.gpt_header.lba_last)
+        if hashes:
+            self._write_hashes(tlb_infos, records)
 
-            info('Writing the secondary partition table of the'
-                 ' GPT/UEFI image: {0}'
-                 .format(self.path))
-            offset = (self.gpt_header.lba_backup - 32) * self.block_size
-            self.table.write(img_file, offset, self.gpt_header.entry_size,
-                             tlb_infos, self.gpt_header.lba_last)
+        return written
 
-            info('Writing partitions of the GPT/UEFI image {0}'
-                 .format(self.path))
-            self._write_partitions(img_file, tlb_infos, binaries_path)
+    def write_stats(self):
+        """
+        Logs the statistics of the write of the image and writes them next
+        to it
+        """
+        stats_path = self.sidecar_path(BuildStats.SUFFIX, True)
+        self.stats.report(self.path)
+        info('Writing the statistics of the write: {0}'.format(stats_path))
+        self.stats.write(stats_path, self.path)
 
-            info('Calculating the GPT/UEFI image CRCs and write them')
-            self._write_crc(img_file)
+    def _write_hashes(self, tlb_infos, records):
+        """
+        Writes the hash manifest of the partitions next to the image
+        """
+        start = time()
+        manifest = HashManifest(self.sidecar_path(HashManifest.SUFFIX, True))
+        info('Writing the hash manifest of the partitions: {0}'
+             .format(manifest.path))
+        manifest.write(self.block_size, [records[tlb_part.label]
+                                         for tlb_part in tlb_infos
+                                         if tlb_part.label in records])
+        self.stats.phase('hashes', start)
+
+    def write_device(self, tlb_infos, binaries_path, jobs=1, binaries=None,
+                     hashes=False):
+        """
+        Used to write a GPT/UEFI image directly in a block device, with the
+        same layout as the write method. The device is written with O_DIRECT
+        through large aligned buffers, the partitions by jobs workers in
+        parallel, and the partitions without binary are discarded. Returns
+        the number of Bytes written in each partition. The hash manifest is
+        written in the sidecar directory, which has to be given.
+        """
+        info('Launch the write of GPT/UEFI image in the block device: {0}'
+             .format(self.path))
 
-            info('GPT/UEFI Image {0} created successfully !!!'
-                 .format(self.path))
+        # the hash manifest can't be written next to the block device
+        if hashes:
+            self.sidecar_path(HashManifest.SUFFIX, True)
+
+        opened = binaries is None
+        if opened:
+            binaries = BinaryFiles()
+
+        primary, backup = self._build_headers(tlb_infos)
+
+        info('Writing the MBR, the GPT Header and the primary partition'
+             ' table of the GPT/UEFI image: {0}'.format(self.path))
+        start = time()
+        writer = DirectWriter(self.path, self.block_size)
+        try:
+            writer.write(primary)
+        finally:
+            writer.close()
+        self.stats.phase('primary', start, len(primary))
+
+        info('Writing partitions of the GPT/UEFI image {0}'.format(self.path))
+        written = {}
+        records = {}
+        try:
+            copies = []
+            discard_fd = os_open(self.path, O_WRONLY)
+            try:
+                for tlb_part in tlb_infos:
+                    bin_path = GPTImage.binary_path(tlb_part, binaries_path)
+                    digests = HashManifest.digests() if hashes else None
+
+                    # no binary file used to build the partition or slot_b
+                    # case, its blocks are discarded
+                    if bin_path == 'none':
+                        BlockDevice.discard(discard_fd,
+                                            int(tlb_part.begin) *
+                                            self.block_size,
+                                            tlb_part.size * self.block_size)
+                        written[tlb_part.label] = 0
+                        if hashes:
+                            records[tlb_part.label] = HashManifest.record(
+                                tlb_part, 0, digests)
+                        continue
+
+                    bin_file, bin_img, size = self._open_binary(tlb_part,
+                                                                bin_path,
+                                                                binaries)
+                    copies.append((size, tlb_part, bin_file, bin_img,
+                                   digests))
+            finally:
+                close(discard_fd)
+
+            # starts with the largest binaries to balance the workers
+            copies.sort(key=lambda copy: copy[0], reverse=True)
+
+            start = time()
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(self._write_device_partition, tlb_part,
+                                       bin_file, bin_img, digests)
+                           for _, tlb_part, bin_file, bin_img, digests
+                           in copies]
+                for copy, future in zip(copies, futures):
+                    written[copy[1].label] = future.result()
+            total = sum(written.values())
+            elapsed = self.stats.phase('partitions', start, total) - start
+        finally:
+            if opened:
+                binaries.close()
+
+        info('Partitions written: {0} Bytes in {1:.2f} s ({2:.2f} MB/s)'
+             .format(total, elapsed,
+                     total / (1024 * 1024) / max(elapsed, 1e-6)))
+
+        info('Writing the secondary partition table and the GPT backup'
+             ' of the GPT/UEFI image: {0}'.format(self.path))
+        start = time()
+        writer = DirectWriter(self.path, self.block_size)
+        try:
+            writer.seek(self.gpt_header.lba_start * self.block_size)
+            writer.write(backup)
+        finally:
+            writer.close()
+        self.stats.phase('backup', start, len(backup))
+
+        info('GPT/UEFI Image {0} created successfully !!!'.format(self.path))
+
+        if hashes:
+            for _, tlb_part, _, _, digests in copies:
+                records[tlb_part.label] = HashManifest.record(
+                    tlb_part, written[tlb_part.label], digests)
+            self._write_hashes(tlb_infos, records)
+
+        return written
+
+    def _write_device_partition(self, tlb_part, bin_file, bin_img,
+                                digests=None):
+        """
+        Writes a binary file in a partition of the block device, runs in a
+        worker of write_device
+        """
+        start = time()
+        writer = DirectWriter(self.path, self.block_size, digests)
+        try:
+            writer.seek(int(tlb_part.begin) * self.block_size)
+            size = writer.write_binary(bin_file, bin_img,
+                                       bytearray(BinaryCopier._BUFFER_SIZE),
+                                       tlb_part.size * self.block_size)
+        finally:
+            writer.close()
+
+        self.stats.partition(tlb_part.label, start, size)
+        return size
+
+    def write_tee(self, tlb_infos, binaries_path, tee, sparse=False,
+                  binaries=None, hashes=False):
+        """
+        Used to write the same GPT/UEFI image in several destinations, the
+        image path and the tee paths, image files or devices. Each binary is
+        read once and its data is written in all the destinations in
+        parallel, and hashed with hashes. The partitions without binary are
+        discarded in the devices, and in sparse mode, the zero chunks are
+        only skipped in the image files. Returns the number of Bytes written
+        in each partition.
+        """
+        paths = [self.path] + tee
+        info('Launch the write of GPT/UEFI image in: {0}'
+             .format(' '.join(paths)))
+
+        opened = binaries is None
+        if opened:
+            binaries = BinaryFiles()
+
+        writer = TeeWriter(paths, self.size if sparse else None)
+        try:
+            primary, backup = self._build_headers(tlb_infos)
+            writer.write(primary, 0)
+
+            # the data is queued to the destinations, the times are the ones
+            # of the reads of the binaries, limited by the slowest one
+            written = {}
+            records = {}
+            partitions_start = time()
+            for tlb_part in tlb_infos:
+                start = time()
+                bin_path = GPTImage.binary_path(tlb_part, binaries_path)
+                offset = int(tlb_part.begin) * self.block_size
+                digests = HashManifest.digests() if hashes else None
+
+                # no binary file used to build the partition or slot_b
+                # case, its blocks are discarded in the devices
+                if bin_path == 'none':
+                    written[tlb_part.label] = 0
+                    writer.discard(offset, tlb_part.size * self.block_size)
+                    if not sparse:
+                        writer.write(b'\0', offset)
+                        written[tlb_part.label] = 1
+                        hash_fill(digests, b'\0', 1)
+                    if hashes:
+                        records[tlb_part.label] = HashManifest.record(
+                            tlb_part, written[tlb_part.label], digests)
+                    continue
+
+                bin_file, bin_img, size = self._open_binary(tlb_part,
+                                                            bin_path,
+                                                            binaries)
+                debug('Writing the partition {0} in: {1}'
+                      .format(tlb_part.label, ' '.join(paths)))
+                if isinstance(bin_img, CompressedImage):
+                    size = 0
+                    for data in bin_img.chunks(tlb_part.size *
+                                               self.block_size):
+                        for digest in digests or ():
+                            digest.update(data)
+                        writer.write(data, offset + size)
+                        size += len(data)
+                elif bin_img:
+                    for chunk_type, chunk_size, data in \
+                            bin_img.chunks(bin_file):
+                        if chunk_type == SparseImage.CHUNK_RAW:
+                            self._tee_file(writer, bin_file, data, offset,
+                                           chunk_size, digests)
+                        elif chunk_type == SparseImage.CHUNK_FILL:
+                            fill = fill_pattern(data, chunk_size)
+                            for pos in range(0, chunk_size, len(fill)):
+                                writer.write(fill[:chunk_size - pos],
+                                             offset + pos)
+                            hash_fill(digests, data, chunk_size)
+                        else:
+                            hash_fill(digests, b'\x00' * 4, chunk_size)
+                        offset += chunk_size
+                else:
+                    self._tee_file(writer, bin_file, 0, offset, size, digests)
+                written[tlb_part.label] = size
+                self.stats.partition(tlb_part.label, start, size)
+                if hashes:
+                    records[tlb_part.label] = HashManifest.record(tlb_part,
+                                                                  size,
+                                                                  digests)
+
+                if root_logger.isEnabledFor(DEBUG):
+                    writer.progress()
+
+            self.stats.phase('partitions', partitions_start,
+                             sum(written.values()))
+
+            writer.write(backup, self.gpt_header.lba_start * self.block_size)
+        finally:
+            failed = writer.close()
+            if opened:
+                binaries.close()
+
+        writer.progress()
+        if failed:
+            raise ImageError('GPT/UEFI Image not written in: {0}'
+                             .format(' '.join(failed)))
+
+        info('GPT/UEFI Image {0} created successfully !!!'
+             .format(' '.join(paths)))
+
+        if hashes:
+            self._write_hashes(tlb_infos, records)
+
+        return written
+
+    def _tee_file(self, writer, bin_file, src_offset, offset, size,
+                  digests=None):
+        """
+        Reads size Bytes of a binary file once, hashes them with the digests
+        and queues them to all the destinations
+        """
+        done = 0
+        while done < size:
+            data = pread(bin_file.fileno(),
+                         min(BinaryCopier._BUFFER_SIZE, size - done),
+                         src_offset + done)
+            if not data:
+                break
+            if digests:
+                for digest in digests:
+                    digest.update(data)
+            writer.write(data, offset + done)
+            done += len(data)
+
+    def write_incremental(self, tlb_infos, binaries_path, sparse=False,
+                          jobs=1, binaries=None, hashes=False):
+        """
+        Used to rebuild a GPT/UEFI image written by a previous build. When the
+        image and its layout match the build manifest recorded next to it,
+        only the partitions whose binary changed are written, the GPT and the
+        other partitions are kept. Otherwise, the whole image is written.
+        With hashes, the hash records of the kept partitions are taken from
+        the previous hash manifest.
+        """
+        manifest = BuildManifest(self.path + BuildManifest.SUFFIX)
+        layout = BuildManifest.layout_hash(tlb_infos, self.size,
+                                           self.block_size)
+        previous = manifest.read()
+
+        # records the binaries, the hash of the unchanged ones is reused
+        inputs = {}
+        for tlb_part in tlb_infos:
+            bin_path = GPTImage.binary_path(tlb_part, binaries_path)
+            inputs[tlb_part.label] = manifest.record(
+                bin_path, previous['partitions'].get(tlb_part.label)
+                if previous else None)
+
+        if not manifest.matches(previous, layout, self.path):
+            info('No matching build of the GPT/UEFI image {0}, writing the'
+                 ' whole image'.format(self.path))
+            if isfile(self.path):
+                remove(self.path)
+            written = self.write(tlb_infos, binaries_path, sparse, jobs,
+                                 binaries, hashes)
+        else:
+            records = None
+            if hashes:
+                records = {}
+                hash_path = self.sidecar_path(HashManifest.SUFFIX)
+                if hash_path is not None and isfile(hash_path):
+                    records = dict((record['label'], record) for record
+                                   in HashManifest(hash_path).read())
+
+            changed = []
+            for tlb_part in tlb_infos:
+                old = previous['partitions'].get(tlb_part.label)
+                if not BuildManifest.same_input(old, inputs[tlb_part.label]):
+                    changed.append(tlb_part)
+
+            written = dict((label, record['length']) for label, record
+                           in previous['partitions'].items())
+            if changed:
+                info('Rewriting the partitions {0} of the GPT/UEFI image {1}'
+                     .format(' '.join(part.label for part in changed),
+                             self.path))
+                with open(self.path, 'rb+') as img_file:
+                    lengths = self._write_partitions(img_file, changed,
+                                                     binaries_path, sparse,
+                                                     jobs, binaries, records,
+                                                     punch=True)
+
+                    # clears what remains of the previous binaries
+                    for tlb_part in changed:
+                        offset = int(tlb_part.begin) * self.block_size
+                        old_length = written.get(tlb_part.label, 0)
+                        length = lengths[tlb_part.label]
+                        if old_length > length:
+                            zero_region(img_file.fileno(), offset + length,
+                                        old_length - length)
+                        written[tlb_part.label] = length
+            else:
+                info('The partitions of the GPT/UEFI image {0} are up to date'
+                     .format(self.path))
+
+            if hashes:
+                missing = [tlb_part.label for tlb_part in tlb_infos
+                           if tlb_part.label not in records]
+                if missing:
+                    info('No previous hash record of the partitions: {0}'
+                         .format(' '.join(missing)))
+                self._write_hashes(tlb_infos, records)
+
+        for label, record in inputs.items():
+            record['length'] = written.get(label, 0)
+        manifest.write(layout, self.path, inputs)
+
+        return written
+
+    def write_android_sparse(self, tlb_infos, binaries_path, binaries=None):
+        """
+        Used to write a new GPT/UEFI image as an Android sparse image, with
+        the same layout as the write method. The regions of the image are
+        written in order: the unwritten space is made of DONT_CARE chunks,
+        the zero blocks of the binaries of FILL chunks and their data of RAW
+        chunks.
+
+        Unlike the write method, which writes a zero Byte at the start of the
+        partitions without binary, these partitions are only DONT_CARE
+        chunks: a flashed device keeps their previous content, a zero FILL
+        chunk would make the flash write the whole partitions.
+        """
+        info('Launch the write of GPT/UEFI Android sparse image: {0}'
+             .format(self.path))
+
+        opened = binaries is None
+        if opened:
+            binaries = BinaryFiles()
+
+        try:
+            primary, backup = self._build_headers(tlb_infos)
+            backup_offset = self.gpt_header.lba_start * self.block_size
+            img_size = (self.gpt_header.lba_backup + 1) * self.block_size
+
+            parts = sorted(tlb_infos, key=lambda part: int(part.begin))
+
+            # uses the largest sparse block size aligned on all the regions
+            limits = [backup_offset, img_size]
+            for tlb_part in parts:
+                limits.append(int(tlb_part.begin) * self.block_size)
+                limits.append((int(tlb_part.begin) + int(tlb_part.size)) *
+                              self.block_size)
+            block_size = SparseImageWriter.BLOCK_SIZE
+            while block_size > self.block_size and \
+                    any(limit % block_size for limit in limits):
+                block_size //= 2
+            debug('Android sparse image block size: {0}'.format(block_size))
+
+            with open(self.path, 'wb') as img_file:
+                writer = SparseImageWriter(img_file, block_size, img_size)
+
+                info('Writing the MBR, the GPT Header and the primary '
+                     'partition table of the GPT/UEFI image: {0}'
+                     .format(self.path))
+                writer.write(primary)
+
+                info('Writing partitions of the GPT/UEFI image {0}'
+                     .format(self.path))
+                buf = bytearray(BinaryCopier._BUFFER_SIZE)
+                partitions_start = time()
+                total = 0
+                for tlb_part in parts:
+                    start = time()
+                    bin_path = GPTImage.binary_path(tlb_part, binaries_path)
+                    # the partition without binary is left as DONT_CARE
+                    # chunks, it isn't zeroed
+                    if bin_path == 'none':
+                        continue
+
+                    offset = int(tlb_part.begin) * self.block_size
+                    if offset < writer.tell():
+                        raise LayoutError('The partition {0} overlaps the '
+                                          'previous one'
+                                          .format(tlb_part.label))
+                    writer.seek(offset)
+
+                    bin_file, bin_img, _ = self._open_binary(tlb_part,
+                                                             bin_path,
+                                                             binaries)
+                    size = writer.write_binary(bin_file, bin_img, buf,
+                                               tlb_part.size * self.block_size)
+                    self.stats.partition(tlb_part.label, start, size)
+                    total += size
+                self.stats.phase('partitions', partitions_start, total)
+
+                info('Writing the secondary partition table and the GPT '
+                     'backup of the GPT/UEFI image: {0}'.format(self.path))
+                writer.seek(backup_offset)
+                writer.write(backup)
+                writer.close()
+
+                info('GPT/UEFI Android sparse image {0} created with {1} '
+                     'chunks !!!'.format(self.path, writer.total_chunks))
+        finally:
+            if opened:
+                binaries.close()
 
 
 def is_safe_path(basedir, path):
     return abspath(path).startswith(basedir)
 
+def is_zero(data):
+    """
+    Checks if a chunk of data only contains zero bytes
+    """
+    # bytes.startswith compares the zero chunk with any buffer with a
+    # memcmp, the slices of a memoryview aren't copied, unlike comparing
+    # bytes or a memoryview item by item
+    view = memoryview(data)
+    chunk_size = len(ZERO_CHUNK)
+    for pos in range(0, len(view), chunk_size):
+        if not ZERO_CHUNK.startswith(view[pos:pos + chunk_size]):
+            return False
+    return True
+
+def entry_name(entry):
+    """
+    Gives the name of a partition table entry
+    """
+    return entry.name.decode('utf-16le').rstrip('\x00')
+
+def hash_extent(img_map, offset, length, algorithms):
+    """
+    Hashes length Bytes at the offset of a mapped image, returns the hex
+    digest of each algorithm
+    """
+    hashes = [(name, hash_new(name)) for name in algorithms]
+    with memoryview(img_map) as view:
+        end = offset + length
+        for pos in range(offset, end, BinaryCopier._BUFFER_SIZE):
+            chunk = view[pos:min(pos + BinaryCopier._BUFFER_SIZE, end)]
+            for _, digest in hashes:
+                digest.update(chunk)
+            chunk.release()
+
+    return dict((name, digest.hexdigest()) for name, digest in hashes)
+
+def make_guid(namespace, name):
+    """
+    Gives the GUID of a name derived in the namespace, or a random GUID
+    without namespace
+    """
+    if namespace is None:
+        return str(uuid4())
+    return str(uuid5(namespace, name))
+
+def read_guid_namespace(value):
+    """
+    Gives the namespace of the deterministic GUIDs, a UUID or derived from a
+    seed, or None
+    """
+    if value is None:
+        return None
+    try:
+        return UUID(value)
+    except ValueError:
+        return uuid5(GUID_NAMESPACE, value)
+
+def data_extents(fd, length, start=0):
+    """
+    Gives the sorted extents of a file which contain data from start up to
+    length, the other ones are holes. The whole file is data if the holes
+    can't be found.
+    """
+    extents = []
+    offset = start
+    try:
+        while offset < length:
+            data = lseek(fd, offset, SEEK_DATA)
+            end = min(lseek(fd, data, SEEK_HOLE), length)
+            extents.append((data, end))
+            offset = end
+    except OSError as err:
+        # no more data after the offset
+        if err.errno == ENXIO:
+            return extents
+        if err.errno not in BinaryCopier._UNSUPPORTED:
+            raise
+        return [(start, length)]
+
+    return extents
+
+def in_extents(extents, start, end):
+    """
+    Checks if a region intersects the sorted extents
+    """
+    pos = bisect_right(extents, (start, float('inf')))
+    if pos and extents[pos - 1][1] > start:
+        return True
+    return pos < len(extents) and extents[pos][0] < end
+
+def diff_extents(img_map, offset, other_map, other_offset, start, end,
+                 block_size):
+    """
+    Compares the region of two mapped images at their offsets, from start to
+    end, returns the extents which differ at the block size granularity
+    """
+    if img_map[offset + start:offset + end] == \
+            other_map[other_offset + start:other_offset + end]:
+        return []
+
+    extents = []
+    for pos in range(start, end, BinaryCopier._SPARSE_CHUNK_SIZE):
+        chunk_end = min(pos + BinaryCopier._SPARSE_CHUNK_SIZE, end)
+        if img_map[offset + pos:offset + chunk_end] == \
+                other_map[other_offset + pos:other_offset + chunk_end]:
+            continue
+        for block in range(pos, chunk_end, block_size):
+            block_end = min(block + block_size, chunk_end)
+            if img_map[offset + block:offset + block_end] == \
+                    other_map[other_offset + block:other_offset + block_end]:
+                continue
+            if extents and extents[-1][1] == block:
+                extents[-1] = (extents[-1][0], block_end)
+            else:
+                extents.append((block, block_end))
+
+    return extents
+
+def fill_pattern(pattern, length):
+    """
+    Gives a pattern repeated on length Bytes, up to the size of the fill
+    buffer, a buffer shorter than the pattern keeps its first Bytes
+    """
+    size = min(length, SparseImage._FILL_SIZE)
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+def hash_fill(digests, pattern, length):
+    """
+    Hashes length Bytes filled with a pattern, written or left as holes
+    without being read
+    """
+    if not digests:
+        return
+
+    fill = fill_pattern(pattern, length)
+    done = 0
+    while done < length:
+        size = min(len(fill), length - done)
+        for digest in digests:
+            digest.update(fill[:size])
+        done += size
+
+def write_all(fd, data, offset):
+    """
+    Writes all the data at the offset of a file descriptor, pwrite may only
+    write a part of it. Returns the number of pwrite calls
+    """
+    calls = 0
+    view = memoryview(data)
+    while view:
+        size = pwrite(fd, view, offset)
+        view = view[size:]
+        offset += size
+        calls += 1
+    return calls
+
+
+def write_zero(fd, offset, length):
+    """
+    Writes length zero Bytes at the offset of a file descriptor. Returns the
+    number of pwrite calls
+    """
+    calls = 0
+    done = 0
+    while done < length:
+        size = min(len(ZERO_CHUNK), length - done)
+        calls += write_all(fd, ZERO_CHUNK[:size], offset + done)
+        done += size
+    return calls
+
+def zero_region(fd, offset, length):
+    """
+    Zeroes length Bytes at the offset of a file descriptor which may hold
+    data, a hole is punched if the file supports it, else zeros are written
+    """
+    if length <= 0:
+        return
+
+    if libc is not None:
+        mode = FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE
+        if libc.fallocate64(fd, mode, offset, length) == 0:
+            return
+        err = get_errno()
+        if err not in BinaryCopier._UNSUPPORTED:
+            raise OSError(err, strerror(err))
+
+    write_zero(fd, offset, length)
+
+def create_image(path, table, size, sources, block_size=512, jobs=1,
+                 sparse=False, hashes=False, guid_namespace=None, cache=None,
+                 binaries=None, stats=False):
+    """
+    Creates a GPT/UEFI image, used to build images from a Python program
+    without a process per image. It raises a GPTImageError instead of
+    exiting, and several images can be created concurrently.
+
+    The partitions layout is read from the table, the path of a TLB partition
+    file or TLB information parsed once and derived for each image. The size
+    is given in Bytes or with a unit, like '5G'. The sources give the binary
+    file of a partition by its label: a path, a file object or a callable
+    giving one of them once the partition is written. The other partitions
+    are left empty. The GUIDs are derived in guid_namespace, a UUID or a
+    seed, if it's given. The layouts are shared through the layout cache and
+    the opened binary files through the binary files, if they're given.
+    With stats, the statistics of the write are written next to the image.
+
+    Returns the number of Bytes written in each partition.
+    """
+    if isinstance(size, int):
+        size = '{0}B'.format(size)
+    if guid_namespace is not None and not isinstance(guid_namespace, UUID):
+        guid_namespace = read_guid_namespace(guid_namespace)
+
+    gpt_img = GPTImage(path, size, block_size, guid_namespace=guid_namespace)
+
+    if isinstance(table, TLBInfos):
+        tlb_infos = table.derive()
+        tlb_infos.namespace = guid_namespace
+    else:
+        tlb_infos = TLBInfos(table, namespace=guid_namespace)
+    read_layout(tlb_infos, gpt_img, cache)
+
+    written = gpt_img.write(tlb_infos, sources, sparse, jobs, binaries, hashes)
+    if stats:
+        gpt_img.write_stats()
+
+    return written
+
+def read_flashfiles(cmdargs):
+    """
+    Gives the paths of the files of the flashfiles, a zip archive or a
+    directory, by name. The files of an archive are its members.
+    """
+    if not cmdargs.flashfiles:
+        return {}
+
+    flashfiles_path = realpath(normpath(normcase(cmdargs.flashfiles)))
+    if isdir(flashfiles_path):
+        names = [name for name in listdir(flashfiles_path)
+                 if isfile(join(flashfiles_path, name))]
+    elif isfile(flashfiles_path) and is_zipfile(flashfiles_path):
+        with ZipFile(flashfiles_path) as zip_file:
+            names = [name for name in zip_file.namelist()
+                     if '/' not in name]
+    else:
+        raise BinaryError('The flashfiles is not a zip archive or a '
+                          'directory: {0}'.format(flashfiles_path))
+
+    return dict((name, join(flashfiles_path, name)) for name in names)
+
+def read_binaries_path(cmdargs):
+    """
+    Gives the path of the binary file used to write each partition, or none
+    """
+    binaries_path = {}
+    flashfiles = read_flashfiles(cmdargs)
+    for label in GPTImage.ANDROID_PARTITIONS:
+
+        # if the binary file is undefined, the one of the flashfiles is used
+        bin_path = getattr(cmdargs, label)
+        if bin_path == 'none' and '{0}.img'.format(label) in flashfiles:
+            bin_path = flashfiles['{0}.img'.format(label)]
+            debug('Partition {0} uses this binary file of the flashfiles: {1}'
+                  .format(label, bin_path))
+            binaries_path[label] = bin_path
+            continue
+
+        if bin_path == 'none':
+            debug('Partition {0} doesn\'t use a binary file'.format(label))
+            binaries_path[label] = bin_path
+            continue
+
+        # check if binary file exist, it may be a member of a zip archive
+        norm_bin_path = realpath(normpath(normcase(bin_path)))
+        if not isfile(norm_bin_path) and not ZipMember.split(norm_bin_path):
+            raise BinaryError('The binary used to create the partition "{0}" '
+                              'is invalid: {1}'.format(label, norm_bin_path))
+
+        debug('Partition {0} uses this binary file: {1}'
+              .format(label, norm_bin_path))
+        binaries_path[label] = norm_bin_path
+
+    return binaries_path
+
+def read_resized_label(cmdargs, block_size):
+    """
+    Gives the label of the partition resized with the image, the only one of
+    size -1 in the TLB partition file, the one of the flashfiles by default
+    """
+    tlb_path = cmdargs.table
+    if tlb_path is None:
+        tlb_path = read_flashfiles(cmdargs).get('gpt.ini')
+    if tlb_path is None:
+        raise LayoutError('The partition table file is needed to find the '
+                          'partition to resize')
+
+    tlb_infos = TLBInfos(realpath(normpath(normcase(tlb_path))))
+    tlb_infos.read(block_size)
+    labels = [entry.label for entry in tlb_infos if entry.size < 0]
+    if len(labels) != 1:
+        raise LayoutError('The TLB partition file {0} must have one '
+                          'partition of size -1 to resize, not {1}'
+                          .format(tlb_infos.path, len(labels)))
+
+    return labels[0]
+
+def read_layout(tlb_infos, gpt_img, cache=None):
+    """
+    Reads the TLB information and computes the partitions layout of an
+    image, or loads it from the layout cache if given
+    """
+    start = time()
+    key = None
+    layout = None
+    if cache is not None:
+        key = LayoutCache.key(tlb_infos, gpt_img)
+        layout = cache.load(key)
+
+    if layout is not None:
+        debug('Using the cached layout {0} of {1}'
+              .format(key, tlb_infos.path))
+        tlb_infos.extend(TLB_INFO(begin, size, ptype,
+                                  make_guid(tlb_infos.namespace, label),
+                                  label)
+                         for begin, size, ptype, label in layout)
+    else:
+        tlb_infos.read(gpt_img.block_size)
+
+        # computes the size of last entry, its size may be undefined
+        tlb_infos.compute_last_size_entry(gpt_img.size,
+                                          gpt_img.block_size,
+                                          gpt_img.gpt_header.entry_size,
+                                          gpt_img.gpt_header.table_length
+                                          )
+        if cache is not None and tlb_infos:
+            cache.store(key, tlb_infos)
+
+    # checks if the TLB partition file read contains valid information
+    if not tlb_infos:
+        raise LayoutError('The partition table contains invalid value(s): {0}'
+                          .format(tlb_infos.path))
+
+    # prints TLB information read
+    debug(tlb_infos)
+    gpt_img.stats.phase('layout', start)
+
+def write_image(gpt_img, tlb_infos, binaries_path, cmdargs, binaries=None):
+    """
+    Writes a GPT/UEFI image with the options of the command line
+    """
+    # the statistics of a block device need the sidecar directory, it's
+    # checked before the write
+    if cmdargs.stats:
+        gpt_img.sidecar_path(BuildStats.SUFFIX, True)
+
+    # writes the GPT/UEFI image as an Android sparse image
+    if cmdargs.android_sparse:
+        if cmdargs.incremental or cmdargs.tee or cmdargs.hash_manifest:
+            raise GPTImageError('An Android sparse image can\'t be rebuilt '
+                                'incrementally, written in several '
+                                'destinations or hashed')
+        gpt_img.write_android_sparse(tlb_infos, binaries_path, binaries)
+
+    # writes the same GPT/UEFI image in several destinations
+    elif cmdargs.tee:
+        if cmdargs.incremental:
+            raise GPTImageError('A GPT/UEFI image written in several '
+                                'destinations can\'t be rebuilt incrementally')
+        tee = [realpath(normpath(normcase(path))) for path in cmdargs.tee]
+        gpt_img.write_tee(tlb_infos, binaries_path, tee, cmdargs.sparse,
+                          binaries, cmdargs.hash_manifest)
+
+    # writes the GPT/UEFI image directly in a block device
+    elif BlockDevice.is_block_device(gpt_img.path):
+        if cmdargs.incremental:
+            raise GPTImageError('A GPT/UEFI image written in a block device '
+                                'can\'t be rebuilt incrementally')
+        gpt_img.write_device(tlb_infos, binaries_path, cmdargs.jobs, binaries,
+                             cmdargs.hash_manifest)
+
+    # rebuilds the GPT/UEFI image from the previous one
+    elif cmdargs.incremental:
+        gpt_img.write_incremental(tlb_infos, binaries_path, cmdargs.sparse,
+                                  cmdargs.jobs, binaries,
+                                  cmdargs.hash_manifest)
+
+    else:
+        # removes the GTP image, if it already exists
+        if isfile(gpt_img.path):
+            info('Deleting the GPT/UEFI image previous created: {0}'
+                 .format(gpt_img.path))
+            remove(gpt_img.path)
+
+        # calls function to write new GPT/UEFI image
+        gpt_img.write(tlb_infos, binaries_path, cmdargs.sparse, cmdargs.jobs,
+                      binaries, cmdargs.hash_manifest)
+
+    # reports the time spent in each phase of the write
+    if cmdargs.stats:
+        gpt_img.write_stats()
+
+def read_batch(batch_path):
+    """
+    Reads a batch specification file, a JSON file with the list of images to
+    write from the same TLB partition file:
+
+    {
+        "images": [
+            {
+                "output": "vm_ro.img",
+                "size": "32G",
+                "exclude": ["teedata", "data"]
+            },
+            {
+                "output": "vm_rw.img",
+                "size": "64G",
+                "include": ["teedata", "data"],
+                "overrides": {"data": {"len": -1}}
+            }
+        ]
+    }
+
+    The image size defaults to the --size option. The included or excluded
+    partitions and the overridden options use the partition names of the
+    TLB partition file.
+    """
+    try:
+        with open(batch_path, 'r') as batch_file:
+            images = load(batch_file)['images']
+    except (IOError, ValueError, KeyError, TypeError) as err:
+        raise GPTImageError('Invalid batch specification file {0}: {1}'
+                            .format(batch_path, err))
+
+    keys = set(('output', 'size', 'include', 'exclude', 'overrides'))
+    for spec in images:
+        if not isinstance(spec, dict) or 'output' not in spec or \
+                not keys.issuperset(spec):
+            raise GPTImageError('Invalid image in batch specification file '
+                                '{0}: {1}'.format(batch_path, spec))
+
+    return images
+
+def read_layout_cache(cmdargs):
+    """
+    Gives the layout cache of the command line, or None
+    """
+    if not cmdargs.layout_cache:
+        return None
+    return LayoutCache(realpath(normpath(normcase(cmdargs.layout_cache))))
+
+def read_sidecar_dir(cmdargs):
+    """
+    Gives the sidecar directory of the command line, or None
+    """
+    if not cmdargs.sidecar_dir:
+        return None
+    return realpath(normpath(normcase(cmdargs.sidecar_dir)))
+
+def write_batch(batch_path, tlb_infos, binaries_path, cmdargs):
+    """
+    Writes concurrently all the GPT/UEFI images of a batch specification
+    file. The TLB partition file is parsed once and the binary files are
+    opened once for all the images.
+    """
+    images = read_batch(batch_path)
+    cache = read_layout_cache(cmdargs)
+
+    gpt_imgs = []
+    for spec in images:
+        img_path = realpath(normpath(normcase(spec['output'])))
+        gpt_img = GPTImage(img_path, spec.get('size', cmdargs.size),
+                           cmdargs.block, guid_namespace=tlb_infos.namespace,
+                           sidecar_dir=read_sidecar_dir(cmdargs))
+
+        info('Computing the layout of the GPT/UEFI image {0}'.format(img_path))
+        img_tlb_infos = tlb_infos.derive(spec.get('include'),
+                                         spec.get('exclude'),
+                                         spec.get('overrides'))
+        read_layout(img_tlb_infos, gpt_img, cache)
+        gpt_imgs.append((gpt_img, img_tlb_infos))
+
+    binaries = BinaryFiles()
+    try:
+        with ThreadPoolExecutor(max_workers=len(gpt_imgs)) as pool:
+            futures = [pool.submit(write_image, gpt_img, img_tlb_infos,
+                                   binaries_path, cmdargs, binaries)
+                       for gpt_img, img_tlb_infos in gpt_imgs]
+            for future in futures:
+                future.result()
+    finally:
+        binaries.close()
+
+    info('{0} GPT/UEFI images written from the batch specification file {1}'
+         .format(len(gpt_imgs), batch_path))
+
 def usage():
     """
     Used to make main args parser and helper
@@ -1135,7 +4993,8 @@ def usage():
 
     # command line option used to specify the GPT/UEFI image filename
     cmdparser.add_argument('FILE', type=str, help=('The path of GPT/UEFI '
-                                                   'image.'))
+                                                   'image, or of the batch '
+                                                   'specification file.'))
 
     cmds_group = cmdparser.add_mutually_exclusive_group()
 
@@ -1146,6 +5005,42 @@ def usage():
     # command line option used to create a GPT/UEFI image
     cmds_group.add_argument('--create', action='store_true',
                             help='Command to create a new GPT/UEFI image.')
+
+    # command line option used to create several GPT/UEFI images
+    cmds_group.add_argument('--batch', action='store_true',
+                            help=('Command to create the GPT/UEFI images '
+                                  'listed in the batch specification file '
+                                  'given as FILE.'))
+
+    # command line option used to verify the integrity of a GPT/UEFI image
+    cmds_group.add_argument('--verify', action='store_true',
+                            help=('Command to verify the CRC32, the backup '
+                                  'and the partition entries of a GPT/UEFI '
+                                  'image.'))
+
+    # command line option used to extract the partitions of a GPT/UEFI image
+    cmds_group.add_argument('--extract', action='store', metavar='DIR',
+                            help=('Command to extract the partitions of a '
+                                  'GPT/UEFI image in the directory DIR.'))
+
+    # command line option used to replace the binary of a partition
+    cmds_group.add_argument('--update', action='append',
+                            metavar='LABEL=PATH',
+                            help=('Command to replace in place the binary of '
+                                  'the partition LABEL of a GPT/UEFI image, '
+                                  'may be repeated.'))
+
+    # command line option used to resize a GPT/UEFI image
+    cmds_group.add_argument('--resize', action='store', metavar='SIZE',
+                            help=('Command to resize in place a GPT/UEFI '
+                                  'image, its partition of size -1 in the '
+                                  'partition table file is resized.'))
+
+    # command line option used to compare two GPT/UEFI images
+    cmds_group.add_argument('--diff', action='store', metavar='OTHER',
+                            help=('Command to compare a GPT/UEFI image with '
+                                  'the OTHER one, exits with 1 when they '
+                                  'differ.'))
     create_group = cmdparser.add_argument_group('create')
 
     # command line option to print debug information
@@ -1166,6 +5061,103 @@ def usage():
                               help=('the size of the GPT/UEFI image in Bytes '
                                     '[default: 5G]'))
 
+    # command line option used to write the image as a sparse file
+    create_group.add_argument('--sparse', action='store_true',
+                              help=('Write the GPT/UEFI image as a sparse '
+                                    'file, the unused and zero regions are '
+                                    'left as holes.'))
+
+    # command line option used to specify the number of partitions written
+    # in parallel
+    create_group.add_argument('-j', '--jobs', action='store', type=int,
+                              default=1, help=('The number of partitions '
+                                               'written or verified in '
+                                               'parallel [default=1].'))
+
+    # command line option used to rebuild only the partitions which changed
+    create_group.add_argument('--incremental', action='store_true',
+                              help=('Only rewrite the partitions whose binary'
+                                    ' changed since the previous build of the'
+                                    ' image, recorded in a manifest next to '
+                                    'it.'))
+
+    # command line option used to write an Android sparse image
+    create_group.add_argument('--android-sparse', action='store_true',
+                              help=('Write the GPT/UEFI image, or the '
+                                    'extracted partitions, as Android sparse '
+                                    'images.'))
+
+    # command line option used to take the binaries from the flashfiles
+    create_group.add_argument('--flashfiles', action='store',
+                              metavar='ZIP|DIR',
+                              help=('Flashfiles zip archive or directory: the '
+                                    'partitions without binary file use its '
+                                    '<label>.img, read directly from the '
+                                    'archive, and its gpt.ini is the default '
+                                    'partition table file.'))
+
+    # command line option used to cache the partitions layouts
+    create_group.add_argument('--layout-cache', action='store', metavar='DIR',
+                              help=('Cache the partitions layouts computed '
+                                    'from the partition table file in this '
+                                    'directory, shared by the builds.'))
+
+    # command line option used to derive the GUIDs instead of random ones
+    create_group.add_argument('--guid-namespace', action='store',
+                              metavar='UUID|SEED',
+                              help=('Derive the disk and partition GUIDs '
+                                    'from the layout and the labels in this '
+                                    'namespace, a UUID or a seed, so the '
+                                    'same inputs give the same image.'))
+
+    # command line option used to write the same image in other destinations
+    create_group.add_argument('--tee', action='append', metavar='PATH',
+                              help=('Also write the GPT/UEFI image in this '
+                                    'file or device, may be repeated.'))
+
+    # command line option used to hash the partitions while they are written
+    create_group.add_argument('--hash-manifest', action='store_true',
+                              help=('Hash the partitions while they are '
+                                    'written and write their hash manifest '
+                                    'next to the image.'))
+
+    # command line option used to report the statistics of the write
+    create_group.add_argument('--stats', action='store_true',
+                              help=('Log the time and the Bytes of each phase '
+                                    'and partition of the write, the system '
+                                    'calls of the copies and the peak RSS, '
+                                    'and write them in a JSON file next to '
+                                    'the image.'))
+
+    # command line option used to write the files of the image elsewhere
+    cmdparser.add_argument('--sidecar-dir', action='store', metavar='DIR',
+                           help=('The directory of the hash manifest and of '
+                                 'the statistics of the image [default: next '
+                                 'to the image], needed for a block device.'))
+
+    verify_group = cmdparser.add_argument_group('verify')
+
+    # command line option used to give the expected hashes of the partitions
+    verify_group.add_argument('--hashes', action='store', metavar='MANIFEST',
+                              help=('The hash manifest of the partitions '
+                                    'compared with the partitions of the '
+                                    'verified image [default: the one '
+                                    'written next to the image].'))
+
+    extract_group = cmdparser.add_argument_group('extract')
+
+    # command line option used to extract only some partitions
+    extract_group.add_argument('--partition', action='append', metavar='LABEL',
+                               help=('Only extract this partition, may be '
+                                     'repeated.'))
+
+    update_group = cmdparser.add_argument_group('update')
+
+    # command line option used to zero the partition after its new binary
+    update_group.add_argument('--zero-tail', action='store_true',
+                              help=('Zero the end of the updated partitions '
+                                    'after their new binary.'))
+
     # command line option used to specify binary filename used to wrote
     # partitions of new image file
     for item in GPTImage.ANDROID_PARTITIONS:
@@ -1203,87 +5195,103 @@ def main():
         error('Invalid block size value: {0} Octets'.format(block_size))
         exit(-1)
 
+    # checks if the number of jobs is valid
+    if cmdargs.jobs <= 0:
+        error('Invalid number of jobs: {0}'.format(cmdargs.jobs))
+        exit(-1)
+
     # normalizes the path of GPT/UEFI image
     img_path = realpath(normpath(normcase(cmdargs.FILE)))
 
     # checks the image size value
     img_size = cmdargs.size
 
+    # the size and the block size of a block device are the ones of the device
+    if BlockDevice.is_block_device(img_path):
+        device = BlockDevice(img_path)
+        img_size = '{0}B'.format(device.size)
+        if block_size != device.logical_block_size:
+            info('Using the logical block size of the block device {0}: {1} '
+                 'Bytes'.format(img_path, device.logical_block_size))
+            block_size = device.logical_block_size
+
     # create an instance of GPTImage with the GPT/UEFI image path and the block
     # size value
-    gpt_img = GPTImage(img_path, img_size, block_size)
+    guid_namespace = read_guid_namespace(cmdargs.guid_namespace)
+    gpt_img = GPTImage(img_path, img_size, block_size,
+                       guid_namespace=guid_namespace,
+                       sidecar_dir=read_sidecar_dir(cmdargs))
 
     # processes the command to create and to write GPT/UEFI image through a TBL
     # partition file and binary filenames
-    if cmdargs.create:
+    if cmdargs.create or cmdargs.batch:
+
+        if cmdargs.create:
+            info('The GPT/UEFI image size: {0}'.format(img_size))
 
-        info('The GPT/UEFI image size: {0}'.format(img_size))
+        # the TBL partition file is the one of the flashfiles by default
+        tlb_path = cmdargs.table
+        if tlb_path is None:
+            tlb_path = read_flashfiles(cmdargs).get('gpt.ini')
+        if tlb_path is None:
+            error('The partition table file is missing')
+            exit(-1)
 
         # normalizes and check if the path of TBL partition file is valid
-        tlb_path = realpath(normpath(normcase(cmdargs.table)))
-        if not isfile(tlb_path):
+        tlb_path = realpath(normpath(normcase(tlb_path)))
+        if not isfile(tlb_path) and not ZipMember.split(tlb_path):
             error('The path of partition table is invalid: {0}'
                   .format(tlb_path))
             exit(-1)
 
         # reads the TLB partition file
-        tlb_infos = TLBInfos(tlb_path)
+        tlb_infos = TLBInfos(tlb_path, namespace=guid_namespace)
         info('Reading the partition file {0} of type {1}'
              .format(tlb_infos.path, tlb_infos.format))
-        tlb_infos.read(gpt_img.block_size)
-
-        # computes the size of last entry, its size may be undefined
-        tlb_infos.compute_last_size_entry(gpt_img.size,
-                                          gpt_img.block_size,
-                                          gpt_img.gpt_header.entry_size,
-                                          gpt_img.gpt_header.table_length
-                                          )
-
-        # checks if the TLB partition file read contains valid information
-        if not tlb_infos:
-            error('The partition table contains invalid value(s): {0}'
-                  .format(tlb_path))
-            exit(-1)
-
-        # prints TLB information read
-        debug(tlb_infos)
 
         # creates the list of necessary binaries used to wrote GPT/UEFI image
-        binaries_path = {}
-        for label in GPTImage.ANDROID_PARTITIONS:
-
-            # if the binary file is undefined
-            bin_path = getattr(cmdargs, label)
-            if bin_path == 'none':
-                debug('Partition {0} doesn\'t use a binary file'.format(label))
-                binaries_path[label] = bin_path
-                continue
+        binaries_path = read_binaries_path(cmdargs)
 
-            # check if binary file exist
-            norm_bin_path = realpath(normpath(normcase(bin_path)))
-            if not isfile(norm_bin_path):
-                error('The binary used to create the partition "{0}" is '
-                      'invalid: {1}'.format(label, norm_bin_path))
-                exit(-1)
+        # writes all the GPT/UEFI images of the batch specification file
+        if cmdargs.batch:
+            write_batch(img_path, tlb_infos, binaries_path, cmdargs)
+            exit(0)
 
-            debug('Partition {0} uses this binary file: {1}'
-                  .format(label, norm_bin_path))
-            binaries_path[label] = norm_bin_path
+        read_layout(tlb_infos, gpt_img, read_layout_cache(cmdargs))
 
-        # removes the GTP image, if it already exists
-        if isfile(img_path):
-            info('Deleting the GPT/UEFI image previous created: {0}'
-                 .format(img_path))
-            remove(img_path)
+        # writes the GPT/UEFI image
+        write_image(gpt_img, tlb_infos, binaries_path, cmdargs)
 
-        # calls function to write new GPT/UEFI image
-        gpt_img.write(tlb_infos, binaries_path)
+        # an Android sparse image can't be read as a GPT/UEFI image
+        if cmdargs.android_sparse:
+            exit(0)
 
     # checks if the GPT/UEFI image exists
-    if not isfile(img_path):
+    if not isfile(img_path) and not BlockDevice.is_block_device(img_path):
         error('GPT/UEFI image not found: {0}'.format(img_path))
         exit(-1)
 
+    # verifies the integrity of the GPT/UEFI image
+    if cmdargs.verify:
+        hashes = None
+        hash_path = cmdargs.hashes or \
+            gpt_img.sidecar_path(HashManifest.SUFFIX)
+        if cmdargs.hashes or (hash_path is not None and isfile(hash_path)):
+            info('Comparing the partitions with the hash manifest: {0}'
+                 .format(hash_path))
+            hashes = HashManifest(hash_path).read()
+
+        problems = gpt_img.verify(hashes, cmdargs.jobs)
+        for problem in problems:
+            error(problem)
+        if problems:
+            error('GPT/UEFI image {0} is invalid: {1} problem(s)'
+                  .format(img_path, len(problems)))
+            exit(-1)
+
+        info('GPT/UEFI image {0} verified successfully'.format(img_path))
+        exit(0)
+
     # reads the GPT/UEFI image to check it's valid, it uses CRC32
     gpt_img.read()
 
@@ -1291,7 +5299,59 @@ def main():
     if cmdargs.show:
         print(gpt_img)
 
+    # resizes the GPT/UEFI image
+    if cmdargs.resize:
+        gpt_img.resize(cmdargs.resize,
+                       read_resized_label(cmdargs, gpt_img.block_size))
+
+    # replaces the binaries of partitions of the GPT/UEFI image
+    if cmdargs.update:
+        updates = {}
+        for update in cmdargs.update:
+            label, sep, bin_path = update.partition('=')
+            norm_bin_path = realpath(normpath(normcase(bin_path)))
+            if not sep or not (isfile(norm_bin_path) or
+                               ZipMember.split(norm_bin_path)):
+                error('Invalid partition update: {0}'.format(update))
+                exit(-1)
+            updates[label] = norm_bin_path
+
+        gpt_img.update(updates, cmdargs.jobs, cmdargs.zero_tail)
+
+    # compares the GPT/UEFI image with another one
+    if cmdargs.diff:
+        other_path = realpath(normpath(normcase(cmdargs.diff)))
+        if not isfile(other_path) and \
+                not BlockDevice.is_block_device(other_path):
+            error('GPT/UEFI image not found: {0}'.format(other_path))
+            exit(-1)
+        other_img = GPTImage(other_path, img_size, block_size)
+        other_img.read()
+
+        differences, partitions = gpt_img.diff(other_img, cmdargs.jobs)
+        for difference in differences:
+            print(difference)
+        for label, extents in partitions.items():
+            print('Partition {0}: {1} Bytes differ in {2} extent(s)'
+                  .format(label, sum(end - start for start, end in extents),
+                          len(extents)))
+            for start, end in extents[:GPTImage._DIFF_MAX_EXTENTS]:
+                print('\t0x{0:x}-0x{1:x}'.format(start, end))
+            if len(extents) > GPTImage._DIFF_MAX_EXTENTS:
+                print('\t...')
+        exit(1 if differences or partitions else 0)
+
+    # extracts the partitions of the GPT/UEFI image
+    if cmdargs.extract:
+        out_dir = realpath(normpath(normcase(cmdargs.extract)))
+        gpt_img.extract(out_dir, cmdargs.partition, cmdargs.jobs,
+                        cmdargs.android_sparse)
+
     exit(0)
 
 if __name__ == '__main__':
+    try:
         main()
+    except GPTImageError as err:
+        error(err)
+        exit(-1)
@@ -37,17 +37,13 @@ esac
 mkfs.ext4 $VM_RO_IMG -F
 mkfs.ext4 $VM1_RW_IMG -F
 mkfs.ext4 $VM2_RW_IMG -F
+# the partitions are written straight from the flashfiles zip, only
+# gpt.ini is extracted, with 7z like the other flash scripts
 TEMP_DIR=$(mktemp -d)
-pushd $TEMP_DIR
-7z x $ZIP_FILE
-simg2img super.img super.img.raw
-mv super.img.raw super.img
-simg2img config.img config.img.raw
-mv config.img.raw config.img
-popd
+7z e -so $ZIP_FILE gpt.ini >$TEMP_DIR/gpt.ini 2>/dev/null || rm -f $TEMP_DIR/gpt.ini
 
 GPT_INI=/home/root/android-flashtool/gpt.ini
-if [ -f $TEMP_DIR/gpt.ini ]; then
+if [ -s $TEMP_DIR/gpt.ini ]; then
 	GPT_INI=$TEMP_DIR/gpt.ini
 	echo "Use gpt.ini in flashfiles: $GPT_INI"
 elif [ -f $GPT_INI ]; then
@@ -62,8 +58,7 @@ sed -e '/partitions =/s/teedata //g' $GPT_INI >$TEMP_INI
 sed -e '/partitions =/s/share_data//g' -e '/partitions =/s/metadata //g' -e '/partitions =/s/persistent //g' -e '/partitions =/s/data //g' -i $TEMP_INI
 SIZE_GB=$(fdisk -l $VM_RO_IMG | grep Disk | awk '{print $3}')
 SIZE_GB=$(awk "BEGIN {print int($SIZE_GB)}")
-python3 ./gpt_ini2bin.py $TEMP_INI > ${TEMP_DIR}/gpt.bin
-python3 ./create_gpt_image.py --create $VM_RO_IMG --size=${SIZE_GB}G --flashfiles $TEMP_DIR
+python3 ./create_gpt_image.py --create $VM_RO_IMG --size=${SIZE_GB}G --table $TEMP_INI --flashfiles $ZIP_FILE
 
 cp $GPT_INI $TEMP_INI
 sed -e '/partitions =/s/bootloader //g' -e '/partitions =/s/boot //g' -e '/partitions =/s/misc //g' -i $TEMP_INI
@@ -75,13 +70,11 @@ sed -e 's/len = 128000/len = -1/' -i $TEMP_INI #vm1/2 only
 
 SIZE_GB=$(fdisk -l $VM1_RW_IMG | grep Disk | awk '{print $3}')
 SIZE_GB=$(awk "BEGIN {print int($SIZE_GB)}")
-python3 ./gpt_ini2bin.py $TEMP_INI > ${TEMP_DIR}/gpt.bin
-python3 ./create_gpt_image.py --create $VM1_RW_IMG --size=${SIZE_GB}G --flashfiles $TEMP_DIR
+python3 ./create_gpt_image.py --create $VM1_RW_IMG --size=${SIZE_GB}G --table $TEMP_INI --flashfiles $ZIP_FILE
 
 SIZE_GB=$(fdisk -l $VM2_RW_IMG | grep Disk | awk '{print $3}')
 SIZE_GB=$(awk "BEGIN {print int($SIZE_GB)}")
-python3 ./gpt_ini2bin.py $TEMP_INI > ${TEMP_DIR}/gpt.bin
-python3 ./create_gpt_image.py --create $VM2_RW_IMG --size=${SIZE_GB}G --flashfiles $TEMP_DIR
+python3 ./create_gpt_image.py --create $VM2_RW_IMG --size=${SIZE_GB}G --table $TEMP_INI --flashfiles $ZIP_FILE
 
 rm -rf ${TEMP_DIR}/*
 sync
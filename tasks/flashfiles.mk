@@ -148,8 +148,6 @@ $(gpt_name):$(BUILT_RELEASE_FLASH_FILES_PACKAGE)
 	rm -rf $(GPT_DIR)
 	mkdir -p $(GPT_DIR)
 	unzip $< -d $(GPT_DIR)
-	$(SIMG2IMG) $(GPT_DIR)/super.img $(GPT_DIR)/super.img.raw
-	$(SIMG2IMG) $(GPT_DIR)/config.img $(GPT_DIR)/config.img.raw
 
 	$(INTEL_PATH_BUILD)/create_gpt_image.py \
 		--create $@ \
@@ -160,11 +158,11 @@ $(gpt_name):$(BUILT_RELEASE_FLASH_FILES_PACKAGE)
 		--tos $(tos_image) \
 		--boot $(GPT_DIR)/boot.img \
 		--vbmeta $(GPT_DIR)/vbmeta.img \
-		--super $(GPT_DIR)/super.img.raw \
+		--super $(GPT_DIR)/super.img \
 		--acpio  $(GPT_DIR)/acpio.img \
 		--vendor_boot $(GPT_DIR)/vendor_boot.img \
 		--init_boot $(GPT_DIR)/init_boot.img \
-		--config $(GPT_DIR)/config.img.raw
+		--config $(GPT_DIR)/config.img
 	$(hide) rm -f $@.gz
 	$(hide) gzip -f $@
 	$(hide) rm -rf $(GPT_DIR)
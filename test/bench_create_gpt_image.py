@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+
+# Copyright (c) 2026, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+
+"""
+Benchmark of create_gpt_image.py.
+
+Generates synthetic partition table files and binaries, then times the
+parsing of the layout, the creation, the show and the verification of the
+GPT/UEFI images for each layout, payload, image size and block size. The
+results are written in a JSON report, to be compared with the report of a
+previous release with --baseline.
+
+Layouts:
+  - few: a few partitions, the last one grows with len = -1,
+  - ab: A/B slots, only the slot A is written,
+  - many: 128 partitions,
+  - grow: several len = -1 partitions sharing the space by weight.
+
+Payloads, the binaries written in the partitions:
+  - dense: random data,
+  - zero: mostly zero data, written in full,
+  - sparse: a sparse file, mostly holes,
+  - android: an Android sparse image of RAW, FILL and DONT_CARE chunks.
+"""
+
+import sys
+import os
+import platform
+import struct
+from argparse import ArgumentParser
+from json import dump, load
+from logging import getLogger, WARNING, basicConfig
+from random import Random
+from shutil import rmtree
+from statistics import median
+from subprocess import check_output, CalledProcessError
+from tempfile import mkdtemp
+from time import perf_counter, strftime, gmtime
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+
+from create_gpt_image import (GPTImage, TLBInfos, HashManifest, BuildStats,
+                              GPTImageError, LayoutError, create_image,
+                              read_layout)
+
+REPORT_VERSION = 1
+
+LAYOUTS = ('few', 'ab', 'many', 'grow')
+
+PAYLOADS = ('dense', 'zero', 'sparse', 'android')
+
+# the Android sparse images use 4 KiB blocks
+SIMG_BLOCK_SIZE = 4096
+
+# a mostly zero or sparse payload holds this much data per MiB
+DATA_PER_MIB = 64 * 1024
+
+MIB = 1024 * 1024
+
+
+def make_layout(name, payload_mib):
+    """
+    Gives the partition table file of a layout and the labels of the
+    partitions written with the payload, they fit payload_mib MiB
+    """
+    size = payload_mib + 1
+    base = ['[base]']
+    parts = []
+
+    if name == 'few':
+        labels = ['boot', 'system', 'vendor']
+        parts = [(label, size, {}) for label in labels]
+        parts.append(('misc', 1, {}))
+        parts.append(('data', -1, {}))
+    elif name == 'ab':
+        labels = ['boot', 'system', 'vendor', 'vbmeta']
+        base.append('nb_slot = 2')
+        parts = [(label, size, {'has_slot': 'true'}) for label in labels]
+        parts.append(('misc', 1, {}))
+        parts.append(('data', -1, {}))
+    elif name == 'many':
+        labels = ['part{0:03d}'.format(index) for index in range(8)]
+        parts = [(label, size, {}) for label in labels]
+        parts.extend(('part{0:03d}'.format(index), 1, {})
+                     for index in range(len(labels), 127))
+        parts.append(('data', -1, {}))
+    elif name == 'grow':
+        labels = ['boot', 'system']
+        base.append('align = 1024')
+        parts = [(label, size, {}) for label in labels]
+        parts.append(('cache', -1, {'weight': '1'}))
+        parts.append(('userdata', -1, {'weight': '3'}))
+        parts.append(('data', -1, {'weight': '1'}))
+    else:
+        raise ValueError('Unknown layout: {0}'.format(name))
+
+    base.append('partitions = {0}'.format(' '.join(part[0]
+                                                   for part in parts)))
+    lines = base + ['']
+    for label, length, options in parts:
+        lines.append('[partition.{0}]'.format(label))
+        lines.append('label = {0}'.format(label))
+        lines.append('len = {0}'.format(length))
+        # the fat type has a single type GUID, any label can use it
+        lines.append('type = fat')
+        for option, value in sorted(options.items()):
+            lines.append('{0} = {1}'.format(option, value))
+        lines.append('')
+
+    return '\n'.join(lines), labels
+
+def random_block(seed, size):
+    """
+    Gives size reproducible random Bytes
+    """
+    return Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+def make_payload(path, kind, size, seed=0):
+    """
+    Writes a binary of size Bytes with the payload kind
+    """
+    block = random_block(seed, MIB)
+
+    with open(path, 'wb') as bin_file:
+        if kind == 'dense':
+            for pos in range(0, size, MIB):
+                bin_file.write(block[:min(MIB, size - pos)])
+        elif kind == 'zero':
+            for pos in range(0, size, MIB):
+                chunk = block[:DATA_PER_MIB].ljust(MIB, b'\x00')
+                bin_file.write(chunk[:min(MIB, size - pos)])
+        elif kind == 'sparse':
+            bin_file.truncate(size)
+            for pos in range(0, size, MIB):
+                bin_file.seek(pos)
+                bin_file.write(block[:min(DATA_PER_MIB, size - pos)])
+        elif kind == 'android':
+            write_android_sparse(bin_file, block, size)
+        else:
+            raise ValueError('Unknown payload: {0}'.format(kind))
+
+def write_android_sparse(bin_file, block, size):
+    """
+    Writes an Android sparse image of size Bytes once expanded, each MiB is
+    made of a RAW, a FILL and a DONT_CARE chunk
+    """
+    blocks = size // SIMG_BLOCK_SIZE
+    per_mib = MIB // SIMG_BLOCK_SIZE
+    raw_blocks = DATA_PER_MIB // SIMG_BLOCK_SIZE
+
+    chunks = []
+    done = 0
+    while done < blocks:
+        count = min(per_mib, blocks - done)
+        raw = min(raw_blocks, count)
+        fill = (count - raw) // 2
+        chunks.append((0xcac1, raw, block[:raw * SIMG_BLOCK_SIZE]))
+        if fill:
+            chunks.append((0xcac2, fill, b'\xa5\x5a\xa5\x5a'))
+        if count - raw - fill:
+            chunks.append((0xcac3, count - raw - fill, b''))
+        done += count
+
+    bin_file.write(struct.pack('<IHHHHIIII', 0xed26ff3a, 1, 0, 28, 12,
+                               SIMG_BLOCK_SIZE, blocks, len(chunks), 0))
+    for chunk_type, count, data in chunks:
+        bin_file.write(struct.pack('<HHII', chunk_type, 0, count,
+                                   12 + len(data)))
+        bin_file.write(data)
+
+def measure(function, repeat):
+    """
+    Calls a function repeat times, gives the times of the calls in seconds
+    and the result of the last one
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        times.append(perf_counter() - start)
+    return times, result
+
+def summary(times):
+    """
+    Gives the summary of the times of a benchmark
+    """
+    return {'min': round(min(times), 6),
+            'median': round(median(times), 6),
+            'max': round(max(times), 6),
+            'runs': [round(value, 6) for value in times]}
+
+def bench_case(work_dir, table_path, sources, size, block_size, cmdargs):
+    """
+    Benchmarks the parsing, the creation, the show and the verification of
+    an image, gives the record of the case. A layout which doesn't fit in
+    the image size is skipped, the reason is recorded.
+    """
+    img_path = os.path.join(work_dir, 'disk.img')
+    str_size = '{0}B'.format(size)
+
+    def parse():
+        tlb_infos = TLBInfos(table_path)
+        read_layout(tlb_infos, GPTImage(img_path, str_size, block_size))
+        return tlb_infos
+
+    def create():
+        if os.path.isfile(img_path):
+            os.remove(img_path)
+        return create_image(img_path, table_path, size, sources, block_size,
+                            cmdargs.jobs, cmdargs.sparse, cmdargs.hashes,
+                            stats=True)
+
+    def show():
+        gpt_img = GPTImage(img_path, str_size, block_size)
+        gpt_img.read()
+        return str(gpt_img)
+
+    def verify():
+        hashes = None
+        if cmdargs.hashes:
+            hashes = HashManifest(img_path + HashManifest.SUFFIX).read()
+        return GPTImage(img_path, str_size, block_size).verify(hashes,
+                                                                cmdargs.jobs)
+
+    record = {}
+    try:
+        parse_times, tlb_infos = measure(parse, cmdargs.repeat)
+    except LayoutError as err:
+        return {'skipped': str(err)}
+    record['partitions'] = len(tlb_infos)
+    record['parse'] = summary(parse_times)
+
+    create_times, written = measure(create, cmdargs.repeat)
+    record['create'] = summary(create_times)
+    record['written'] = sum(written.values())
+    record['create']['mb_per_s'] = BuildStats.rate(record['written'],
+                                                   median(create_times))
+    with open(img_path + BuildStats.SUFFIX, 'r') as stats_file:
+        stats = load(stats_file)
+    record['stats'] = dict((key, stats[key]) for key in
+                           ('phases', 'syscalls', 'peak_rss'))
+    record['allocated'] = os.stat(img_path).st_blocks * 512
+
+    record['show'] = summary(measure(show, cmdargs.repeat)[0])
+
+    verify_times, problems = measure(verify, cmdargs.repeat)
+    record['verify'] = summary(verify_times)
+    if problems:
+        raise GPTImageError('Invalid image {0}: {1}'
+                            .format(img_path, '; '.join(problems)))
+
+    return record
+
+def case_name(case):
+    """
+    Gives the name of a benchmark case, used to compare the reports
+    """
+    return '{0}/{1}/{2}/{3}'.format(case['layout'], case['payload'],
+                                    case['size'], case['block_size'])
+
+def compare(report, baseline_path):
+    """
+    Prints the median times of the report relative to the ones of a
+    baseline report, a ratio below 1 is an improvement
+    """
+    with open(baseline_path, 'r') as baseline_file:
+        baseline_report = load(baseline_file)
+    baseline = dict((case_name(case), case)
+                    for case in baseline_report['cases'])
+    # the number of runs doesn't change the times compared
+    parameters = dict(report['parameters'], repeat=None)
+    baseline_parameters = dict(baseline_report.get('parameters', {}),
+                               repeat=None)
+    if baseline_parameters != parameters:
+        sys.stderr.write('The baseline was run with other parameters: {0}\n'
+                         .format(baseline_report.get('parameters')))
+
+    print('{0:40} {1:>8} {2:>8} {3:>8} {4:>8}'
+          .format('case', 'parse', 'create', 'show', 'verify'))
+    for case in report['cases']:
+        old = baseline.get(case_name(case))
+        if old is None or 'skipped' in old or 'skipped' in case:
+            continue
+        ratios = ['{0:8.2f}'.format(case[op]['median'] /
+                                    max(old[op]['median'], 1e-9))
+                  for op in ('parse', 'create', 'show', 'verify')]
+        print('{0:40} {1}'.format(case_name(case), ' '.join(ratios)))
+
+def git_revision():
+    """
+    Gives the git revision of create_gpt_image.py, or None
+    """
+    try:
+        return check_output(['git', '-C', TOP_DIR, 'rev-parse', 'HEAD'],
+                            universal_newlines=True).strip()
+    except (OSError, CalledProcessError):
+        return None
+
+def usage():
+    """
+    Used to make the arguments parser of the benchmark
+    """
+    cmdparser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    cmdparser.add_argument('--layouts', default=','.join(LAYOUTS),
+                           help='Comma separated layouts [default: all].')
+    cmdparser.add_argument('--payloads', default=','.join(PAYLOADS),
+                           help='Comma separated payloads [default: all].')
+    cmdparser.add_argument('--sizes', default='512M,2G',
+                           help=('Comma separated image sizes, in Bytes or '
+                                 'with a unit [default: 512M,2G].'))
+    cmdparser.add_argument('--block-sizes', default='512,4096',
+                           help=('Comma separated block sizes [default: '
+                                 '512,4096].'))
+    cmdparser.add_argument('--payload-size', type=int, default=8,
+                           metavar='MIB',
+                           help=('Size of the binary of each written '
+                                 'partition in MiB [default: 8].'))
+    cmdparser.add_argument('--repeat', type=int, default=3,
+                           help='Number of runs of each benchmark.')
+    cmdparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='Number of jobs of the writes.')
+    cmdparser.add_argument('--sparse', action='store_true',
+                           help='Create sparse images.')
+    cmdparser.add_argument('--hashes', action='store_true',
+                           help=('Hash the partitions while they are '
+                                 'written and verify them.'))
+    cmdparser.add_argument('--workdir', default=None,
+                           help=('Directory of the generated files, its file '
+                                 'system changes the copy methods used '
+                                 '[default: a temporary directory].'))
+    cmdparser.add_argument('--keep', action='store_true',
+                           help='Keep the generated files.')
+    cmdparser.add_argument('-o', '--output',
+                           default='bench_create_gpt_image.json',
+                           help='Path of the JSON report.')
+    cmdparser.add_argument('--baseline', metavar='REPORT',
+                           help=('Compare the report with the one of a '
+                                 'previous run.'))
+    return cmdparser
+
+def main():
+    """
+    Runs the benchmark cases and writes the report
+    """
+    cmdargs = usage().parse_args()
+    basicConfig(format=' %(levelname)s %(message)s')
+    getLogger().setLevel(WARNING)
+
+    layouts = cmdargs.layouts.split(',')
+    payloads = cmdargs.payloads.split(',')
+    sizes = [GPTImage.convert_size_to_bytes(size if size[-1:].isalpha()
+                                            else size + 'B')
+             for size in cmdargs.sizes.split(',')]
+    block_sizes = [int(block_size)
+                   for block_size in cmdargs.block_sizes.split(',')]
+
+    work_dir = cmdargs.workdir or mkdtemp(prefix='bench_gpt_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    report = {'version': REPORT_VERSION,
+              'date': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()),
+              'revision': git_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'parameters': {'payload_size': cmdargs.payload_size * MIB,
+                             'repeat': cmdargs.repeat,
+                             'jobs': cmdargs.jobs,
+                             'sparse': cmdargs.sparse,
+                             'hashes': cmdargs.hashes},
+              'cases': []}
+
+    try:
+        payload_paths = {}
+        for payload in payloads:
+            payload_paths[payload] = os.path.join(work_dir,
+                                                  '{0}.bin'.format(payload))
+            make_payload(payload_paths[payload], payload,
+                         cmdargs.payload_size * MIB)
+
+        for layout in layouts:
+            table, labels = make_layout(layout, cmdargs.payload_size)
+            table_path = os.path.join(work_dir, '{0}.ini'.format(layout))
+            with open(table_path, 'w') as table_file:
+                table_file.write(table)
+
+            for payload in payloads:
+                sources = dict((label, payload_paths[payload])
+                               for label in labels)
+                for size in sizes:
+                    for block_size in block_sizes:
+                        case = {'layout': layout, 'payload': payload,
+                                'size': size, 'block_size': block_size}
+                        sys.stderr.write('{0}\n'.format(case_name(case)))
+                        case.update(bench_case(work_dir, table_path, sources,
+                                               size, block_size, cmdargs))
+                        if 'skipped' in case:
+                            sys.stderr.write('  skipped: {0}\n'
+                                             .format(case['skipped']))
+                        report['cases'].append(case)
+    except GPTImageError as err:
+        sys.stderr.write('Benchmark failed: {0}\n'.format(err))
+        return 1
+    finally:
+        if not cmdargs.keep and cmdargs.workdir is None:
+            rmtree(work_dir)
+
+    with open(cmdargs.output, 'w') as report_file:
+        dump(report, report_file, indent=2, sort_keys=True)
+    sys.stderr.write('Report written: {0}\n'.format(cmdargs.output))
+
+    if cmdargs.baseline:
+        compare(report, cmdargs.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
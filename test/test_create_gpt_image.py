@@ -0,0 +1,1263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+
+# Copyright (c) 2026, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+
+"""
+Regression tests of create_gpt_image.py.
+
+The GPT/UEFI images are built in a temporary directory from synthetic
+partition table files and binaries, then read back and compared with the
+binaries.
+
+Usage: python -m unittest test.test_create_gpt_image, or pytest.
+"""
+
+import errno
+import os
+import sys
+import struct
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from gzip import open as gzip_open
+from hashlib import sha256
+from json import dump, load
+from logging import getLogger, WARNING
+from lzma import open as lzma_open
+from random import Random
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from unittest.mock import patch
+from uuid import UUID, uuid5
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from zlib import crc32
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import create_gpt_image
+from create_gpt_image import (GPTImage, TLBInfos, BinaryCopier,
+                              BuildManifest, usage, read_binaries_path,
+                              write_batch, entry_name, HashManifest,
+                              read_guid_namespace, read_layout,
+                              LayoutCache, GPTImageError, LayoutError,
+                              BinaryError, ImageError, create_image,
+                              BuildStats, read_resized_label, hash_fill,
+                              fill_pattern, data_extents, TeeWriter)
+
+MIB = 1024 * 1024
+
+TABLE = """[base]
+partitions = boot system misc data
+
+[partition.boot]
+label = boot
+len = 4
+type = fat
+
+[partition.system]
+label = system
+len = 8
+type = fat
+
+[partition.misc]
+label = misc
+len = 1
+type = fat
+
+[partition.data]
+label = data
+len = -1
+type = fat
+"""
+
+ALIGNED_TABLE = """[base]
+partitions = boot cache userdata data
+align = 1024
+
+[partition.boot]
+label = boot
+len = 3
+type = fat
+
+[partition.cache]
+label = cache
+len = -1
+type = fat
+weight = 1
+
+[partition.userdata]
+label = userdata
+len = -1
+type = fat
+weight = 2
+
+[partition.data]
+label = data
+len = -1
+type = fat
+weight = 1
+"""
+
+NAMESPACE = UUID('3c8ea8b6-5d4e-4a0c-9b3e-3f1a3c9f5a11')
+
+
+def setUpModule():
+    getLogger().setLevel(WARNING)
+
+def random_data(size, seed=0):
+    """
+    Gives size reproducible random Bytes
+    """
+    return Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+def make_simg(chunks, block_size=4096):
+    """
+    Gives an Android sparse image of chunks, each one is ('raw', data),
+    ('fill', pattern, blocks) or ('skip', blocks), and its expanded data
+    """
+    raw_chunks = []
+    expanded = []
+    blocks = 0
+    for chunk in chunks:
+        if chunk[0] == 'raw':
+            count = len(chunk[1]) // block_size
+            raw_chunks.append(struct.pack('<HHII', 0xcac1, 0, count,
+                                          12 + len(chunk[1])) + chunk[1])
+            expanded.append(chunk[1])
+        elif chunk[0] == 'fill':
+            count = chunk[2]
+            raw_chunks.append(struct.pack('<HHII', 0xcac2, 0, count, 16) +
+                              chunk[1])
+            expanded.append(chunk[1] * (count * block_size // 4))
+        else:
+            count = chunk[1]
+            raw_chunks.append(struct.pack('<HHII', 0xcac3, 0, count, 12))
+            expanded.append(b'\x00' * (count * block_size))
+        blocks += count
+
+    header = struct.pack('<IHHHHIIII', 0xed26ff3a, 1, 0, 28, 12, block_size,
+                         blocks, len(raw_chunks), 0)
+    return header + b''.join(raw_chunks), b''.join(expanded)
+
+def expand_simg(path):
+    """
+    Gives the data of an Android sparse image once expanded
+    """
+    with open(path, 'rb') as simg_file:
+        _, _, _, file_hdr, chunk_hdr, block_size, blocks, chunks, _ = \
+            struct.unpack('<IHHHHIIII', simg_file.read(28))
+        simg_file.seek(file_hdr)
+        expanded = []
+        for _ in range(chunks):
+            chunk_type, _, count, total = struct.unpack(
+                '<HHII', simg_file.read(chunk_hdr))
+            data = simg_file.read(total - chunk_hdr)
+            if chunk_type == 0xcac1:
+                expanded.append(data)
+            elif chunk_type == 0xcac2:
+                expanded.append(data * (count * block_size // 4))
+            elif chunk_type == 0xcac3:
+                expanded.append(b'\x00' * (count * block_size))
+    data = b''.join(expanded)
+    assert len(data) == blocks * block_size
+    return data
+
+
+class ImageTestCase(unittest.TestCase):
+    """
+    Builds images in a temporary directory and reads their partitions
+    """
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='test_gpt_')
+        self.table = self.path('gpt.ini')
+        self.write(self.table, TABLE.encode('utf-8'))
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, path, data):
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as in_file:
+            return in_file.read()
+
+    def layout(self, img_path, size='32M', block_size=512, namespace=None):
+        """
+        Gives an image and the layout of the TLB partition file in it
+        """
+        gpt_img = GPTImage(img_path, size, block_size,
+                           guid_namespace=namespace)
+        tlb_infos = TLBInfos(self.table, namespace=namespace)
+        tlb_infos.read(block_size)
+        tlb_infos.compute_last_size_entry(gpt_img.size, block_size,
+                                          gpt_img.gpt_header.entry_size,
+                                          gpt_img.gpt_header.table_length)
+        return gpt_img, tlb_infos
+
+    def binaries_path(self, sources):
+        """
+        Gives the binary of each label of sources, the other partitions
+        have no binary
+        """
+        return dict((label, sources.get(label, 'none'))
+                    for label in GPTImage.ANDROID_PARTITIONS)
+
+    def create(self, img_path, sources, size='32M', block_size=512,
+               namespace=None, **kwargs):
+        """
+        Writes an image with the binaries of sources
+        """
+        gpt_img, tlb_infos = self.layout(img_path, size, block_size,
+                                         namespace)
+        gpt_img.write(tlb_infos, self.binaries_path(sources), **kwargs)
+
+    def partitions(self, img_path, block_size=512):
+        """
+        Gives the first and last LBAs of each partition of an image
+        """
+        gpt_img = GPTImage(img_path, '{0}B'.format(os.stat(img_path).st_size),
+                           block_size)
+        gpt_img.read()
+        return dict((entry_name(entry), (entry.lba_first, entry.lba_last))
+                    for entry in gpt_img.table
+                    if entry.type != b'\x00' * 16)
+
+    def partition(self, img_path, label, block_size=512):
+        """
+        Gives the data of a partition of an image
+        """
+        first, last = self.partitions(img_path, block_size)[label]
+        with open(img_path, 'rb') as img_file:
+            img_file.seek(first * block_size)
+            return img_file.read((last + 1 - first) * block_size)
+
+    def assertPartition(self, img_path, label, data, block_size=512):
+        """
+        Checks a partition starts with data and is zero after it
+        """
+        part = self.partition(img_path, label, block_size)
+        self.assertEqual(part[:len(data)], data)
+        self.assertEqual(part[len(data):].count(0), len(part) - len(data))
+
+    def verify(self, img_path, block_size=512, hashes=None):
+        """
+        Gives the problems found in an image
+        """
+        gpt_img = GPTImage(img_path, '{0}B'.format(os.stat(img_path).st_size),
+                           block_size)
+        return gpt_img.verify(hashes)
+
+    def assertSamePartitions(self, img_path, other_path, block_size=512):
+        """
+        Checks two images have the same partitions, with the same data
+        """
+        parts = self.partitions(img_path, block_size)
+        self.assertEqual(parts, self.partitions(other_path, block_size))
+        for label in parts:
+            self.assertTrue(self.partition(img_path, label, block_size) ==
+                            self.partition(other_path, label, block_size),
+                            'The partition {0} differs'.format(label))
+
+
+class SparseOutputTest(ImageTestCase):
+    """
+    Images written as sparse files
+    """
+
+    def test_same_image(self):
+        data = (random_data(64 * 1024) + b'\x00' * (2 * MIB) +
+                random_data(4096, 1))
+        sources = {'system': self.write(self.path('system.img'), data)}
+        reference = self.path('ref.img')
+        self.create(reference, sources)
+        img = self.path('sparse.img')
+        self.create(img, sources, sparse=True)
+
+        self.assertEqual(os.stat(img).st_size, 32 * MIB)
+        self.assertSamePartitions(img, reference)
+        self.assertPartition(img, 'system', data)
+
+    def test_holes(self):
+        data = random_data(MIB) + b'\x00' * (4 * MIB)
+        img = self.path('sparse.img')
+        self.create(img, {'system': self.write(self.path('system.img'),
+                                               data)},
+                    sparse=True)
+        # only the headers, the tables and the data of the binary are
+        # allocated
+        self.assertLess(os.stat(img).st_blocks * 512, 2 * MIB)
+
+
+class KernelCopyTest(ImageTestCase):
+    """
+    Binaries copied in the partitions by the kernel or through the buffer
+    """
+
+    def test_round_trip(self):
+        # larger than the buffer and not aligned on the blocks
+        data = random_data(5 * MIB + 100)
+        img = self.path('copy.img')
+        self.create(img, {'system': self.write(self.path('system.img'),
+                                               data)})
+        self.assertPartition(img, 'system', data)
+
+    def test_methods(self):
+        data = random_data(MIB + 100)
+        src_path = self.write(self.path('src.img'), data)
+        for methods in (['reflink'], ['copy_file_range'], ['sendfile'], []):
+            copier = BinaryCopier()
+            copier.methods = [method for method in methods
+                              if method in copier.methods]
+            dst_path = self.path('dst.img')
+            with open(src_path, 'rb') as src_file, \
+                    open(dst_path, 'wb') as dst_file:
+                copier.copy(src_file.fileno(), dst_file.fileno(), 4096 + 1,
+                            len(data) - 10, 10)
+            self.assertEqual(self.read(dst_path),
+                             b'\x00' * 4097 + data[10:], methods)
+
+
+class AndroidSparseInputTest(ImageTestCase):
+    """
+    Android sparse binaries expanded in the partitions
+    """
+
+    def test_expanded(self):
+        raw, data = make_simg([('raw', random_data(8192)),
+                               ('fill', b'\xa5\x5a\x00\x01', 16),
+                               ('skip', 32),
+                               ('fill', b'\x00' * 4, 8),
+                               ('raw', random_data(4096, 1))])
+        sources = {'boot': self.write(self.path('boot.simg'), raw)}
+        for sparse in (False, True):
+            img = self.path('simg{0}.img'.format(sparse))
+            self.create(img, sources, sparse=sparse)
+            self.assertPartition(img, 'boot', data)
+
+
+class ParallelWriteTest(ImageTestCase):
+    """
+    Partitions written by several workers
+    """
+
+    def test_same_image(self):
+        sources = {
+            'boot': self.write(self.path('boot.img'), random_data(MIB)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(MIB, 1) + b'\x00' * MIB),
+            'misc': self.write(self.path('misc.img'), random_data(4096, 2))}
+        reference = self.path('ref.img')
+        self.create(reference, sources)
+        for sparse in (False, True):
+            img = self.path('jobs{0}.img'.format(sparse))
+            self.create(img, sources, sparse=sparse, jobs=3)
+            self.assertSamePartitions(img, reference)
+
+
+class HeadersTest(ImageTestCase):
+    """
+    GPT headers and partition tables of the images
+    """
+
+    _HEADER_FMT = '<8s4sIIIQQQQ16sQIII'
+
+    def read_header(self, img_file, lba, block_size):
+        """
+        Reads a GPT header, checks its CRC32 and the one of its partition
+        table, returns the header fields
+        """
+        img_file.seek(lba * block_size)
+        raw = img_file.read(struct.calcsize(HeadersTest._HEADER_FMT))
+        fields = struct.unpack(HeadersTest._HEADER_FMT, raw)
+        self.assertEqual(fields[0], b'EFI PART')
+        self.assertEqual(fields[3], crc32(raw[:16] + b'\x00' * 4 + raw[20:]))
+
+        img_file.seek(fields[10] * block_size)
+        table = img_file.read(fields[11] * fields[12])
+        self.assertEqual(fields[13], crc32(table))
+        return fields, table
+
+    def test_headers(self):
+        data = random_data(MIB + 100)
+        sources = {'boot': self.write(self.path('boot.img'), data)}
+        for block_size in (512, 4096):
+            img = self.path('h{0}.img'.format(block_size))
+            self.create(img, sources, block_size=block_size)
+            self.assertPartition(img, 'boot', data, block_size)
+
+            last = 32 * MIB // block_size - 1
+            with open(img, 'rb') as img_file:
+                primary, table = self.read_header(img_file, 1, block_size)
+                backup, backup_table = self.read_header(img_file, last,
+                                                        block_size)
+            # the backup header points to the primary one and to its own
+            # copy of the partition table
+            self.assertEqual((primary[5], primary[6]), (1, last))
+            self.assertEqual((backup[5], backup[6]), (last, 1))
+            self.assertEqual(primary[7:10], backup[7:10])
+            self.assertEqual(table, backup_table)
+
+
+class IncrementalTest(ImageTestCase):
+    """
+    Images rebuilt from their build manifest
+    """
+
+    def test_rebuild(self):
+        sources = {
+            'boot': self.write(self.path('boot.img'), random_data(MIB)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(2 * MIB, 1))}
+        img = self.path('inc.img')
+        gpt_img, tlb_infos = self.layout(img)
+        gpt_img.write_incremental(tlb_infos, self.binaries_path(sources))
+        self.assertTrue(os.path.isfile(img + BuildManifest.SUFFIX))
+
+        # the partition of the changed binary is rewritten, its old data
+        # after the new binary is cleared
+        boot = random_data(MIB // 2, 2)
+        self.write(sources['boot'], boot)
+        gpt_img, tlb_infos = self.layout(img)
+        gpt_img.write_incremental(tlb_infos, self.binaries_path(sources))
+        self.assertPartition(img, 'boot', boot)
+
+        reference = self.path('ref.img')
+        self.create(reference, sources)
+        self.assertSamePartitions(img, reference)
+
+
+class AndroidSparseOutputTest(ImageTestCase):
+    """
+    Images written as Android sparse images
+    """
+
+    def test_expanded(self):
+        raw, _ = make_simg([('raw', random_data(4096, 2)), ('skip', 4),
+                            ('fill', b'\x01\x02\x03\x04', 2)])
+        sources = {
+            'boot': self.write(self.path('boot.img'), random_data(MIB)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(MIB, 1) + b'\x00' * MIB +
+                                 random_data(100, 3)),
+            'misc': self.write(self.path('misc.simg'), raw)}
+        reference = self.path('ref.img')
+        self.create(reference, sources)
+
+        simg = self.path('disk.simg')
+        gpt_img, tlb_infos = self.layout(simg)
+        gpt_img.write_android_sparse(tlb_infos, self.binaries_path(sources))
+        img = self.write(self.path('expanded.img'), expand_simg(simg))
+        self.assertEqual(os.stat(img).st_size, 32 * MIB)
+        self.assertSamePartitions(img, reference)
+        # the zero blocks aren't stored
+        self.assertLess(os.stat(simg).st_size, 3 * MIB)
+
+
+class BatchTest(ImageTestCase):
+    """
+    Several images written from one TLB partition file
+    """
+
+    def batch(self, images, *args):
+        """
+        Writes the images of a batch specification file with the options
+        of the command line
+        """
+        batch_path = self.path('batch.json')
+        with open(batch_path, 'w') as batch_file:
+            dump({'images': images}, batch_file)
+        cmdargs = usage().parse_args([batch_path, '--batch', '--table',
+                                      self.table, '--size', '32M'] +
+                                     list(args))
+        write_batch(batch_path, TLBInfos(self.table),
+                    read_binaries_path(cmdargs), cmdargs)
+
+    def test_filters(self):
+        boot = random_data(MIB)
+        boot_path = self.write(self.path('boot.img'), boot)
+        ro_img = self.path('ro.img')
+        rw_img = self.path('rw.img')
+        self.batch([{'output': ro_img, 'exclude': ['data']},
+                    {'output': rw_img, 'size': '16M',
+                     'include': ['boot', 'data'],
+                     'overrides': {'data': {'len': 2}}}],
+                   '--boot', boot_path, '--jobs', '2')
+
+        self.assertEqual(os.stat(ro_img).st_size, 32 * MIB)
+        self.assertEqual(sorted(self.partitions(ro_img)),
+                         ['boot', 'misc', 'system'])
+        self.assertPartition(ro_img, 'boot', boot)
+
+        self.assertEqual(os.stat(rw_img).st_size, 16 * MIB)
+        parts = self.partitions(rw_img)
+        self.assertEqual(sorted(parts), ['boot', 'data'])
+        self.assertEqual(parts['data'][1] + 1 - parts['data'][0],
+                         2 * MIB // 512)
+        self.assertPartition(rw_img, 'boot', boot)
+
+    def test_invalid(self):
+        for image in ({'output': self.path('a.img'), 'unknown': 1},
+                      {'size': '32M'}):
+            with self.assertRaises(GPTImageError):
+                self.batch([image])
+
+
+class TeeTest(ImageTestCase):
+    """
+    The same image written in several destinations
+    """
+
+    def test_destinations(self):
+        sources = {
+            'boot': self.write(self.path('boot.img'), random_data(MIB)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(MIB, 1) + b'\x00' * MIB)}
+        reference = self.path('ref.img')
+        self.create(reference, sources)
+
+        for sparse in (False, True):
+            img = self.path('tee{0}.img'.format(sparse))
+            copies = [self.path('copy{0}{1}.img'.format(sparse, pos))
+                      for pos in range(2)]
+            gpt_img, tlb_infos = self.layout(img)
+            gpt_img.write_tee(tlb_infos, self.binaries_path(sources), copies,
+                              sparse)
+            self.assertSamePartitions(img, reference)
+            for copy in copies:
+                self.assertTrue(self.read(copy) == self.read(img))
+
+    def test_sparse_device(self):
+        paths = [self.path('tee.img'), self.path('device.img')]
+        writer = TeeWriter(paths, 4 * MIB)
+        # the second destination stands for a device
+        writer.regular[1] = False
+        self.assertFalse(any(thread.daemon for thread in writer.threads))
+        writer.write(b'\x00' * MIB, MIB)
+        writer.write(b'\x01' * 4096, 0)
+        writer.discard(2 * MIB, MIB)
+        self.assertEqual(writer.close(), [])
+
+        # the zeros are only skipped in the image file
+        self.assertEqual(writer.written, [4096, MIB + 4096])
+        self.assertEqual(os.stat(paths[0]).st_size, 4 * MIB)
+        self.assertLess(os.stat(paths[0]).st_blocks * 512, MIB)
+        self.assertGreaterEqual(os.stat(paths[1]).st_blocks * 512, MIB)
+        for path in paths:
+            self.assertTrue(self.read(path)[:2 * MIB] ==
+                            b'\x01' * 4096 + b'\x00' * (2 * MIB - 4096))
+
+
+class VerifyTest(ImageTestCase):
+    """
+    Integrity checks of the images
+    """
+
+    def setUp(self):
+        super(VerifyTest, self).setUp()
+        self.img = self.path('disk.img')
+        self.create(self.img, {'boot': self.write(self.path('boot.img'),
+                                                  random_data(MIB))})
+
+    def corrupt(self, offset):
+        with open(self.img, 'r+b') as img_file:
+            img_file.seek(offset)
+            data = img_file.read(1)
+            img_file.seek(offset)
+            img_file.write(bytes([data[0] ^ 0xff]))
+
+    def test_valid(self):
+        self.assertEqual(self.verify(self.img), [])
+        for block_size in (512, 4096):
+            img = self.path('v{0}.img'.format(block_size))
+            self.create(img, {}, block_size=block_size, sparse=True)
+            self.assertEqual(self.verify(img, block_size), [])
+
+    def test_corrupted_header(self):
+        self.corrupt(512 + 40)
+        self.assertNotEqual(self.verify(self.img), [])
+
+    def test_corrupted_backup_table(self):
+        self.corrupt(32 * MIB - 33 * 512 + 10)
+        self.assertNotEqual(self.verify(self.img), [])
+
+
+class HashManifestTest(ImageTestCase):
+    """
+    Hash manifests of the partitions written with the images
+    """
+
+    def setUp(self):
+        super(HashManifestTest, self).setUp()
+        self.sources = {
+            'boot': self.write(self.path('boot.img'), random_data(MIB)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(MIB, 1) + b'\x00' * MIB)}
+
+    def hashes(self, img_path):
+        return HashManifest(img_path + HashManifest.SUFFIX).read()
+
+    def test_write_modes(self):
+        img = self.path('disk.img')
+        self.create(img, self.sources, hashes=True, jobs=2)
+        hashes = self.hashes(img)
+        self.assertEqual(self.verify(img, hashes=hashes), [])
+
+        # the binaries are hashed the same way in all the write modes
+        sparse = self.path('sparse.img')
+        self.create(sparse, self.sources, sparse=True, hashes=True)
+        tee = self.path('tee.img')
+        gpt_img, tlb_infos = self.layout(tee)
+        gpt_img.write_tee(tlb_infos, self.binaries_path(self.sources),
+                          [self.path('copy.img')], hashes=True)
+        records = [record for record in hashes
+                   if record['label'] in self.sources]
+        self.assertEqual(len(records), 2)
+        for other in (sparse, tee):
+            self.assertEqual([record for record in self.hashes(other)
+                              if record['label'] in self.sources], records)
+
+    def test_corrupted_partition(self):
+        img = self.path('disk.img')
+        self.create(img, self.sources, hashes=True)
+        first, _ = self.partitions(img)['system']
+        with open(img, 'r+b') as img_file:
+            img_file.seek(first * 512 + 100)
+            img_file.write(b'\xff')
+
+        problems = self.verify(img, hashes=self.hashes(img))
+        # one problem per hash algorithm of the manifest
+        self.assertNotEqual(problems, [])
+        for problem in problems:
+            self.assertIn('The partition system ', problem)
+
+
+class CompressedTest(ImageTestCase):
+    """
+    Compressed binaries decompressed in the partitions
+    """
+
+    def test_gzip_and_xz(self):
+        data = random_data(MIB) + b'\x00' * MIB + random_data(100, 1)
+        for suffix, opener in (('gz', gzip_open), ('xz', lzma_open)):
+            bin_path = self.path('boot.img.{0}'.format(suffix))
+            with opener(bin_path, 'wb') as bin_file:
+                bin_file.write(data)
+            for sparse in (False, True):
+                img = self.path('{0}{1}.img'.format(suffix, sparse))
+                self.create(img, {'boot': bin_path}, sparse=sparse)
+                self.assertPartition(img, 'boot', data)
+
+    @unittest.skipIf(create_gpt_image.zstandard is None,
+                     'zstandard module not installed')
+    def test_zstd(self):
+        data = random_data(MIB)
+        bin_path = self.write(
+            self.path('boot.img.zst'),
+            create_gpt_image.zstandard.ZstdCompressor().compress(data))
+        img = self.path('zstd.img')
+        self.create(img, {'boot': bin_path})
+        self.assertPartition(img, 'boot', data)
+
+    def test_too_large(self):
+        bin_path = self.path('big.img.gz')
+        with gzip_open(bin_path, 'wb') as bin_file:
+            bin_file.write(b'\x00' * (5 * MIB))
+        with self.assertRaises(BinaryError):
+            self.create(self.path('big.img'), {'boot': bin_path})
+
+
+class BlockDeviceTest(ImageTestCase):
+    """
+    Images written with O_DIRECT as in a block device, a regular file
+    stands for the device
+    """
+
+    def test_same_image(self):
+        sources = {
+            'boot': self.write(self.path('boot.img'),
+                               random_data(MIB + 100)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(MIB, 1) + b'\x00' * MIB)}
+        reference = self.path('ref.img')
+        self.create(reference, sources, hashes=True)
+
+        device = self.path('device.img')
+        with open(device, 'wb') as device_file:
+            device_file.truncate(32 * MIB)
+        gpt_img, tlb_infos = self.layout(device)
+        written = gpt_img.write_device(tlb_infos,
+                                       self.binaries_path(sources), jobs=2,
+                                       hashes=True)
+
+        self.assertEqual(written['boot'], MIB + 100)
+        self.assertEqual(os.stat(device).st_size, 32 * MIB)
+        self.assertEqual(self.verify(device), [])
+        self.assertSamePartitions(device, reference)
+        hashes = HashManifest(device + HashManifest.SUFFIX).read()
+        self.assertEqual(self.verify(device, hashes=hashes), [])
+
+    def test_sidecar_dir(self):
+        sources = {'boot': self.write(self.path('boot.img'),
+                                      random_data(MIB))}
+        device = self.path('device.img')
+        with open(device, 'wb') as device_file:
+            device_file.truncate(32 * MIB)
+
+        # the hash manifest isn't written next to a block device
+        with patch.object(create_gpt_image.BlockDevice, 'is_block_device',
+                          side_effect=lambda path: path == device):
+            gpt_img, tlb_infos = self.layout(device)
+            self.assertIsNone(gpt_img.sidecar_path(HashManifest.SUFFIX))
+            with self.assertRaises(ImageError):
+                gpt_img.write_device(tlb_infos, self.binaries_path(sources),
+                                     hashes=True)
+            self.assertEqual(os.stat(device).st_blocks, 0)
+
+            sidecar_dir = self.path('sidecar')
+            os.mkdir(sidecar_dir)
+            gpt_img.sidecar_dir = sidecar_dir
+            gpt_img.write_device(tlb_infos, self.binaries_path(sources),
+                                 hashes=True)
+
+        self.assertEqual(os.listdir(sidecar_dir),
+                         ['device.img' + HashManifest.SUFFIX])
+        hashes = HashManifest(os.path.join(sidecar_dir, 'device.img' +
+                                           HashManifest.SUFFIX)).read()
+        self.assertEqual(self.verify(device, hashes=hashes), [])
+
+
+class DiskTestCase(ImageTestCase):
+    """
+    Operations on an image written with a boot and a system binaries
+    """
+
+    def setUp(self):
+        super(DiskTestCase, self).setUp()
+        self.boot = random_data(MIB)
+        self.system = random_data(MIB, 1) + b'\x00' * (2 * MIB)
+        self.sources = {
+            'boot': self.write(self.path('boot.img'), self.boot),
+            'system': self.write(self.path('system.img'), self.system)}
+        self.img = self.path('disk.img')
+        self.create(self.img, self.sources, hashes=True)
+
+    def read_image(self, size='32M'):
+        gpt_img = GPTImage(self.img, size)
+        gpt_img.read()
+        return gpt_img
+
+
+class ExtractTest(DiskTestCase):
+    """
+    Partitions extracted from the images
+    """
+
+    def test_extract(self):
+        paths = self.read_image().extract(self.path('out'), jobs=2)
+        self.assertEqual(sorted(paths), ['boot', 'data', 'misc', 'system'])
+        for label, path in paths.items():
+            self.assertTrue(self.read(path) ==
+                            self.partition(self.img, label),
+                            'The partition {0} differs'.format(label))
+        # the zero chunks are holes of the extracted partitions
+        self.assertLess(os.stat(paths['system']).st_blocks * 512, 2 * MIB)
+
+    def test_android_sparse(self):
+        paths = self.read_image().extract(self.path('out'), ['system'],
+                                          android_sparse=True)
+        self.assertEqual(list(paths), ['system'])
+        self.assertTrue(expand_simg(paths['system']) ==
+                        self.partition(self.img, 'system'))
+
+    def test_unknown(self):
+        with self.assertRaises(ImageError):
+            self.read_image().extract(self.path('out'), ['nope'])
+
+
+class UpdateTest(DiskTestCase):
+    """
+    Partitions replaced in place in the images
+    """
+
+    def test_zero_tail(self):
+        boot = random_data(MIB // 4, 2)
+        self.read_image().update({'boot': self.write(self.path('new.img'),
+                                                     boot)},
+                                 zero_tail=True)
+        self.assertPartition(self.img, 'boot', boot)
+        self.assertPartition(self.img, 'system', self.system)
+        hashes = HashManifest(self.img + HashManifest.SUFFIX).read()
+        self.assertEqual(self.verify(self.img, hashes=hashes), [])
+
+    def test_keep_tail(self):
+        boot = random_data(MIB // 4, 2)
+        self.read_image().update({'boot': self.write(self.path('new.img'),
+                                                     boot)})
+        self.assertPartition(self.img, 'boot', boot + self.boot[len(boot):])
+
+    def test_unknown(self):
+        with self.assertRaises(ImageError):
+            self.read_image().update({'nope': self.sources['boot']})
+
+
+class ResizeTest(DiskTestCase):
+    """
+    Images resized in place
+    """
+
+    def test_resize(self):
+        before = self.partitions(self.img)
+        for size, blocks in (('48M', 48 * MIB // 512),
+                             ('40M', 40 * MIB // 512)):
+            self.read_image(size).resize(size, 'data')
+            self.assertEqual(os.stat(self.img).st_size, blocks * 512)
+            self.assertEqual(self.verify(self.img), [])
+
+            # the last partition grows or shrinks with the image
+            after = self.partitions(self.img)
+            self.assertEqual(after['data'][1] - before['data'][1],
+                             blocks - 32 * MIB // 512)
+            for label in ('boot', 'system', 'misc'):
+                self.assertEqual(after[label], before[label])
+            self.assertPartition(self.img, 'boot', self.boot)
+            self.assertPartition(self.img, 'system', self.system)
+
+    def test_too_small(self):
+        with self.assertRaises(ImageError):
+            self.read_image().resize('8M', 'data')
+
+    def test_not_last(self):
+        # the partition of size -1 is followed by a fixed one
+        self.write(self.table, (TABLE.replace('misc data', 'misc data '
+                                              'vendor_boot') +
+                                '\n[partition.vendor_boot]\n'
+                                'label = vendor_boot\nlen = 1\n'
+                                'type = fat\n').encode('utf-8'))
+        self.create(self.img, self.sources)
+        before = self.partitions(self.img)
+        self.assertGreater(before['vendor_boot'][0], before['data'][1])
+
+        cmdargs = usage().parse_args([self.img, '--resize', '48M',
+                                      '--table', self.table])
+        label = read_resized_label(cmdargs, 512)
+        self.assertEqual(label, 'data')
+        for label in ('data', 'missing'):
+            with self.assertRaises(ImageError):
+                self.read_image().resize('48M', label)
+        self.assertEqual(os.stat(self.img).st_size, 32 * MIB)
+        self.assertEqual(self.partitions(self.img), before)
+
+    def test_table(self):
+        cmdargs = usage().parse_args([self.img, '--resize', '48M'])
+        with self.assertRaises(LayoutError):
+            read_resized_label(cmdargs, 512)
+
+        # several partitions of size -1 share the space
+        self.write(self.table, ALIGNED_TABLE.encode('utf-8'))
+        cmdargs = usage().parse_args([self.img, '--resize', '48M',
+                                      '--table', self.table])
+        with self.assertRaises(LayoutError):
+            read_resized_label(cmdargs, 512)
+
+
+class DiffTest(DiskTestCase):
+    """
+    Differences between two images
+    """
+
+    def diff(self, img_path, other_path):
+        gpt_img = GPTImage(img_path, '32M')
+        gpt_img.read()
+        other = GPTImage(other_path, '32M')
+        other.read()
+        return gpt_img.diff(other, jobs=2)
+
+    def test_extents(self):
+        other = self.path('other.img')
+        copyfile(self.img, other)
+        first, _ = self.partitions(other)['system']
+        with open(other, 'r+b') as other_file:
+            for offset in (8192 + 10, 3 * MIB + 5, 3 * MIB + 600):
+                other_file.seek(first * 512 + offset)
+                other_file.write(b'\xff')
+
+        differences, extents = self.diff(self.img, other)
+        self.assertEqual(differences, [])
+        self.assertEqual(extents, {'system': [(8192, 8704),
+                                              (3 * MIB, 3 * MIB + 1024)]})
+        self.assertEqual(self.diff(self.img, self.img), ([], {}))
+
+    def test_structure(self):
+        other = self.path('other.img')
+        table = TABLE.replace('len = 4', 'len = 5')
+        self.write(self.table, table.encode('utf-8'))
+        self.create(other, self.sources, sparse=True)
+
+        differences, extents = self.diff(self.img, other)
+        self.assertIn('Partition boot lba_last: {0} != {1}'
+                      .format(5 * MIB // 512 - 1, 6 * MIB // 512 - 1),
+                      differences)
+        self.assertIn('Partition system lba_first: {0} != {1}'
+                      .format(5 * MIB // 512, 6 * MIB // 512), differences)
+        # the partitions are compared from their own start
+        self.assertEqual(extents, {})
+
+
+class DeterministicTest(ImageTestCase):
+    """
+    Images with GUIDs derived from a namespace
+    """
+
+    def setUp(self):
+        super(DeterministicTest, self).setUp()
+        self.sources = {
+            'boot': self.write(self.path('boot.img'), random_data(MIB)),
+            'system': self.write(self.path('system.img'),
+                                 random_data(MIB, 1) + b'\x00' * MIB)}
+
+    def test_identical(self):
+        reference = self.path('ref.img')
+        self.create(reference, self.sources, namespace=NAMESPACE)
+        for pos, kwargs in enumerate(({}, {'sparse': True, 'jobs': 2})):
+            img = self.path('{0}.img'.format(pos))
+            self.create(img, self.sources, namespace=NAMESPACE, **kwargs)
+            self.assertTrue(self.read(img) == self.read(reference), kwargs)
+
+        gpt_img = GPTImage(reference, '32M')
+        gpt_img.read()
+        self.assertEqual(UUID(bytes_le=gpt_img.table[0].uuid),
+                         uuid5(NAMESPACE, 'boot'))
+
+    def test_namespaces(self):
+        self.assertEqual(read_guid_namespace(str(NAMESPACE)), NAMESPACE)
+        self.assertEqual(read_guid_namespace('seed'),
+                         read_guid_namespace('seed'))
+        self.assertIsNone(read_guid_namespace(None))
+
+        first = self.path('a.img')
+        second = self.path('b.img')
+        self.create(first, self.sources, namespace=NAMESPACE)
+        self.create(second, self.sources,
+                    namespace=read_guid_namespace('seed'))
+        self.assertFalse(self.read(first) == self.read(second))
+        self.assertSamePartitions(first, second)
+
+
+class LayoutCacheTest(ImageTestCase):
+    """
+    Layouts of the TLB partition files loaded from the layout cache
+    """
+
+    def setUp(self):
+        super(LayoutCacheTest, self).setUp()
+        self.cache_dir = self.path('cache')
+
+    def read_layout(self, cache, size='32M'):
+        gpt_img = GPTImage(self.path('disk.img'), size,
+                           guid_namespace=NAMESPACE)
+        tlb_infos = TLBInfos(self.table, namespace=NAMESPACE)
+        read_layout(tlb_infos, gpt_img, cache)
+        return list(tlb_infos)
+
+    def test_cached(self):
+        expected = self.read_layout(None)
+        self.assertEqual(self.read_layout(LayoutCache(self.cache_dir)),
+                         expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # another build loads the layout without parsing the TLB partition
+        # file again
+        with patch.object(TLBInfos, 'read',
+                          side_effect=AssertionError('not cached')):
+            self.assertEqual(self.read_layout(LayoutCache(self.cache_dir)),
+                             expected)
+
+    def test_keys(self):
+        cache = LayoutCache(self.cache_dir)
+        layout = self.read_layout(cache)
+        self.assertNotEqual(self.read_layout(cache, '64M'), layout)
+
+        table = TABLE.replace('len = 4', 'len = 5')
+        self.write(self.table, table.encode('utf-8'))
+        self.assertNotEqual(self.read_layout(cache), layout)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_invalid(self):
+        expected = self.read_layout(LayoutCache(self.cache_dir))
+        for name in os.listdir(self.cache_dir):
+            self.write(os.path.join(self.cache_dir, name), b'{')
+        self.assertEqual(self.read_layout(LayoutCache(self.cache_dir)),
+                         expected)
+
+
+class AllocationTest(ImageTestCase):
+    """
+    Alignment of the partitions and the space shared by weight
+    """
+
+    def setUp(self):
+        super(AllocationTest, self).setUp()
+        self.write(self.table, ALIGNED_TABLE.encode('utf-8'))
+
+    def test_alignment_and_weights(self):
+        for block_size in (512, 4096):
+            img = self.path('al{0}.img'.format(block_size))
+            self.create(img, {}, '64M', block_size)
+            self.assertEqual(self.verify(img, block_size), [])
+
+            parts = self.partitions(img, block_size)
+            align = MIB // block_size
+            for first, _ in parts.values():
+                self.assertEqual(first % align, 0)
+
+            sizes = dict((label, last + 1 - first)
+                         for label, (first, last) in parts.items())
+            self.assertEqual(sizes['boot'], 3 * align)
+            self.assertAlmostEqual(sizes['userdata'], 2 * sizes['cache'],
+                                   delta=align)
+            self.assertAlmostEqual(sizes['data'], sizes['cache'],
+                                   delta=align)
+
+            # the growing partitions fill the image up to the 2048 blocks
+            # reserved before the backup table
+            self.assertEqual(parts['data'][1] + 1,
+                             64 * MIB // block_size - 2048)
+
+    def test_invalid(self):
+        for option in ('weight = 0', 'align = 3'):
+            table = ALIGNED_TABLE.replace('weight = 2', option)
+            self.write(self.table, table.encode('utf-8'))
+            with self.assertRaises(LayoutError):
+                self.create(self.path('bad.img'), {}, '64M', 4096)
+
+    def test_too_small(self):
+        with self.assertRaises(LayoutError):
+            self.create(self.path('small.img'), {}, '4M')
+
+
+class FlashfilesTest(ImageTestCase):
+    """
+    Images built from the members of a flashfiles zip archive
+    """
+
+    def setUp(self):
+        super(FlashfilesTest, self).setUp()
+        self.boot = random_data(MIB)
+        self.system = random_data(2 * MIB, 1) + b'\x00' * MIB
+        raw, self.misc = make_simg([('raw', random_data(4096, 2)),
+                                    ('skip', 4)])
+        self.archive = self.path('flashfiles.zip')
+        with ZipFile(self.archive, 'w') as zip_file:
+            zip_file.writestr('boot.img', self.boot, ZIP_STORED)
+            zip_file.writestr('system.img', self.system, ZIP_DEFLATED)
+            zip_file.writestr('misc.img', raw, ZIP_DEFLATED)
+            zip_file.writestr('gpt.ini', TABLE, ZIP_DEFLATED)
+
+    def test_members(self):
+        self.table = os.path.join(self.archive, 'gpt.ini')
+        img = self.path('zip.img')
+        self.create(img, dict((label, os.path.join(self.archive,
+                                                   label + '.img'))
+                              for label in ('boot', 'system', 'misc')))
+        self.assertEqual(self.verify(img), [])
+        self.assertPartition(img, 'boot', self.boot)
+        self.assertPartition(img, 'system', self.system)
+        self.assertPartition(img, 'misc', self.misc)
+
+    def test_binaries_path(self):
+        boot_path = self.write(self.path('boot.img'), self.boot)
+        cmdargs = usage().parse_args([self.path('disk.img'), '--create',
+                                      '--table', self.table, '--flashfiles',
+                                      self.archive, '--boot', boot_path])
+        binaries_path = read_binaries_path(cmdargs)
+        # the binaries given explicitly take precedence over the flashfiles
+        self.assertEqual(binaries_path['boot'], boot_path)
+        self.assertEqual(binaries_path['system'],
+                         os.path.join(self.archive, 'system.img'))
+        self.assertEqual(binaries_path['misc'],
+                         os.path.join(self.archive, 'misc.img'))
+        self.assertEqual(binaries_path['data'], 'none')
+
+
+class APITest(ImageTestCase):
+    """
+    Images created through the create_image API
+    """
+
+    def setUp(self):
+        super(APITest, self).setUp()
+        self.boot = random_data(MIB)
+        self.boot_path = self.write(self.path('boot.img'), self.boot)
+
+    def test_create_image(self):
+        img = self.path('api.img')
+        written = create_image(img, self.table, 32 * MIB,
+                               {'boot': self.boot_path},
+                               guid_namespace='seed')
+        self.assertEqual(written['boot'], MIB)
+
+        reference = self.path('ref.img')
+        self.create(reference, {'boot': self.boot_path},
+                    namespace=read_guid_namespace('seed'))
+        self.assertTrue(self.read(img) == self.read(reference))
+
+    def test_sources(self):
+        with open(self.boot_path, 'rb') as bin_file:
+            img = self.path('obj.img')
+            create_image(img, self.table, '32M', {'boot': bin_file})
+        self.assertPartition(img, 'boot', self.boot)
+
+        img = self.path('callable.img')
+        create_image(img, self.table, '32M',
+                     {'boot': lambda: self.boot_path})
+        self.assertPartition(img, 'boot', self.boot)
+
+    def test_shared_table(self):
+        tlb_infos = TLBInfos(self.table)
+        sizes = ('32M', '48M', '64M')
+        with ThreadPoolExecutor(max_workers=len(sizes)) as pool:
+            futures = [pool.submit(create_image,
+                                   self.path('{0}.img'.format(size)),
+                                   tlb_infos, size, {'boot': self.boot_path})
+                       for size in sizes]
+            for future in futures:
+                future.result()
+
+        for size in sizes:
+            img = self.path('{0}.img'.format(size))
+            self.assertEqual(self.verify(img), [])
+            self.assertPartition(img, 'boot', self.boot)
+
+    def test_errors(self):
+        with self.assertRaises(BinaryError):
+            create_image(self.path('e.img'), self.table, '32M',
+                         {'boot': self.path('missing.img')})
+        with self.assertRaises(LayoutError):
+            create_image(self.path('e.img'), self.path('missing.ini'), '32M',
+                         {})
+        bad = self.write(self.path('bad.ini'),
+                         b'[base]\npartitions = boot\n')
+        with self.assertRaises(LayoutError):
+            create_image(self.path('e.img'), bad, '32M', {})
+        with self.assertRaises(LayoutError):
+            create_image(self.path('e.img'), self.table, '8M', {})
+        with self.assertRaises(GPTImageError):
+            create_image(self.path('e.img'), self.table, '32M',
+                         {'boot': self.write(self.path('big.img'),
+                                             bytes(5 * MIB))})
+
+
+class ZeroRunsTest(ImageTestCase):
+    """
+    Zero runs and holes of the binaries left as holes of the partitions
+    """
+
+    def test_zero_chunks(self):
+        data = (random_data(64 * 1024) + b'\x00' * (2 * MIB) +
+                random_data(4096, 1))
+        bin_path = self.write(self.path('zero.img'), data)
+        allocated = {}
+        for sparse in (False, True):
+            img = self.path('z{0}.img'.format(sparse))
+            self.create(img, {'system': bin_path}, sparse=sparse)
+            self.assertPartition(img, 'system', data)
+            allocated[sparse] = os.stat(img).st_blocks * 512
+        # the zeros are only skipped in sparse mode
+        self.assertLess(allocated[True], MIB)
+        self.assertGreaterEqual(allocated[False], len(data))
+
+    def test_sparse_file(self):
+        data = bytearray(3 * MIB)
+        data[MIB:MIB + 4096] = random_data(4096)
+        bin_path = self.path('holes.img')
+        with open(bin_path, 'wb') as bin_file:
+            bin_file.truncate(len(data))
+            bin_file.seek(MIB)
+            bin_file.write(data[MIB:MIB + 4096])
+
+        allocated = {}
+        for sparse in (False, True):
+            img = self.path('s{0}.img'.format(sparse))
+            self.create(img, {'system': bin_path}, sparse=sparse)
+            self.assertPartition(img, 'system', bytes(data))
+            allocated[sparse] = os.stat(img).st_blocks * 512
+        # the holes of the binary are only kept in sparse mode
+        self.assertLess(allocated[True], MIB)
+        self.assertGreaterEqual(allocated[False], len(data))
+
+    def test_update(self):
+        img = self.path('disk.img')
+        self.create(img, {'system': self.write(self.path('system.img'),
+                                               random_data(3 * MIB))})
+        # the old data is cleared where the new binary is zero
+        data = random_data(4096, 1) + b'\x00' * (2 * MIB) + \
+            random_data(4096, 2)
+        gpt_img = GPTImage(img, '32M')
+        gpt_img.read()
+        gpt_img.update({'system': self.write(self.path('new.img'), data)},
+                       zero_tail=True)
+        self.assertPartition(img, 'system', data)
+
+    def test_extents_unsupported(self):
+        # the whole region is data when the holes can't be found anymore
+        with patch.object(create_gpt_image, 'lseek',
+                          side_effect=[8192, 12288,
+                                       OSError(errno.EINVAL, 'lseek')]):
+            self.assertEqual(data_extents(-1, MIB, 4096), [(4096, MIB)])
+
+    def test_short_fill(self):
+        # the fills shorter than their pattern are hashed too
+        pattern = b'\x01\x02\x03\x04'
+        for length in (1, 2, 3, 5, 3 * MIB + 3):
+            digest = sha256()
+            hash_fill([digest], pattern, length)
+            expected = (pattern * (length // 4 + 1))[:length]
+            self.assertEqual(digest.hexdigest(), sha256(expected).hexdigest())
+            self.assertEqual(fill_pattern(pattern, length),
+                             expected[:MIB])
+
+
+class StatsTest(ImageTestCase):
+    """
+    Statistics of the writes of the images
+    """
+
+    def test_stats(self):
+        data = random_data(MIB)
+        img = self.path('stats.img')
+        create_image(img, self.table, '32M',
+                     {'boot': self.write(self.path('boot.img'), data)},
+                     jobs=2, stats=True)
+        with open(img + BuildStats.SUFFIX, 'r') as stats_file:
+            stats = load(stats_file)
+
+        self.assertEqual(stats['image'], img)
+        phases = dict((phase['name'], phase) for phase in stats['phases'])
+        self.assertIn('layout', phases)
+        self.assertIn('partitions', phases)
+        partitions = dict((part['label'], part)
+                          for part in stats['partitions'])
+        self.assertEqual(partitions['boot']['bytes'], len(data))
+        self.assertGreater(sum(stats['syscalls'].values()), 0)
+        self.assertGreater(stats['peak_rss'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()